@@ -1,15 +1,35 @@
-from fastapi import FastAPI, Depends, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List, Optional
+from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from database import SessionLocal
-from models import Lead
-from datetime import datetime
+from lead_actions import ACTIONS, perform_action, perform_actions
+from funnel import funnel_summary
+from export import FORMATS, MEDIA_TYPES, stream_export
+from metrics import render_all
+import telegram_bot
+import os
 import logging
+import importlib.util
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Outreach Action API")
+WEBHOOK_MODE = os.getenv("TELEGRAM_WEBHOOK_MODE", "0") == "1"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WEBHOOK_MODE:
+        await telegram_bot.start_webhook()
+    yield
+    if WEBHOOK_MODE:
+        await telegram_bot.stop_webhook()
+
+app = FastAPI(title="Outreach Action API", lifespan=lifespan)
 
 # Dependency
 def get_db():
@@ -19,41 +39,91 @@ def get_db():
     finally:
         db.close()
 
-@app.get("/action/sent/{lead_id}")
-async def mark_as_sent(lead_id: str, db: Session = Depends(get_db)):
-    lead = db.query(Lead).filter(Lead.id == lead_id).first()
-    if not lead:
+async def _run_action(lead_id: str, action: str):
+    business_name = await perform_action(lead_id, action)
+    if business_name is None:
         raise HTTPException(status_code=404, detail="Lead not found")
-    
-    lead.state = 'SENT'
-    lead.sent_at = datetime.utcnow()
-    lead.last_interaction_at = lead.sent_at
-    db.commit()
-    logger.info(f"Lead {lead.business_name} marked as SENT")
-    return {"status": "success", "message": f"{lead.business_name} marked as SENT"}
+    return {"status": "success", "message": f"{business_name} marked as {ACTIONS[action]}"}
+
+@app.get("/action/sent/{lead_id}")
+async def mark_as_sent(lead_id: str):
+    return await _run_action(lead_id, "sent")
 
 @app.get("/action/replied/{lead_id}")
-async def mark_as_replied(lead_id: str, db: Session = Depends(get_db)):
-    lead = db.query(Lead).filter(Lead.id == lead_id).first()
-    if not lead:
-        raise HTTPException(status_code=404, detail="Lead not found")
-    
-    lead.state = 'REPLIED'
-    lead.last_interaction_at = datetime.utcnow()
-    db.commit()
-    logger.info(f"Lead {lead.business_name} marked as REPLIED")
-    return {"status": "success", "message": f"{lead.business_name} marked as REPLIED"}
+async def mark_as_replied(lead_id: str):
+    return await _run_action(lead_id, "replied")
 
 @app.get("/action/closed/{lead_id}")
-async def mark_as_closed(lead_id: str, db: Session = Depends(get_db)):
-    lead = db.query(Lead).filter(Lead.id == lead_id).first()
-    if not lead:
-        raise HTTPException(status_code=404, detail="Lead not found")
-    
-    lead.state = 'CLOSED'
-    db.commit()
-    logger.info(f"Lead {lead.business_name} marked as CLOSED")
-    return {"status": "success", "message": f"{lead.business_name} marked as CLOSED"}
+async def mark_as_closed(lead_id: str):
+    return await _run_action(lead_id, "closed")
+
+MAX_BULK_ACTIONS = 500
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Lead timestamps are stored as naive UTC."""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+class ActionItem(BaseModel):
+    lead_id: str
+    action: str  # sent, replied, closed
+    timestamp: Optional[datetime] = None  # when it happened; defaults to now
+
+@app.post("/actions")
+async def bulk_actions(items: List[ActionItem]):
+    """
+    Applies many lead actions in one transaction. Safe to retry: entries
+    already applied come back as "unchanged".
+    """
+    if len(items) > MAX_BULK_ACTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ACTIONS} actions per request")
+    entries = [{"lead_id": item.lead_id, "action": item.action, "at": _naive_utc(item.timestamp)} for item in items]
+    results = await perform_actions(entries)
+    return {"status": "success", "results": results}
+
+@app.get("/analytics/funnel")
+def get_funnel(days: int = 30, niche: Optional[str] = None, city: Optional[str] = None,
+               db: Session = Depends(get_db)):
+    """
+    Funnel counts from the incrementally maintained aggregates: leads per
+    state now, entries per state per day, and send-to-reply latency.
+    """
+    if not 1 <= days <= 366:
+        raise HTTPException(status_code=422, detail="days must be between 1 and 366")
+    return funnel_summary(db, days=days, niche=niche, city=city)
+
+@app.get("/export/leads")
+def export_leads(format: str = "ndjson", state: Optional[List[str]] = Query(None), category: Optional[str] = None,
+                 since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Streams leads as NDJSON, CSV or Parquet; memory stays flat however many rows match."""
+    if format not in FORMATS:
+        raise HTTPException(status_code=422, detail=f"format must be one of {', '.join(FORMATS)}")
+    if format == "parquet":
+        if importlib.util.find_spec("pyarrow") is None:
+            raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+    chunks = stream_export(SessionLocal, format, states=state, category=category,
+                           since=_naive_utc(since), until=_naive_utc(until))
+    filename = f"leads-{datetime.utcnow():%Y%m%d-%H%M%S}.{format}"
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape target: this process plus the discovery workers' snapshots."""
+    return PlainTextResponse(render_all("api"), media_type="text/plain; version=0.0.4")
+
+def mount_telegram_webhook(app: FastAPI):
+    """Serves aiogram updates from this app, replacing the polling listener process."""
+    @app.post(telegram_bot.WEBHOOK_PATH, include_in_schema=False)
+    async def telegram_webhook(request: Request):
+        if not telegram_bot.verify_webhook_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+            raise HTTPException(status_code=403, detail="Invalid secret token")
+        await telegram_bot.feed_webhook_update(await request.json())
+        return {"ok": True}
+
+if WEBHOOK_MODE:
+    mount_telegram_webhook(app)
 
 if __name__ == "__main__":
     import uvicorn
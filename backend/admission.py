@@ -0,0 +1,87 @@
+import logging
+from typing import Dict, List
+from sqlalchemy import and_, update
+from models import Lead
+from ai_agent import remaining_quota
+from telegram_queue import DAILY_SENT_LIMIT, remaining_daily_budget
+from generation_queue import PENDING_STATE, lead_to_data
+
+logger = logging.getLogger(__name__)
+
+CALLS_PER_LEAD = 2   # worst case: EMAIL + WHATSAPP drafts
+BACKLOG_DAYS = 2     # drafts we are willing to hold, in days of Telegram budget
+
+class AdmissionController:
+    """
+    Decides how many newly scraped leads may go on to enrichment and drafting.
+
+    Capacity is the smaller of
+      - drafting: leads the remaining LLM quota can draft, minus leads
+        already waiting for a draft, and
+      - delivery: Telegram budget left today plus the following days'
+        budget (BACKLOG_DAYS in total), minus drafts not yet queued and
+        leads waiting for a draft.
+    Everything past capacity is parked as DISCOVERED, with no browser or
+    LLM work spent on it, and readmitted first in a later window.
+    """
+
+    def __init__(self, llm_calls_left: float, telegram_left: int, pending_drafts: int, unqueued_drafts: int):
+        self.llm_calls_left = llm_calls_left
+        self.telegram_left = telegram_left
+        self.pending_drafts = pending_drafts
+        self.unqueued_drafts = unqueued_drafts
+        draft_capacity = llm_calls_left / CALLS_PER_LEAD - pending_drafts
+        delivery_capacity = (telegram_left + DAILY_SENT_LIMIT * (BACKLOG_DAYS - 1)
+                             - unqueued_drafts - pending_drafts)
+        capacity = min(draft_capacity, delivery_capacity)
+        self.capacity = max(0, int(capacity))  # delivery capacity is always finite
+        self.admitted = 0
+        self.parked = 0
+
+    @classmethod
+    def from_db(cls, db) -> "AdmissionController":
+        pending = db.query(Lead).filter(Lead.state == PENDING_STATE).count()
+        unqueued = db.query(Lead).filter(and_(Lead.state == 'DRAFTED', Lead.is_queued == False)).count()
+        controller = cls(remaining_quota(), remaining_daily_budget(db), pending, unqueued)
+        logger.info(f"Admission: capacity {controller.capacity} leads "
+                    f"(LLM calls left {controller.llm_calls_left}, Telegram left today {controller.telegram_left}, "
+                    f"{pending} awaiting drafts, {unqueued} drafts unqueued)")
+        return controller
+
+    @property
+    def exhausted(self) -> bool:
+        return self.admitted >= self.capacity
+
+    def admit(self) -> bool:
+        """Claims one slot; False means park the lead."""
+        if self.exhausted:
+            self.parked += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def stats(self) -> Dict:
+        return {"capacity": self.capacity, "admitted": self.admitted, "parked": self.parked}
+
+def parked_leads(db, limit: int) -> List[Dict]:
+    """
+    Claims up to `limit` parked leads to readmit, best first, as lead_data
+    dicts ready for enrichment. Unparking is a compare-and-set, so two
+    discovery workers never readmit the same lead. Commits.
+    """
+    if limit <= 0:
+        return []
+    # Best first from the (state, priority) index; a few spare in case another worker wins some
+    parked = db.query(Lead).filter(and_(Lead.state == 'DISCOVERED', Lead.parked_at != None)) \
+        .order_by(Lead.priority.desc(), Lead.created_at.asc()).limit(limit * 2).all()
+    claimed = []
+    for lead in parked:
+        if len(claimed) >= limit:
+            break
+        result = db.execute(
+            update(Lead).where(Lead.id == lead.id, Lead.parked_at != None).values(parked_at=None)
+        )
+        if result.rowcount == 1:
+            claimed.append(lead_to_data(lead))
+    db.commit()
+    return claimed
@@ -2,10 +2,18 @@ import os
 import logging
 import json
 import time
-from typing import Dict, Optional
-from google import genai
+import math
+import tempfile
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from ratelimit import limits, sleep_and_retry
+from quota_ledger import QuotaLedger
+from niches import NicheClassifier
+from generation_cache import GenerationCache, prompt_hash
+from metrics import REGISTRY
+import tracing
+from llm_providers import (
+    LLMProvider, GeminiProvider, OpenAICompatibleProvider, StubProvider, ProviderRouter
+)
 
 load_dotenv()
 
@@ -14,35 +22,24 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # Rate limiting configuration
-GEMINI_CALLS_PER_MINUTE = 5
 GEMINI_CALLS_PER_DAY = 25
-ONE_MINUTE = 60
+# Using gemini-2.5-flash-lite for cost-efficiency and high-volume stability
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
-DAILY_USAGE_FILE = os.path.join(DATA_DIR, "usage.json")
+DAILY_USAGE_FILE = os.path.join(DATA_DIR, "usage.json")  # legacy, migrated into the ledger
 
-def get_daily_usage() -> Dict:
-    """Loads daily usage per key from a persistent file."""
-    os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(DAILY_USAGE_FILE):
-        return {"keys": {}, "date": time.strftime("%Y-%m-%d")}
-    
-    with open(DAILY_USAGE_FILE, "r") as f:
-        try:
-            usage = json.load(f)
-            # Reset if it's a new day
-            if usage.get("date") != time.strftime("%Y-%m-%d"):
-                return {"keys": {}, "date": time.strftime("%Y-%m-%d")}
-            return usage
-        except:
-            return {"keys": {}, "date": time.strftime("%Y-%m-%d")}
-
-def increment_usage(key_index: int):
-    """Increments the daily usage counter for a specific key."""
-    usage = get_daily_usage()
-    key_str = str(key_index)
-    usage["keys"][key_str] = usage["keys"].get(key_str, 0) + 1
-    with open(DAILY_USAGE_FILE, "w") as f:
-        json.dump(usage, f)
+# Paths from QUOTA_DB_FILE / GENERATION_CACHE_FILE, else data/
+ledger = QuotaLedger()
+ledger.import_legacy_json(DAILY_USAGE_FILE)
+if os.getenv("LLM_STUB") == "1":
+    # Offline runs get a throwaway cache, like benchmark.offline_llm, so stub drafts never reach real leads
+    generation_cache = GenerationCache(os.path.join(tempfile.mkdtemp(prefix="llm-stub-"), "generation_cache.db"))
+else:
+    generation_cache = GenerationCache()
+
+LLM_CALL_SECONDS = REGISTRY.histogram("llm_call_seconds", "LLM completion latency", ["provider"])
+LLM_CALLS = REGISTRY.counter("llm_calls", "LLM calls by outcome (ok, error, quota)", ["provider", "outcome"])
+GENERATION_CACHE = REGISTRY.counter("generation_cache", "Generation cache lookups", ["result"])
 
 # Configure API clients
 GEMINI_KEYS = []
@@ -56,11 +53,75 @@ for i in range(1, 10):
 
 logger.info(f"Initialized with {len(GEMINI_KEYS)} Gemini API keys")
 
+def build_providers() -> List[LLMProvider]:
+    """
+    Builds the provider list from the environment.
+    LLM_STUB=1 replaces everything with the offline stub for load tests.
+    """
+    if os.getenv("LLM_STUB") == "1":
+        return [StubProvider(latency=float(os.getenv("LLM_STUB_LATENCY", "0")))]
+
+    # Gemini keys keep their index as ledger key so existing counts carry over
+    providers: List[LLMProvider] = [
+        GeminiProvider(key, GEMINI_MODEL, str(idx), GEMINI_CALLS_PER_DAY)
+        for idx, key in enumerate(GEMINI_KEYS)
+    ]
+    if os.getenv("OPENAI_API_KEY"):
+        limit = os.getenv("OPENAI_CALLS_PER_DAY")
+        providers.append(OpenAICompatibleProvider(
+            "openai", os.getenv("OPENAI_MODEL", "gpt-4o-mini"), os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL"), daily_limit=int(limit) if limit else None
+        ))
+    if os.getenv("LOCAL_LLM_BASE_URL"):
+        # e.g. http://localhost:11434/v1 for Ollama; unmetered
+        providers.append(OpenAICompatibleProvider(
+            "local", os.getenv("LOCAL_LLM_MODEL", "llama3.1"), os.getenv("LOCAL_LLM_API_KEY", "local"),
+            base_url=os.getenv("LOCAL_LLM_BASE_URL")
+        ))
+    return providers
+
+def get_daily_usage() -> Dict:
+    """Today's usage per key, channel and tokens from the shared quota ledger."""
+    return ledger.snapshot()
+
+def has_quota(provider: LLMProvider) -> bool:
+    """True if the provider is unmetered or still under its daily limit."""
+    if provider.daily_limit is None:
+        return True
+    return ledger.key_counts().get(provider.quota_key, 0) < provider.daily_limit
+
+def reserve_usage(provider: LLMProvider, channel: str) -> bool:
+    """Atomically claims one call on a provider. False if it hit its daily limit."""
+    if provider.daily_limit is None:
+        return True
+    return ledger.reserve(provider.quota_key, provider.daily_limit, channel)
+
+def release_usage(provider: LLMProvider, channel: str):
+    """Returns a claimed call when the API attempt produced nothing."""
+    if provider.daily_limit is not None:
+        ledger.release(provider.quota_key, channel)
+
+def remaining_quota() -> float:
+    """Calls still available today across all providers (math.inf if one is unmetered)."""
+    used = ledger.key_counts()
+    remaining = 0
+    for provider in router.providers:
+        if provider.daily_limit is None:
+            return math.inf
+        remaining += max(0, provider.daily_limit - used.get(provider.quota_key, 0))
+    return remaining
+
+router = ProviderRouter(build_providers(), has_quota=has_quota)
+REGISTRY.gauge("llm_quota_remaining", "LLM calls left today across providers").set_function(remaining_quota)
+
 # Company branding
 COMPANY_NAME = "Anchor Digitals"
 SENDER_NAME = "Peter"
 COMPANY_DESCRIPTION = "a specialized tech partner for small businesses in Nigeria"
 
+# Built once: keyword automaton + compact per-niche templates from config/niches.json
+niche_classifier = NicheClassifier.from_file(SENDER_NAME, COMPANY_NAME)
+
 def build_email_prompt(lead_data: Dict) -> str:
     """Builds the AI prompt for extremely personalized email generation."""
     business_name = lead_data.get("name", "your business")
@@ -133,10 +194,12 @@ def build_follow_up_prompt(lead_data: Dict) -> str:
     business_name = lead_data.get("name", "your business")
     category = lead_data.get("category", "business")
     city = lead_data.get("city") or "Abuja"
+    # Part of the prompt so each nudge is drafted (and cached) separately
+    follow_up = lead_data.get("follow_up_number") or 1
     
     prompt = f"""You are {SENDER_NAME}. Circling back to {business_name} ({category}, {city}).
     
-Write a respectul, short check-in.
+Write a respectul, short check-in. This is follow-up #{follow_up}: take a different angle from any earlier one.
 - Tone: Helpful, low pressure.
 - Avoid "Just checking in." Use something like "Did you see my last message regarding the automation for {business_name}?"
 - MAX 140 chars for WhatsApp, 80 words for Email.
@@ -149,66 +212,116 @@ Return ONLY valid JSON:
 """
     return prompt
 
-@sleep_and_retry
-@limits(calls=GEMINI_CALLS_PER_MINUTE, period=ONE_MINUTE)
-def call_gemini_api(client: genai.Client, prompt: str, channel: str) -> Optional[Dict]:
-    """Single API call attempt with error analysis."""
+def build_prompt(lead_data: Dict, channel: str) -> Optional[str]:
+    """
+    Uses the compact niche template when the lead's category (or search
+    query) maps to a niche; falls back to the generic prompts otherwise.
+    """
+    niche = lead_data.get("niche") or niche_classifier.classify(lead_data.get("category"), lead_data.get("query"))
+    if niche:
+        prompt = niche_classifier.build_prompt(niche, channel, lead_data)
+        if prompt:
+            return prompt
+
+    if channel == "EMAIL": return build_email_prompt(lead_data)
+    elif channel == "WHATSAPP": return build_whatsapp_prompt(lead_data)
+    elif channel == "FOLLOW_UP": return build_follow_up_prompt(lead_data)
+    return None
+
+def parse_response(response_text: str) -> Dict:
+    """Parses model output into JSON, tolerating ```json fences."""
+    response_text = (response_text or "").strip()
+    if response_text.startswith("```"):
+        lines = response_text.splitlines()
+        if lines[0].startswith("```"):
+            response_text = "\n".join(lines[1:-1])
+    result = json.loads(response_text.strip())
+    if not isinstance(result, dict):
+        raise ValueError(f"Expected a JSON object, got {type(result).__name__}")
+    return result
+
+def call_llm(provider: LLMProvider, prompt: str, channel: str) -> Optional[Tuple[Dict, int]]:
+    """Single provider attempt with error analysis. Returns (result, tokens) or None."""
+    started = time.monotonic()
     try:
-        # Using gemini-2.5-flash-lite for cost-efficiency and high-volume stability
-        response = client.models.generate_content(
-            model='gemini-2.5-flash-lite',
-            contents=prompt
-        )
-        response_text = response.text.strip()
-        if response_text.startswith("```"):
-            lines = response_text.splitlines()
-            if lines[0].startswith("```"):
-                response_text = "\n".join(lines[1:-1])
-        return json.loads(response_text.strip())
+        response_text, tokens = provider.complete(prompt)
+        result = parse_response(response_text)
+        elapsed = time.monotonic() - started
+        router.record(provider, elapsed, ok=True)
+        LLM_CALL_SECONDS.observe(elapsed, provider=provider.name)
+        LLM_CALLS.inc(provider=provider.name, outcome="ok")
+        return result, tokens
     except Exception as e:
+        elapsed = time.monotonic() - started
+        router.record(provider, elapsed, ok=False)
+        LLM_CALL_SECONDS.observe(elapsed, provider=provider.name)
         error_msg = str(e)
         if "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg:
-            logger.warning(f"Quota issue detected: {error_msg}")
+            LLM_CALLS.inc(provider=provider.name, outcome="quota")
+            logger.warning(f"Quota issue detected on {provider.name}: {error_msg}")
         else:
-            logger.error(f"Gemini API error ({channel}): {error_msg}")
+            LLM_CALLS.inc(provider=provider.name, outcome="error")
+            logger.error(f"{provider.name} API error ({channel}): {error_msg}")
         return None
 
-def generate_message(lead_data: Dict, channel: str = "EMAIL") -> Optional[Dict]:
-    """Generates message with API key rotation and NO generic fallbacks."""
-    if not GEMINI_KEYS:
-        logger.error("No Gemini API keys configured.")
-        return None
+def generate_message(lead_data: Dict, channel: str = "EMAIL", force: bool = False) -> Optional[Dict]:
+    """
+    Generates message on the fastest healthy provider with quota, falling
+    through the rest on failure. NO generic fallbacks.
+    Identical prompts are served from the generation cache unless force=True.
+    """
+    with tracing.span("llm.generate", key=lead_data.get("maps_url"), channel=channel) as attrs:
+        result = _generate_message(lead_data, channel, force)
+        attrs["ok"] = result is not None
+        return result
 
+def _generate_message(lead_data: Dict, channel: str, force: bool) -> Optional[Dict]:
     # Step 1: Select Channel and Build Prompt
-    if channel == "EMAIL": prompt = build_email_prompt(lead_data)
-    elif channel == "WHATSAPP": prompt = build_whatsapp_prompt(lead_data)
-    elif channel == "FOLLOW_UP": prompt = build_follow_up_prompt(lead_data)
-    else: return None
+    prompt = build_prompt(lead_data, channel)
+    if prompt is None:
+        return None
 
-    # Step 2: Try keys in rotation
-    usage = get_daily_usage()
-    
-    for idx, key in enumerate(GEMINI_KEYS):
-        key_str = str(idx)
-        current_usage = usage["keys"].get(key_str, 0)
-        
-        if current_usage >= GEMINI_CALLS_PER_DAY:
+    # Step 2: Reuse a previous generation before spending any quota.
+    # Keyed on the primary model so routing to a fallback doesn't split the cache.
+    cache_key = prompt_hash(GEMINI_MODEL, channel, prompt)
+    if not force:
+        with tracing.span("llm.cache"):
+            cached = generation_cache.get(cache_key)
+        GENERATION_CACHE.inc(result="hit" if cached else "miss")
+        if cached:
+            logger.info(f"Cache hit for {lead_data.get('name')} ({channel}); no quota used")
+            return cached
+
+    if not router.providers:
+        logger.error("No LLM providers configured.")
+        return None
+
+    # Step 3: Route across providers, fastest healthy first
+    for provider in router.candidates():
+        if not reserve_usage(provider, channel):
+            # Another process took the last call on this provider since we checked
             continue
-        
-        logger.info(f"Attempting generation with Key {idx} (Usage: {current_usage}/{GEMINI_CALLS_PER_DAY})")
-        client = genai.Client(api_key=key)
-        
-        result = call_gemini_api(client, prompt, channel)
-        if result:
-            increment_usage(idx)
+
+        logger.info(f"Attempting generation with {provider.name} ({provider.model})")
+        with tracing.span("llm.call", provider=provider.name):
+            outcome = call_llm(provider, prompt, channel)
+        if outcome:
+            result, tokens = outcome
+            if provider.daily_limit is not None:
+                ledger.record_tokens(provider.quota_key, tokens, channel)
+            if not isinstance(provider, StubProvider):
+                # Stub text cached under the primary model's key would be served to real leads
+                generation_cache.put(cache_key, provider.model, channel, result, tokens)
             return result
+        release_usage(provider, channel)
         
-        # If we are here, this key failed. We'll wait a bit and try the next one.
-        logger.warning(f"Key {idx} failed. Pacing rotation...")
-        time.sleep(2)
+        # If we are here, this provider failed. We'll wait a bit and try the next one.
+        logger.warning(f"{provider.name} failed. Pacing rotation...")
+        with tracing.span("llm.rotation_sleep"):
+            time.sleep(2)
     
-    # Step 3: All keys failed or exhausted
-    logger.error(f"All {len(GEMINI_KEYS)} keys failed or reached daily limit. Marking for review.")
+    # Step 4: All providers failed or exhausted
+    logger.error(f"All {len(router.providers)} providers failed or reached daily limit. Marking for review.")
     return None # We return None so main.py can set state to NEEDS_REVIEW
 
 if __name__ == "__main__":
@@ -0,0 +1,402 @@
+"""
+Offline benchmarks for the hot paths.
+
+Nothing here touches the network: Maps feeds and business sites are saved
+HTML (tests/fixtures) served from a local HTTP server to local Playwright
+pages, drafts come from StubProvider and Telegram is tests/fake_telegram.
+Each run writes machine-readable results to data/benchmarks/ and is
+compared with the saved baseline, if there is one.
+
+    python benchmark.py                      # everything, save_lead at 10k/100k/1M rows
+    python benchmark.py --quick              # small sizes, for a quick check
+    python benchmark.py --only save_lead --rows 10000,100000
+    python benchmark.py --save-baseline      # make this run the reference
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import ExitStack, asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from unittest.mock import patch
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BASE_DIR, "tests", "fixtures")
+RESULTS_DIR = os.path.join(BASE_DIR, "data", "benchmarks")
+BASELINE_FILE = os.path.join(RESULTS_DIR, "baseline.json")
+
+ROW_COUNTS = (10_000, 100_000, 1_000_000)  # table sizes for save_lead
+QUICK_ROW_COUNTS = (1_000,)
+STATE_ROWS = 10_000        # leads in the table for maintain_lead_states
+SEED_BATCH = 10_000        # rows per INSERT while seeding
+SAVE_LEAD_CALLS = 500      # new leads saved per size (and as many updates)
+MICRO_INPUTS = 100_000     # inputs for normalize_phone / decide_channels
+CYCLE_QUERIES = 4          # queries per full cycle, each replaying the whole feed
+REPEATS = 5                # Playwright runs per benchmark
+REGRESSION_TOLERANCE = 0.2  # flag results more than 20% slower than the baseline
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+class Skipped(Exception):
+    """The benchmark can't run here, e.g. no Chromium for Playwright."""
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+def _rate(ops: int, seconds: float, **extra) -> Dict:
+    return {"ops": ops, "seconds": round(seconds, 6), "ops_per_sec": round(ops / seconds, 3) if seconds else None,
+            **extra}
+
+# --- Fixtures ---
+
+@asynccontextmanager
+async def fixture_server():
+    """Serves tests/fixtures over HTTP on a free local port; yields the base URL."""
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    app = web.Application()
+    app.router.add_static("/", FIXTURES_DIR)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        yield str(server.make_url("")).rstrip("/")
+    finally:
+        await server.close()
+
+@asynccontextmanager
+async def chromium():
+    from playwright.async_api import async_playwright
+    async with async_playwright() as p:
+        try:
+            browser = await p.chromium.launch(headless=True)
+        except Exception as e:
+            raise Skipped(f"Chromium unavailable ({str(e).splitlines()[0]}); run `playwright install chromium`")
+        try:
+            yield browser
+        finally:
+            await browser.close()
+
+def fixture_leads(tag: str = "") -> List[Dict]:
+    """
+    The saved feed's listings as scraper dicts, read without a browser, for
+    the paths downstream of Maps. `tag` makes maps_urls unique per query.
+    """
+    from utils import normalize_phone
+    from channel_decision import AD_LINK_TERMS
+    with open(os.path.join(FIXTURES_DIR, "maps_feed.html")) as f:
+        html = f.read()
+    leads = []
+    for block in html.split('<div role="article"')[1:]:
+        field = lambda pattern: (re.search(pattern, block) or [None, ""])[1]
+        phone = field(r'class="UsdlK">([^<]*)<') or "N/A"
+        website = field(r'class="lcr4fd[^"]*" href="([^"]*)"')
+        leads.append({
+            "name": field(r'class="qBF1Pd[^"]*">([^<]*)<'),
+            "category": field(r'class="W4Efsd"><span><span>([^<]*)<'),
+            "phone": phone,
+            "normalized_phone": normalize_phone(phone),
+            "website": "" if any(t in website for t in AD_LINK_TERMS) else website,
+            "rating": field(r'class="MW4etd">([^<]*)<'),
+            "reviews": field(r'class="UY7F9">([^<]*)<'),
+            "maps_url": field(r'class="hfpxzc"[^>]*href="([^"]*)"') + (f"&q={tag}" if tag else ""),
+        })
+    return leads
+
+def temp_database(directory: str):
+    """A file SQLite database with the full schema; returns (engine, sessionmaker)."""
+    from models import Base
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    return engine, sessionmaker(bind=engine, autoflush=False)
+
+def seed_leads(engine, count: int, make_row: Callable[[int], Dict]):
+    from models import Lead
+    with engine.begin() as conn:
+        for start in range(0, count, SEED_BATCH):
+            conn.execute(insert(Lead), [make_row(i) for i in range(start, min(count, start + SEED_BATCH))])
+
+def offline_llm(directory: str) -> ExitStack:
+    """StubProvider only, with a throwaway quota ledger and generation cache."""
+    import ai_agent
+    from quota_ledger import QuotaLedger
+    from generation_cache import GenerationCache
+    from llm_providers import ProviderRouter, StubProvider
+    stack = ExitStack()
+    stack.enter_context(patch.object(ai_agent, "ledger", QuotaLedger(os.path.join(directory, "quota.db"))))
+    stack.enter_context(patch.object(ai_agent, "generation_cache",
+                                     GenerationCache(os.path.join(directory, "generation_cache.db"))))
+    stack.enter_context(patch.object(ai_agent, "router",
+                                     ProviderRouter([StubProvider()], has_quota=ai_agent.has_quota)))
+    return stack
+
+# --- Benchmarks ---
+
+@benchmark("feed_extraction")
+async def bench_feed_extraction(options) -> Dict[str, Dict]:
+    """scraper.extract_listings over the saved feed, without the scroll pause."""
+    import scraper
+    async with fixture_server() as base_url, chromium() as browser:
+        page = await browser.new_page()
+        timings, found = [], 0
+        with patch.object(scraper, "SCROLL_PAUSE_MS", 0):
+            for _ in range(options.repeats):
+                await page.goto(f"{base_url}/maps_feed.html")
+                started = time.perf_counter()
+                found = len(await scraper.extract_listings(page, max_results=100))
+                timings.append(time.perf_counter() - started)
+    return {"feed_extraction": _rate(found * len(timings), sum(timings), listings=found)}
+
+@benchmark("email_extraction")
+async def bench_email_extraction(options) -> Dict[str, Dict]:
+    """enrichment.enrich_lead_with_email on the saved site: browser launch, home page, contact pages."""
+    from enrichment import enrich_lead_with_email
+    async with fixture_server() as base_url:
+        async with chromium():
+            pass  # skip cleanly before timing if there is no browser
+        emails: List[str] = []
+        started = time.perf_counter()
+        for _ in range(options.repeats):
+            emails = await enrich_lead_with_email(f"{base_url}/site/index.html")
+        elapsed = time.perf_counter() - started
+    return {"email_extraction": _rate(options.repeats, elapsed, emails=len(emails))}
+
+@benchmark("save_lead")
+async def bench_save_lead(options) -> Dict[str, Dict]:
+    """save_lead inserts and updates against tables of increasing size."""
+    from database import save_lead
+    now = datetime.utcnow()
+    results = {}
+    for rows in options.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            engine, Session = temp_database(directory)
+            started = time.perf_counter()
+            seed_leads(engine, rows, lambda i: {
+                "business_name": f"Seeded {i}", "maps_url": f"https://maps/seed/{i}", "phone_number": "08031234567",
+                "state": "DISCOVERED", "created_at": now, "updated_at": now,
+            })
+            seeded = time.perf_counter() - started
+            db = Session()
+            calls = min(SAVE_LEAD_CALLS, rows)
+            started = time.perf_counter()
+            for i in range(calls):
+                save_lead(db, {"name": f"New {i}", "maps_url": f"https://maps/new/{i}", "phone": "08031234567"})
+            for i in range(0, rows, max(1, rows // calls))[:calls]:
+                save_lead(db, {"name": f"Seeded {i}", "maps_url": f"https://maps/seed/{i}", "rating": "4.5"})
+            elapsed = time.perf_counter() - started
+            db.close()
+            engine.dispose()
+        results[f"save_lead[{rows}]"] = _rate(2 * calls, elapsed, rows=rows, seed_seconds=round(seeded, 3))
+    return results
+
+@benchmark("maintain_lead_states")
+async def bench_maintain_lead_states(options) -> Dict[str, Dict]:
+    """One maintenance pass over a mix of SENT/WAITING/NO_REPLY leads, follow-ups drafted by the stub."""
+    import main
+    now = datetime.utcnow()
+    mix = [("SENT", now), ("WAITING", now - timedelta(days=3)), ("WAITING", now),
+           ("NO_REPLY", now - timedelta(days=6)), ("NO_REPLY", now), ("DRAFTED", now), ("CLOSED", now)]
+    with tempfile.TemporaryDirectory() as directory, offline_llm(directory):
+        engine, Session = temp_database(directory)
+        seed_leads(engine, options.state_rows, lambda i: {
+            "business_name": f"Lead {i}", "maps_url": f"https://maps/state/{i}", "category": "Dentist",
+            "phone_number": "08031234567", "primary_channel": "WHATSAPP", "state": mix[i % len(mix)][0],
+            "last_interaction_at": mix[i % len(mix)][1], "follow_up_count": 0, "created_at": now, "updated_at": now,
+        })
+        db = Session()
+        started = time.perf_counter()
+        await main.maintain_lead_states(db)
+        elapsed = time.perf_counter() - started
+        db.close()
+        engine.dispose()
+    return {"maintain_lead_states": _rate(options.state_rows, elapsed)}
+
+@benchmark("normalize_phone")
+async def bench_normalize_phone(options) -> Dict[str, Dict]:
+    from utils import normalize_phone
+    formats = ["0803 123 {0:04d}", "+234 806 555 {0:04d}", "(0812) 7{0:03d} 010", "806-555-{0:04d}", "N/A", ""]
+    inputs = [formats[i % len(formats)].format(i % 10_000) for i in range(options.micro_inputs)]
+    started = time.perf_counter()
+    for phone in inputs:
+        normalize_phone(phone)
+    return {"normalize_phone": _rate(len(inputs), time.perf_counter() - started)}
+
+@benchmark("decide_channels")
+async def bench_decide_channels(options) -> Dict[str, Dict]:
+    from channel_decision import decide_channels
+    feed = fixture_leads()
+    inputs = [feed[i % len(feed)] for i in range(options.micro_inputs)]
+    started = time.perf_counter()
+    for lead_data in inputs:
+        decide_channels(lead_data)
+    return {"decide_channels": _rate(len(inputs), time.perf_counter() - started)}
+
+@benchmark("full_cycle")
+async def bench_full_cycle(options) -> Dict[str, Dict]:
+    """
+    DiscoveryCycle over the saved feed (scrape replayed, site crawl faked)
+    with stub drafting, then the outbox drained into the fake Telegram server.
+    """
+    import main
+    import telegram_queue
+    from admission import AdmissionController
+    from telegram_sender import TelegramSender
+    from tests.fake_telegram import FakeTelegramServer
+
+    async def replay_feed(business_type, location, max_results=10):
+        return fixture_leads(tag=f"{business_type}-{location}".replace(" ", "+"))
+
+    async def fake_enrich(url):
+        return ["hello@" + url.split("//")[-1].split("/")[0].removeprefix("www.")]
+
+    queries = [f"dentist in Area{n}" for n in range(options.cycle_queries)]
+    with tempfile.TemporaryDirectory() as directory, offline_llm(directory) as stack:
+        engine, Session = temp_database(directory)
+        for target, value in [("SessionLocal", Session), ("scrape_google_maps", replay_feed),
+                              ("enrich_lead_with_email", fake_enrich), ("SCRAPER_DELAY", 0), ("ENRICHMENT_DELAY", 0)]:
+            stack.enter_context(patch.object(main, target, value))
+        for target, value in [("DAILY_SENT_LIMIT", 1_000_000), ("TELEGRAM_BOT_TOKEN", "1:BENCH"),
+                              ("TELEGRAM_CHAT_ID", "1")]:
+            stack.enter_context(patch.object(telegram_queue, target, value))
+
+        admission = AdmissionController(llm_calls_left=1_000_000, telegram_left=1_000_000,
+                                        pending_drafts=0, unqueued_drafts=0)
+        started = time.perf_counter()
+        processed, messages = await main.DiscoveryCycle(set(), admission, sharded=False).run(queries)
+        cycle_seconds = time.perf_counter() - started
+
+        async with FakeTelegramServer() as server:
+            # Unthrottled: this measures our side of delivery, not Telegram's limits
+            sender = TelegramSender("1:BENCH", api_base=server.base_url, global_rate=1e6, chat_rate=1e6,
+                                    chat_burst=1e6)
+            db = Session()
+            delivered = 0
+            started = time.perf_counter()
+            with patch.object(telegram_queue, "get_sender", return_value=sender):
+                while True:
+                    batch = await telegram_queue.drain_outbox(db, limit=200)
+                    if not batch:
+                        break
+                    delivered += batch
+            delivery_seconds = time.perf_counter() - started
+            db.close()
+        engine.dispose()
+    return {
+        "full_cycle": _rate(processed, cycle_seconds, queries=len(queries), messages=messages),
+        "outbox_delivery": _rate(delivered, delivery_seconds),
+    }
+
+# --- Running and comparing ---
+
+async def run_benchmarks(names: Optional[List[str]] = None, **settings) -> Dict:
+    """Runs the named benchmarks (default: all) and returns the results document."""
+    options = argparse.Namespace(rows=list(ROW_COUNTS), state_rows=STATE_ROWS, micro_inputs=MICRO_INPUTS,
+                                 cycle_queries=CYCLE_QUERIES, repeats=REPEATS)
+    for key, value in settings.items():
+        setattr(options, key, value)
+    results, skipped = {}, {}
+    for name in names or list(BENCHMARKS):
+        logger.info(f"Running {name}...")
+        try:
+            results.update(await BENCHMARKS[name](options))
+        except Skipped as e:
+            skipped[name] = str(e)
+            logger.warning(f"Skipped {name}: {e}")
+    return {"created_at": datetime.utcnow().isoformat(timespec="seconds"), "environment": _environment(),
+            "results": results, "skipped": skipped}
+
+def _environment() -> Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+def compare(current: Dict, baseline: Dict, tolerance: float = REGRESSION_TOLERANCE) -> List[Dict]:
+    """Per-result change in throughput against the baseline; `regressed` past the tolerance."""
+    rows = []
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before or not before.get("ops_per_sec") or not result.get("ops_per_sec"):
+            continue
+        change = result["ops_per_sec"] / before["ops_per_sec"] - 1
+        rows.append({"name": name, "baseline": before["ops_per_sec"], "current": result["ops_per_sec"],
+                     "change": round(change, 4), "regressed": change < -tolerance})
+    return rows
+
+def save_results(document: Dict, path: Optional[str] = None) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = path or os.path.join(RESULTS_DIR, f"results-{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+    return path
+
+def format_report(document: Dict, comparison: List[Dict]) -> str:
+    changes = {row["name"]: row for row in comparison}
+    lines = [f"{'benchmark':<26}{'ops':>9}{'seconds':>10}{'ops/s':>13}{'vs baseline':>14}"]
+    for name, r in document["results"].items():
+        row = changes.get(name)
+        delta = f"{row['change']:+.1%}{' !' if row['regressed'] else ''}" if row else "-"
+        lines.append(f"{name:<26}{r['ops']:>9}{r['seconds']:>10.3f}{r['ops_per_sec'] or 0:>13,.1f}{delta:>14}")
+    for name, reason in document["skipped"].items():
+        lines.append(f"{name:<26}skipped: {reason}")
+    return "\n".join(lines)
+
+def _int_list(value: str) -> List[int]:
+    return [int(v.replace("_", "")) for v in value.split(",") if v]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the scraping and outreach hot paths.")
+    parser.add_argument("--only", help=f"comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--rows", type=_int_list, help="save_lead table sizes, e.g. 10000,100000,1000000")
+    parser.add_argument("--quick", action="store_true", help="small sizes and fewer repeats")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="results file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="also write this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--out", help="results file (default: data/benchmarks/results-<time>.json)")
+    args = parser.parse_args()
+    # Measure the code, not log I/O
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    logger.setLevel(logging.INFO)
+
+    names = args.only.split(",") if args.only else None
+    unknown = set(names or []) - set(BENCHMARKS)
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    settings = {}
+    if args.quick:
+        settings = {"rows": list(QUICK_ROW_COUNTS), "state_rows": 1_000, "micro_inputs": 10_000,
+                    "cycle_queries": 2, "repeats": 2}
+    if args.rows:
+        settings["rows"] = args.rows
+
+    document = asyncio.run(run_benchmarks(names, **settings))
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    comparison = compare(document, baseline, args.tolerance) if baseline else []
+    document["comparison"] = comparison
+    print(format_report(document, comparison))
+    print(f"Results: {save_results(document, args.out)}")
+    if args.save_baseline:
+        print(f"Baseline: {save_results(document, args.baseline)}")
+    if any(row["regressed"] for row in comparison):
+        sys.exit(1)
@@ -3,6 +3,9 @@ from typing import Dict, List
 
 logger = logging.getLogger(__name__)
 
+# Ad redirects and links back into Maps aren't the business's own website
+AD_LINK_TERMS = ["/aclk", "googleadservices", "google.com/maps"]
+
 def decide_channels(lead_data: Dict) -> List[str]:
     """
     Decides the outreach channels based on available contact information.
@@ -20,7 +23,7 @@ def decide_channels(lead_data: Dict) -> List[str]:
     """
     website = lead_data.get("website", "").strip()
     # Ensure it's not an ad link or an internal google link
-    has_website = bool(website) and not any(term in website for term in ["/aclk", "googleadservices", "google.com/maps"])
+    has_website = bool(website) and not any(term in website for term in AD_LINK_TERMS)
     
     phone = (lead_data.get("normalized_phone") or lead_data.get("phone", "")).strip()
     
@@ -0,0 +1,75 @@
+import json
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from models import DiscoveryRun, LeadCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# Lead stages recorded before the lead itself is saved
+SCRAPED = 'SCRAPED'
+ENRICHED = 'ENRICHED'
+
+def start_run(db, queries: List[str], owner: Optional[str] = None) -> Tuple[DiscoveryRun, List[str], List[Dict]]:
+    """
+    Resumes `owner`'s unfinished run if there is one, else starts a new run.
+    Returns (run, queries still to scrape, checkpointed lead_data to finish).
+    Resumed leads carry their stage in lead_data['checkpoint_stage'].
+    """
+    run = db.query(DiscoveryRun).filter(DiscoveryRun.status == 'RUNNING', DiscoveryRun.owner == owner) \
+        .order_by(DiscoveryRun.id.desc()).first()
+    if run is None:
+        run = DiscoveryRun(owner=owner, status='RUNNING', done_queries='[]')
+        db.add(run)
+        db.commit()
+        return run, queries, []
+
+    done = set(json.loads(run.done_queries or '[]'))
+    leads = []
+    for checkpoint in db.query(LeadCheckpoint).filter(LeadCheckpoint.run_id == run.id).order_by(LeadCheckpoint.id):
+        lead_data = json.loads(checkpoint.data)
+        lead_data['checkpoint_stage'] = checkpoint.stage
+        leads.append(lead_data)
+    remaining = [q for q in queries if q not in done]
+    logger.info(f"Resuming discovery run {run.id}: {len(done)} queries already done, "
+                f"{len(remaining)} to go, {len(leads)} leads in flight")
+    return run, remaining, leads
+
+def checkpoint_lead(db, run_id: int, lead_data: Dict, stage: str):
+    """Records (or advances) an unsaved lead's progress. Commits."""
+    data = json.dumps({k: v for k, v in lead_data.items() if k != 'checkpoint_stage'}, default=str)
+    checkpoint = db.query(LeadCheckpoint).filter(
+        LeadCheckpoint.run_id == run_id, LeadCheckpoint.maps_url == lead_data['maps_url']
+    ).first()
+    if checkpoint is None:
+        db.add(LeadCheckpoint(run_id=run_id, maps_url=lead_data['maps_url'], stage=stage, data=data))
+    else:
+        checkpoint.stage = stage
+        checkpoint.data = data
+    db.commit()
+
+def is_checkpointed(db, maps_url: str) -> bool:
+    """True if any run, including another worker's unfinished one, holds this lead unsaved."""
+    return db.query(LeadCheckpoint.id).filter(LeadCheckpoint.maps_url == maps_url).first() is not None
+
+def clear_lead(db, run_id: int, maps_url: str):
+    """Drops a lead's checkpoint; call right before saving the lead so both commit together."""
+    db.query(LeadCheckpoint).filter(
+        LeadCheckpoint.run_id == run_id, LeadCheckpoint.maps_url == maps_url
+    ).delete(synchronize_session=False)
+
+def mark_query_done(db, run: DiscoveryRun, query: str):
+    """A query is done once all its leads are checkpointed or saved. Commits."""
+    done = json.loads(run.done_queries or '[]')
+    if query not in done:
+        run.done_queries = json.dumps(done + [query])
+        db.commit()
+
+def finish_run(db, run: DiscoveryRun):
+    """Marks the run DONE. Leads still checkpointed had a stage fail on them and are dropped. Commits."""
+    leftover = db.query(LeadCheckpoint).filter(LeadCheckpoint.run_id == run.id).delete(synchronize_session=False)
+    if leftover:
+        logger.warning(f"Discovery run {run.id} finished with {leftover} unsaved leads (stage errors)")
+    run.status = 'DONE'
+    run.finished_at = datetime.utcnow()
+    db.commit()
@@ -1,16 +1,111 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+import time
+import logging
+from sqlalchemy import create_engine, inspect, text, bindparam, select, update, Column, Integer, String, Text, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import Session, sessionmaker
 from models import Base, Lead
+from funnel import seed_funnel_if_empty  # also registers the funnel flush hook
+from entities import seed_entities_if_empty
+from utils import normalize_phone, parse_rating, parse_review_count, lead_priority
+from metrics import REGISTRY
+import tracing
 import datetime
+
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./outreach.db")
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+DB_COMMIT_SECONDS = REGISTRY.histogram("db_commit_seconds", "Session commit time, including the final flush")
+BACKFILL_BATCH = 5000  # leads per round trip when filling columns added by a migration
+
+@event.listens_for(Session, "before_commit")
+def _commit_started(session):
+    session.info["commit_started"] = time.perf_counter()
+
+@event.listens_for(Session, "after_commit")
+def _commit_finished(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+@event.listens_for(Lead, "before_insert")
+@event.listens_for(Lead, "before_update")
+def _derive_lead_columns(mapper, connection, lead):
+    """Typed copies of the scraped strings and the priority score, kept in step with every ORM write."""
+    lead.rating_value = parse_rating(lead.rating)
+    lead.review_count = parse_review_count(lead.reviews)
+    lead.priority = lead_priority(lead)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    added = migrate_columns(engine)
+    if "leads.priority" in added:
+        backfill_lead_columns(engine)
+    db = SessionLocal()
+    try:
+        seed_funnel_if_empty(db)
+        seed_entities_if_empty(db)
+    finally:
+        db.close()
+
+def migrate_columns(bind) -> set:
+    """
+    Adds model columns and indexes missing from existing tables (create_all
+    only creates new tables). Returns the added columns as "table.column".
+    """
+    inspector = inspect(bind)
+    added = set()
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+                    logger.info(f"Migrated: added {table.name}.{column.name}")
+                    added.add(f"{table.name}.{column.name}")
+            existing_indexes = {ix["name"] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    logger.info(f"Migrated: created index {index.name}")
+    return added
+
+def backfill_lead_columns(bind):
+    """
+    One-off migration for leads saved before the typed columns: parses
+    rating/reviews, stores the priority score, and on Postgres turns
+    follow_up_count into an integer (SQLite keeps the old column affinity).
+    """
+    table = Lead.__table__
+    with bind.begin() as conn:
+        if bind.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE leads ALTER COLUMN follow_up_count TYPE INTEGER "
+                              "USING follow_up_count::integer"))
+        stmt = select(table.c.id, table.c.rating, table.c.reviews, table.c.website_url, table.c.email,
+                      table.c.category).where(table.c.priority == None).order_by(table.c.id).limit(BACKFILL_BATCH)
+        filled, last_id = 0, ""
+        while True:
+            rows = conn.execute(stmt.where(table.c.id > last_id)).all()  # keyset: each batch reads only its rows
+            if not rows:
+                break
+            conn.execute(
+                update(table).where(table.c.id == bindparam("b_id")).values(
+                    rating_value=bindparam("b_rating"), review_count=bindparam("b_reviews"),
+                    priority=bindparam("b_priority")),
+                [{"b_id": row.id, "b_rating": parse_rating(row.rating), "b_reviews": parse_review_count(row.reviews),
+                  "b_priority": lead_priority(row)} for row in rows],
+            )
+            filled += len(rows)
+            last_id = rows[-1].id
+    logger.info(f"Backfilled typed columns and priority for {filled} leads")
 
 def get_db():
     db = SessionLocal()
@@ -21,6 +116,12 @@ def get_db():
 
 def save_lead(db, lead_data: dict):
     """Saves a lead to the database. Updates if maps_url exists."""
+    with tracing.span("db.save_lead", key=lead_data.get('maps_url')) as attrs:
+        lead = _save_lead(db, lead_data)
+        attrs["lead_id"] = lead.id  # lets the trace analyzer join delivery spans, keyed by id
+        return lead
+
+def _save_lead(db, lead_data: dict):
     existing = db.query(Lead).filter(Lead.maps_url == lead_data.get('maps_url')).first()
     
     if existing:
@@ -42,11 +143,15 @@ def save_lead(db, lead_data: dict):
         business_name=lead_data.get('name'),
         category=lead_data.get('category'),
         phone_number=lead_data.get('phone'),
+        normalized_phone=lead_data.get('normalized_phone') or normalize_phone(lead_data.get('phone')) or None,
         email=lead_data.get('email'),
         website_url=lead_data.get('website'),
         maps_url=lead_data.get('maps_url'),
         rating=lead_data.get('rating'),
         reviews=lead_data.get('reviews'),
+        niche=lead_data.get('niche'),
+        city=lead_data.get('city'),
+        parked_at=lead_data.get('parked_at'),
         primary_channel=lead_data.get('primary_channel'),
         email_draft=lead_data.get('email_draft'),
         email_subject=lead_data.get('email_subject'),
@@ -3,12 +3,15 @@ import re
 import logging
 from typing import List, Set
 from playwright.async_api import async_playwright, Page, BrowserContext
+from metrics import REGISTRY
+import tracing
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 EMAIL_REGEX = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-0.-]+\.[a-zA-Z]{2,}'
+ENRICH_SECONDS = REGISTRY.histogram("enrich_site_seconds", "Time to crawl one website for emails")
 FORBIDDEN_DOMAINS = {'sentry.io', 'example.com', 'google.com', 'wixpress.com', 'png', 'jpg', 'jpeg', 'gif'}
 
 async def extract_emails_from_page(page: Page) -> Set[str]:
@@ -45,6 +48,7 @@ async def find_contact_links(page: Page) -> List[str]:
         logger.error(f"Error finding contact links: {e}")
         return []
 
+@ENRICH_SECONDS.timed
 async def enrich_lead_with_email(url: str) -> List[str]:
     """
     Crawls a website to find email addresses.
@@ -55,7 +59,8 @@ async def enrich_lead_with_email(url: str) -> List[str]:
         return []
 
     async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
+        with tracing.span("site.launch"):
+            browser = await p.chromium.launch(headless=True)
         context = await browser.new_context(
             viewport={'width': 1280, 'height': 720},
             user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
@@ -67,7 +72,8 @@ async def enrich_lead_with_email(url: str) -> List[str]:
 
         try:
             logger.info(f"Enriching from Home: {url}")
-            await page.goto(url, timeout=30000, wait_until="networkidle")
+            with tracing.span("site.home", url=url):
+                await page.goto(url, timeout=30000, wait_until="networkidle")
             visited_urls.add(page.url)
             
             # Extract from Home Page
@@ -92,7 +98,8 @@ async def enrich_lead_with_email(url: str) -> List[str]:
                 if full_url not in visited_urls:
                     logger.info(f"Checking Contact Page: {full_url}")
                     try:
-                        await page.goto(full_url, timeout=15000, wait_until="domcontentloaded")
+                        with tracing.span("site.contact", url=full_url):
+                            await page.goto(full_url, timeout=15000, wait_until="domcontentloaded")
                         visited_urls.add(full_url)
                         emails = await extract_emails_from_page(page)
                         found_emails.update(emails)
@@ -0,0 +1,259 @@
+import re
+import math
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+from sqlalchemy import bindparam, func, insert, select, update
+from models import Lead, Entity, EntityKey
+from metrics import REGISTRY
+from utils import normalize_phone
+import tracing
+
+logger = logging.getLogger(__name__)
+
+NAME_THRESHOLD = 0.8      # trigram Jaccard for a name-only match
+KEYED_NAME_THRESHOLD = 0.3  # a shared phone/domain still needs names this alike (malls share switchboards)
+SEED_BATCH = 5000         # leads read per round trip when indexing an existing database
+
+# Hosts many unrelated businesses share, so they say nothing about identity
+GENERIC_DOMAINS = {
+    "facebook.com", "instagram.com", "twitter.com", "x.com", "linkedin.com", "tiktok.com", "youtube.com",
+    "wa.me", "whatsapp.com", "linktr.ee", "business.site", "wixsite.com", "blogspot.com", "wordpress.com",
+    "google.com", "googleadservices.com", "goo.gl", "bit.ly", "sites.google.com",
+}
+# Public suffixes with two labels, so "clinic.com.ng" is the domain and not "com.ng"
+MULTI_PART_SUFFIXES = {"com.ng", "org.ng", "gov.ng", "edu.ng", "net.ng", "name.ng", "co.uk", "org.uk", "co.za",
+                       "com.gh", "co.ke"}
+# Words listings add or drop freely ("Smile Dental Ltd" vs "Smile Dental Clinic Limited")
+NAME_STOPWORDS = {"the", "and", "of", "ltd", "limited", "nig", "nigeria", "plc", "co", "company", "inc",
+                  "enterprise", "enterprises", "services", "ventures", "global", "int", "international"}
+
+ENTITIES_MERGED = REGISTRY.counter("entities_merged", "Listings merged into a business already found", ["match"])
+
+# --- Keys ---
+
+def normalize_name(name: Optional[str]) -> str:
+    words = re.sub(r"[^a-z0-9]+", " ", (name or "").lower()).split()
+    kept = [w for w in words if w not in NAME_STOPWORDS]
+    return " ".join(kept or words)
+
+def name_trigrams(normalized: str) -> Set[str]:
+    """Character trigrams of each word, padded so short words and word starts count."""
+    grams = set()
+    for word in normalized.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    """Jaccard index of two trigram sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def _numbers(normalized: str) -> Set[str]:
+    return set(re.findall(r"\d+", normalized))
+
+def registered_domain(url: Optional[str]) -> Optional[str]:
+    """"https://www.smile.com.ng/contact" -> "smile.com.ng"; None for missing or shared hosts."""
+    if not url or url == "N/A":
+        return None
+    host = urlsplit(url if "//" in url else f"//{url}").hostname or ""
+    labels = host.lower().strip(".").split(".")
+    if len(labels) < 2:
+        return None
+    size = 3 if ".".join(labels[-2:]) in MULTI_PART_SUFFIXES else 2
+    domain = ".".join(labels[-size:])
+    if len(labels) < size or domain in GENERIC_DOMAINS or host in GENERIC_DOMAINS:
+        return None
+    return domain
+
+def _city_key(city: Optional[str]) -> str:
+    return (city or "").strip().lower()
+
+def lead_keys(maps_url: str, name: str, city: Optional[str], phone: Optional[str],
+              domain: Optional[str]) -> List[Dict]:
+    """entity_keys rows for one business; trigrams are blocked by city."""
+    keys = [{"kind": "trigram", "key": f"{_city_key(city)}|{gram}", "maps_url": maps_url}
+            for gram in sorted(name_trigrams(name))]
+    if phone:
+        keys.append({"kind": "phone", "key": phone, "maps_url": maps_url})
+    if domain:
+        keys.append({"kind": "domain", "key": domain, "maps_url": maps_url})
+    return keys
+
+def _entity_row(maps_url: str, name: Optional[str], city: Optional[str], phone: Optional[str],
+                website: Optional[str]) -> Dict:
+    return {"maps_url": maps_url, "name": normalize_name(name), "city": city,
+            "phone": normalize_phone(phone) or None, "domain": registered_domain(website)}
+
+# --- Resolution ---
+
+class EntityResolver:
+    """
+    Incremental entity resolution for scraped listings. Each new listing
+    is looked up by its blocking keys -- exact phone, exact website
+    domain, and name trigrams within its city -- and only the entities
+    sharing a key are compared by name. A match folds the listing into the
+    first one found; otherwise it becomes a new entity.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def resolve(self, lead_data: Dict) -> Optional[str]:
+        """
+        maps_url of the business this listing duplicates (after merging what
+        it adds), or None for a new business, which is indexed. Commits.
+        """
+        maps_url = lead_data['maps_url']
+        with tracing.span("entity.resolve", key=maps_url) as attrs:
+            alias = self.db.execute(select(EntityKey.maps_url).where(
+                EntityKey.kind == "alias", EntityKey.key == maps_url)).scalar()
+            if alias:
+                return alias  # merged on an earlier run
+            if self.db.get(Entity, maps_url) is not None:
+                return None  # this very listing, indexed before it was saved
+            row = _entity_row(maps_url, lead_data.get('name'), lead_data.get('city'),
+                              lead_data.get('normalized_phone') or lead_data.get('phone'), lead_data.get('website'))
+            match = self.find_match(row)
+            if match is None:
+                self.register(row)
+                return None
+            canonical, matched_on, score = match
+            attrs.update(duplicate_of=canonical, match=matched_on)
+            logger.info(f"'{lead_data.get('name')}' is another listing of {canonical} "
+                        f"(same {matched_on}, name similarity {score:.2f}); merging")
+            self.merge(canonical, row, lead_data)
+            ENTITIES_MERGED.inc(match=matched_on)
+            return canonical
+
+    def candidates(self, row: Dict) -> Dict[str, str]:
+        """Entities sharing a blocking key with `row`: maps_url -> strongest shared key kind."""
+        found: Dict[str, str] = {}
+        for kind in ("phone", "domain"):
+            if row[kind]:
+                for maps_url in self.db.execute(select(EntityKey.maps_url).where(
+                        EntityKey.kind == kind, EntityKey.key == row[kind])).scalars():
+                    found.setdefault(maps_url, kind)
+        grams = name_trigrams(row["name"])
+        if grams:
+            # Jaccard >= t needs at least t*|A| shared trigrams, so the DB drops the rest
+            city = _city_key(row["city"])
+            shared = func.count(EntityKey.id)
+            stmt = select(EntityKey.maps_url).where(
+                EntityKey.kind == "trigram", EntityKey.key.in_([f"{city}|{g}" for g in grams])
+            ).group_by(EntityKey.maps_url).having(shared >= math.ceil(NAME_THRESHOLD * len(grams)))
+            for maps_url in self.db.execute(stmt).scalars():
+                found.setdefault(maps_url, "name")
+        return found
+
+    def find_match(self, row: Dict) -> Optional[Tuple[str, str, float]]:
+        """Best (maps_url, matched_on, name similarity) among the candidates, if any passes."""
+        found = self.candidates(row)
+        if not found:
+            return None
+        grams = name_trigrams(row["name"])
+        best = None
+        for entity in self.db.execute(select(Entity).where(Entity.maps_url.in_(list(found)))).scalars():
+            matched_on = found[entity.maps_url]
+            score = similarity(grams, name_trigrams(entity.name))
+            numbers, entity_numbers = _numbers(row["name"]), _numbers(entity.name)
+            if numbers and entity_numbers and numbers != entity_numbers:
+                continue  # "Shop 12" and "Shop 14" in one plaza, even on a shared line
+            if matched_on == "name":
+                # Same name, different number or site: another branch, not the same business
+                conflict = (row["phone"] and entity.phone and row["phone"] != entity.phone) or \
+                           (row["domain"] and entity.domain and row["domain"] != entity.domain)
+                if conflict or score < NAME_THRESHOLD:
+                    continue
+            elif score < KEYED_NAME_THRESHOLD:
+                continue
+            if best is None or score > best[2]:
+                best = (entity.maps_url, matched_on, score)
+        return best
+
+    def register(self, row: Dict):
+        self.db.add(Entity(**row, merged=0, created_at=datetime.utcnow()))
+        keys = lead_keys(row["maps_url"], row["name"], row["city"], row["phone"], row["domain"])
+        if keys:
+            self.db.execute(insert(EntityKey), keys)
+        self.db.commit()
+
+    def merge(self, canonical: str, row: Dict, lead_data: Dict):
+        """
+        Folds a duplicate listing into `canonical`: its phone and domain
+        become keys of the entity, its maps_url an alias, and contact
+        details the saved lead lacks are filled in from it.
+        """
+        entity = self.db.get(Entity, canonical)
+        new_keys = [{"kind": "alias", "key": row["maps_url"], "maps_url": canonical}]
+        for kind in ("phone", "domain"):
+            if row[kind] and row[kind] != getattr(entity, kind):
+                if getattr(entity, kind) is None:
+                    setattr(entity, kind, row[kind])
+                if self.db.execute(select(EntityKey.id).where(EntityKey.kind == kind, EntityKey.key == row[kind],
+                                                              EntityKey.maps_url == canonical)).first() is None:
+                    new_keys.append({"kind": kind, "key": row[kind], "maps_url": canonical})
+        entity.merged = (entity.merged or 0) + 1
+        self.db.execute(insert(EntityKey), new_keys)
+
+        lead = self.db.query(Lead).filter(Lead.maps_url == canonical).first()
+        if lead is not None:  # else still in this cycle's pipeline and saved as scraped
+            phone = lead_data.get('phone')
+            if not lead.phone_number and phone and phone != "N/A":
+                lead.phone_number = phone
+                lead.normalized_phone = row["phone"]
+            website = lead_data.get('website')
+            if not lead.website_url and website and website != "N/A":
+                lead.website_url = website
+        self.db.commit()
+
+# --- Backfill ---
+
+def index_leads(db, rows: Iterable[Dict]) -> int:
+    """
+    Indexes saved leads as entities without merging them, e.g. after a
+    bulk import. `rows` carry maps_url, business_name, city, phone_number
+    (or normalized_phone) and website_url. Doesn't commit.
+    """
+    entities, keys = [], []
+    for lead in rows:
+        row = _entity_row(lead["maps_url"], lead.get("business_name"), lead.get("city"),
+                          lead.get("normalized_phone") or lead.get("phone_number"), lead.get("website_url"))
+        entities.append({**row, "merged": 0, "created_at": datetime.utcnow()})
+        keys += lead_keys(row["maps_url"], row["name"], row["city"], row["phone"], row["domain"])
+    if entities:
+        db.execute(insert(Entity), entities)
+    if keys:
+        db.execute(insert(EntityKey), keys)
+    return len(entities)
+
+def rebuild_entities(db):
+    """
+    Indexes every saved lead in batches and stores the normalized phone of
+    leads saved before the column existed. Existing duplicates are left
+    alone; only listings found from now on are merged.
+    """
+    db.execute(EntityKey.__table__.delete())
+    db.execute(Entity.__table__.delete())
+    stmt = select(Lead.maps_url, Lead.business_name, Lead.city, Lead.phone_number, Lead.normalized_phone,
+                  Lead.website_url).execution_options(yield_per=SEED_BATCH)
+    indexed = 0
+    for batch in db.execute(stmt).mappings().partitions():
+        backfill = [{"b_url": lead["maps_url"], "b_phone": normalize_phone(lead["phone_number"])}
+                    for lead in batch if lead["normalized_phone"] is None and lead["phone_number"]]
+        indexed += index_leads(db, batch)
+        if backfill:
+            db.execute(update(Lead.__table__).where(Lead.__table__.c.maps_url == bindparam("b_url"))
+                       .values(normalized_phone=bindparam("b_phone")), backfill)
+    db.commit()
+    logger.info(f"Indexed {indexed} leads for entity resolution")
+
+def seed_entities_if_empty(db):
+    """Builds the index once for databases created before it existed."""
+    if db.execute(select(Entity.maps_url).limit(1)).first() is None and \
+            db.execute(select(Lead.id).limit(1)).first() is not None:
+        logger.info("Seeding entity index from existing leads...")
+        rebuild_entities(db)
@@ -0,0 +1,182 @@
+import io
+import csv
+import json
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import DateTime, Float, Integer, and_, or_, select
+from models import Lead
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 1000
+FORMATS = ("ndjson", "csv", "parquet")
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+EXPORT_COLUMNS = [
+    Lead.id, Lead.business_name, Lead.category, Lead.niche, Lead.city, Lead.phone_number, Lead.email,
+    Lead.website_url, Lead.maps_url, Lead.rating, Lead.reviews, Lead.primary_channel, Lead.state,
+    Lead.follow_up_count, Lead.email_subject, Lead.email_draft, Lead.whatsapp_draft,
+    Lead.queued_at, Lead.sent_at, Lead.last_interaction_at, Lead.created_at, Lead.updated_at,
+]
+FIELDNAMES = [col.key for col in EXPORT_COLUMNS]
+
+def iter_lead_batches(db, states: Optional[List[str]] = None, category: Optional[str] = None,
+                      since: Optional[datetime] = None, until: Optional[datetime] = None,
+                      batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Dict]]:
+    """
+    Yields leads as lists of plain dicts, `batch_size` at a time.
+
+    Keyset pagination on (created_at, id) -- each page starts after the last
+    row of the previous one via the ix_leads_created_id index, so late pages
+    cost the same as the first and no ORM objects pile up in the session.
+    """
+    base = select(*EXPORT_COLUMNS)
+    if states:
+        base = base.where(Lead.state.in_(states))
+    if category:
+        base = base.where(Lead.category.ilike(f"%{category}%"))
+    if since:
+        base = base.where(Lead.created_at >= since)
+    if until:
+        base = base.where(Lead.created_at < until)
+    base = base.order_by(Lead.created_at, Lead.id).limit(batch_size)
+
+    last = None
+    while True:
+        stmt = base
+        if last is not None:
+            created_at, lead_id = last
+            stmt = stmt.where(or_(
+                Lead.created_at > created_at,
+                and_(Lead.created_at == created_at, Lead.id > lead_id),
+            ))
+        rows = [dict(row._mapping) for row in db.execute(stmt)]
+        if not rows:
+            return
+        yield rows
+        last = (rows[-1]["created_at"], rows[-1]["id"])
+        if len(rows) < batch_size:
+            return
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def iter_ndjson(batches: Iterator[List[Dict]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield "".join(
+            json.dumps({k: _plain(v) for k, v in row.items()}, ensure_ascii=False) + "\n" for row in batch
+        ).encode("utf-8")
+
+def iter_csv(batches: Iterator[List[Dict]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows({k: _plain(v) for k, v in row.items()} for row in batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands written bytes back to the caller in chunks."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def iter_parquet(batches: Iterator[List[Dict]]) -> Iterator[bytes]:
+    """One Parquet row group per batch; only the current batch is held in memory."""
+    try:
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow") from e
+
+    schema = _arrow_schema(pa)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for batch in batches:
+            frame = pd.DataFrame(batch, columns=FIELDNAMES)
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def _arrow_schema(pa):
+    """Typed from the model, so a batch of all-NULL values can't change a column's type."""
+    arrow_types = {DateTime: pa.timestamp("us"), Float: pa.float64(), Integer: pa.int64()}
+    return pa.schema([
+        pa.field(col.key, next((t for sa_type, t in arrow_types.items() if isinstance(col.type, sa_type)), pa.string()))
+        for col in EXPORT_COLUMNS
+    ])
+
+WRITERS = {"ndjson": iter_ndjson, "csv": iter_csv, "parquet": iter_parquet}
+
+def stream_export(session_factory, fmt: str = "ndjson", **filters) -> Iterator[bytes]:
+    """Opens its own session for the lifetime of the stream (FastAPI iterates it after the handler returns)."""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    db = session_factory()
+    try:
+        yield from WRITERS[fmt](iter_lead_batches(db, **filters))
+    finally:
+        db.close()
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+if __name__ == "__main__":
+    import sys
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Stream leads out of the database.")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--state", action="append", help="repeatable, e.g. --state SENT --state REPLIED")
+    parser.add_argument("--category", help="case-insensitive substring of the Maps category")
+    parser.add_argument("--since", help="created on/after this ISO date")
+    parser.add_argument("--until", help="created before this ISO date")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument("--out", help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    chunks = stream_export(
+        SessionLocal, args.format, states=args.state, category=args.category,
+        since=_parse_date(args.since), until=_parse_date(args.until), batch_size=args.batch_size,
+    )
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    try:
+        written = 0
+        for chunk in chunks:
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        if args.out:
+            out.close()
+    print(f"Exported {written} bytes", file=sys.stderr)
@@ -0,0 +1,180 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from models import Lead, FunnelCount, FunnelCurrent, ReplyLatency
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = "unknown"  # niche/city bucket for leads without one
+# Send-to-reply histogram bucket upper bounds, in hours
+LATENCY_BUCKETS = (1, 4, 12, 24, 48, 72, 168)
+
+LEAD_TRANSITIONS = REGISTRY.counter("lead_transitions", "Lead state changes", ["from_state", "to_state"])
+
+def latency_bucket(hours: float) -> str:
+    for bound in LATENCY_BUCKETS:
+        if hours <= bound:
+            return f"{bound}h"
+    return "inf"
+
+class FunnelDelta:
+    """Aggregate changes collected during one flush, written with one statement per key."""
+
+    def __init__(self):
+        self.entered: Counter = Counter()   # (day, state, niche, city)
+        self.current: Counter = Counter()   # (state, niche, city)
+        self.latency: Counter = Counter()   # (day, niche, city, bucket)
+
+    def transition(self, old_state: Optional[str], new_state: Optional[str], niche: Optional[str],
+                   city: Optional[str], at: datetime, sent_at: Optional[datetime] = None):
+        if old_state == new_state:
+            return
+        niche, city = niche or UNKNOWN, city or UNKNOWN
+        LEAD_TRANSITIONS.inc(from_state=old_state or "NEW", to_state=new_state or "DELETED")
+        if old_state:
+            self.current[(old_state, niche, city)] -= 1
+        if new_state:
+            self.current[(new_state, niche, city)] += 1
+            self.entered[(at.strftime("%Y-%m-%d"), new_state, niche, city)] += 1
+        if new_state == "REPLIED" and sent_at and at >= sent_at:
+            hours = (at - sent_at).total_seconds() / 3600
+            self.latency[(at.strftime("%Y-%m-%d"), niche, city, latency_bucket(hours))] += 1
+
+    def __bool__(self):
+        return bool(self.entered or self.current or self.latency)
+
+    def apply(self, conn):
+        """Upserts the deltas, one statement per key, so concurrent writers can't both insert a new row."""
+        for (day, state, niche, city), n in self.entered.items():
+            _bump(conn, FunnelCount, FunnelCount.entered,
+                  {"day": day, "state": state, "niche": niche, "city": city}, n)
+        for (state, niche, city), n in self.current.items():
+            if n:
+                _bump(conn, FunnelCurrent, FunnelCurrent.leads, {"state": state, "niche": niche, "city": city}, n)
+        for (day, niche, city, bucket), n in self.latency.items():
+            _bump(conn, ReplyLatency, ReplyLatency.replies,
+                  {"day": day, "niche": niche, "city": city, "bucket": bucket}, n)
+
+def _bump(conn, model, column, key: Dict, n: int):
+    """Adds n to one aggregate row in a single INSERT ... ON CONFLICT DO UPDATE."""
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f"Funnel aggregates need SQLite or Postgres, not {dialect}")
+    stmt = insert(model).values(**key, **{column.key: n})
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[getattr(model, k) for k in key], set_={column.key: column + stmt.excluded[column.key]}
+    ))
+
+def record_transitions(db, transitions: List[Tuple]):
+    """
+    Records transitions made outside the ORM (Core UPDATEs in lead_actions).
+    Each item is (old_state, new_state, niche, city, at, sent_at). Runs in db's transaction.
+    """
+    delta = FunnelDelta()
+    for old_state, new_state, niche, city, when, sent_at in transitions:
+        delta.transition(old_state, new_state, niche, city, when or datetime.utcnow(), sent_at)
+    if delta:
+        delta.apply(db.connection())
+
+@event.listens_for(Session, "before_flush")
+def _track_lead_transitions(session, flush_context, instances):
+    """Every ORM state change (new lead, draft, queue, follow-up) updates the aggregates in the same transaction."""
+    now = datetime.utcnow()
+    delta = FunnelDelta()
+    for obj in session.new:
+        if isinstance(obj, Lead):
+            delta.transition(None, obj.state or "DISCOVERED", obj.niche, obj.city, obj.created_at or now)
+    for obj in session.dirty:
+        if not isinstance(obj, Lead):
+            continue
+        history = inspect(obj).attrs.state.history
+        if not history.added:
+            continue
+        if history.deleted:
+            old_state = history.deleted[0]
+        else:
+            # Assigned after a commit expired the row; the database still has the old value
+            old_state = session.connection().execute(select(Lead.state).where(Lead.id == obj.id)).scalar()
+        at = obj.last_interaction_at if obj.state == "REPLIED" and obj.last_interaction_at else now
+        delta.transition(old_state, history.added[0], obj.niche, obj.city, at, obj.sent_at)
+    for obj in session.deleted:
+        if isinstance(obj, Lead):
+            delta.transition(obj.state, None, obj.niche, obj.city, now)
+    if delta:
+        delta.apply(session.connection())
+
+def rebuild_funnel(db):
+    """
+    Recomputes the aggregates from the leads table. One full scan; used to
+    seed an existing database and to repair drift, never on the read path.
+    """
+    conn = db.connection()
+    for model in (FunnelCount, FunnelCurrent, ReplyLatency):
+        conn.execute(model.__table__.delete())
+    delta = FunnelDelta()
+    rows = db.execute(select(Lead.state, Lead.niche, Lead.city, Lead.created_at, Lead.sent_at,
+                             Lead.last_interaction_at))
+    for state, niche, city, created_at, sent_at, last_interaction_at in rows:
+        created_at = created_at or datetime.utcnow()
+        delta.entered[(created_at.strftime("%Y-%m-%d"), "DISCOVERED", niche or UNKNOWN, city or UNKNOWN)] += 1
+        if sent_at:
+            delta.entered[(sent_at.strftime("%Y-%m-%d"), "SENT", niche or UNKNOWN, city or UNKNOWN)] += 1
+        if state:
+            delta.current[(state, niche or UNKNOWN, city or UNKNOWN)] += 1
+        if state == "REPLIED" and sent_at and last_interaction_at and last_interaction_at >= sent_at:
+            hours = (last_interaction_at - sent_at).total_seconds() / 3600
+            delta.latency[(last_interaction_at.strftime("%Y-%m-%d"), niche or UNKNOWN, city or UNKNOWN,
+                           latency_bucket(hours))] += 1
+    delta.apply(conn)
+    db.commit()
+
+def seed_funnel_if_empty(db):
+    """Backfills the aggregates once for databases created before they existed."""
+    if db.execute(select(FunnelCurrent.state).limit(1)).first() is None and \
+            db.execute(select(Lead.id).limit(1)).first() is not None:
+        logger.info("Seeding funnel aggregates from existing leads...")
+        rebuild_funnel(db)
+
+def funnel_summary(db, days: int = 30, niche: Optional[str] = None, city: Optional[str] = None) -> Dict:
+    """
+    Reads only the aggregate tables, whose size depends on the number of
+    states/niches/cities/days -- not on how many leads there are.
+    """
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+    def filtered(stmt, model):
+        if niche:
+            stmt = stmt.where(model.niche == niche)
+        if city:
+            stmt = stmt.where(model.city == city)
+        return stmt
+
+    current = dict(db.execute(filtered(
+        select(FunnelCurrent.state, func.sum(FunnelCurrent.leads)).group_by(FunnelCurrent.state), FunnelCurrent
+    )).all())
+
+    daily: Dict[str, Dict[str, int]] = {}
+    stmt = select(FunnelCount.day, FunnelCount.state, func.sum(FunnelCount.entered)) \
+        .where(FunnelCount.day >= since).group_by(FunnelCount.day, FunnelCount.state)
+    for day, state, entered in db.execute(filtered(stmt, FunnelCount)):
+        daily.setdefault(day, {})[state] = entered
+
+    stmt = select(ReplyLatency.bucket, func.sum(ReplyLatency.replies)) \
+        .where(ReplyLatency.day >= since).group_by(ReplyLatency.bucket)
+    histogram = dict(db.execute(filtered(stmt, ReplyLatency)).all())
+    buckets = [f"{b}h" for b in LATENCY_BUCKETS] + ["inf"]
+
+    return {
+        "since": since,
+        "current": {state: n for state, n in current.items() if n},
+        "daily": dict(sorted(daily.items())),
+        "reply_latency_hours": {b: histogram.get(b, 0) for b in buckets},
+    }
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import closing
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+CACHE_DB_FILE = os.getenv("GENERATION_CACHE_FILE", os.path.join(DATA_DIR, "generation_cache.db"))
+CACHE_TTL = 7 * 24 * 60 * 60  # a week; drafts older than that are regenerated
+CACHE_MAX_ENTRIES = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    response TEXT NOT NULL,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+)
+"""
+
+def prompt_hash(model: str, channel: str, prompt: str) -> str:
+    """Stable cache key for a rendered prompt."""
+    digest = hashlib.sha256()
+    for part in (model, channel, prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class GenerationCache:
+    """
+    Persistent cache of LLM responses keyed by prompt_hash().
+
+    Entries expire after `ttl` seconds and the least recently used ones
+    are evicted once there are more than `max_entries`. Survives restarts,
+    so a lead redrafted after a crash or NEEDS_REVIEW costs no quota.
+    """
+
+    def __init__(self, path: str = CACHE_DB_FILE, ttl: float = CACHE_TTL,
+                 max_entries: int = CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._tokens_saved = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_generations_lru ON generations (last_used_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Returns the cached response for `key`, or None if missing/expired."""
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT response, tokens, created_at FROM generations WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[2] > self.ttl:
+                    conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+                    row = None
+                if row:
+                    conn.execute(
+                        "UPDATE generations SET hits = hits + 1, last_used_at = ? WHERE key = ?",
+                        (now, key)
+                    )
+        except sqlite3.Error as e:
+            logger.warning(f"Generation cache read failed: {e}")
+            row = None
+
+        with self._lock:
+            if not row:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._tokens_saved += row[1]
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, channel: str, response: Dict, tokens: int = 0):
+        """Stores a response and evicts the least recently used overflow."""
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO generations "
+                    "(key, model, channel, response, tokens, hits, created_at, last_used_at) "
+                    "VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                    (key, model, channel, json.dumps(response), int(tokens or 0), now, now)
+                )
+                conn.execute("DELETE FROM generations WHERE created_at < ?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM generations WHERE key IN ("
+                    "SELECT key FROM generations ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Generation cache write failed: {e}")
+
+    def stats(self) -> Dict:
+        """Hit/miss counters for this process plus lifetime totals on disk."""
+        with closing(self._connect()) as conn:
+            entries, lifetime_hits, lifetime_tokens = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * tokens), 0) FROM generations"
+            ).fetchone()
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "calls_saved": self._hits,
+                "tokens_saved": self._tokens_saved,
+                "lifetime_calls_saved": lifetime_hits,
+                "lifetime_tokens_saved": lifetime_tokens,
+            }
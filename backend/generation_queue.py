@@ -0,0 +1,97 @@
+import logging
+from typing import Dict, List, Tuple
+from models import Lead
+from channel_decision import decide_channels
+from ai_agent import generate_message, remaining_quota
+from telegram_render import render_lead
+
+logger = logging.getLogger(__name__)
+
+# Leads that have a viable channel but no drafts yet wait in this state
+PENDING_STATE = 'PENDING_DRAFT'
+
+def lead_to_data(lead: Lead) -> Dict:
+    """Converts a Lead row back into the dict shape used by the drafting code."""
+    return {
+        "name": lead.business_name,
+        "category": lead.category or "",
+        "phone": lead.phone_number or "",
+        "email": lead.email,
+        "website": lead.website_url or "",
+        "maps_url": lead.maps_url,
+        "rating": lead.rating,
+        "reviews": lead.reviews,
+        "niche": lead.niche,
+        "city": lead.city,
+    }
+
+def draft_lead(lead: Lead, lead_data: Dict, channels: List[str]) -> int:
+    """
+    Drafts every channel for one lead. Returns the number of messages generated.
+    Leaves the lead PENDING_DRAFT if quota ran out, NEEDS_REVIEW on real failures.
+    """
+    generated = 0
+    for channel in channels:
+        logger.info(f"Generating {channel} message for {lead.business_name}...")
+        message_result = generate_message(lead_data, channel=channel)
+        if not message_result:
+            if remaining_quota() <= 0:
+                logger.info(f"Quota exhausted mid-lead; deferring {lead.business_name} to next window")
+            else:
+                logger.warning(f"AI Failed for {lead.business_name} on {channel}")
+                lead.state = 'NEEDS_REVIEW'
+            return generated
+
+        if channel == "EMAIL":
+            lead.email_subject = message_result.get('subject')
+            lead.email_draft = message_result.get('message')
+        elif channel == "WHATSAPP":
+            lead.whatsapp_draft = message_result.get('message')
+        generated += 1
+
+    lead.primary_channel = channels[0]
+    lead.state = 'DRAFTED'
+    render_lead(lead)
+    return generated
+
+def process_generation_queue(db) -> Tuple[int, int]:
+    """
+    Spends the remaining LLM quota on the highest-value pending leads first.
+    Anything that doesn't fit stays PENDING_DRAFT for the next quota window.
+    Returns (leads drafted, messages generated).
+    """
+    # Already in value order: the stored priority is score_lead, read through ix_leads_state_priority
+    pending = db.query(Lead).filter(Lead.state == PENDING_STATE) \
+        .order_by(Lead.priority.desc(), Lead.created_at.asc()).all()
+    if not pending:
+        return 0, 0
+
+    ranked = [(lead.priority, lead, lead_to_data(lead)) for lead in pending]
+    budget = remaining_quota()
+    logger.info(f"Generation queue: {len(ranked)} pending leads, {budget} calls left today")
+
+    drafted = 0
+    messages = 0
+    for score, lead, lead_data in ranked:
+        if budget <= 0:
+            break
+        channels = decide_channels(lead_data)
+        if not channels:
+            lead.state = 'DISCOVERED'
+            continue
+        if len(channels) > budget:
+            # Not enough left for every channel; a cheaper lead may still fit
+            continue
+
+        logger.info(f"Drafting {lead.business_name} (score {score})")
+        generated = draft_lead(lead, lead_data, channels)
+        messages += generated
+        if lead.state == 'DRAFTED':
+            drafted += 1
+        db.commit()
+        budget = remaining_quota()
+
+    deferred = sum(1 for _, lead, _ in ranked if lead.state == PENDING_STATE)
+    if deferred:
+        logger.info(f"Deferred {deferred} pending leads to the next quota window")
+    return drafted, messages
@@ -0,0 +1,45 @@
+import asyncio
+import logging
+from typing import Optional
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Connection pool configuration
+POOL_LIMIT = 20               # total open connections
+POOL_LIMIT_PER_HOST = 10      # api.telegram.org, the Action API, ...
+DNS_CACHE_TTL = 300           # seconds
+KEEPALIVE_TIMEOUT = 60        # seconds an idle connection is kept for reuse
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the process-wide HTTP session, creating it on first use.
+    Connections to the same host are kept alive and reused across calls.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        # A session is tied to the loop that created it (asyncio.run in scripts/tests)
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+        _session_loop = loop
+        logger.debug("Opened shared HTTP session")
+    return _session
+
+async def close_session():
+    """Closes the shared session; call once on shutdown."""
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.debug("Closed shared HTTP session")
+    _session = None
+    _session_loop = None
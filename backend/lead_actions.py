@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy import select, text, update
+from database import SessionLocal
+from models import Lead
+from funnel import record_transitions
+
+logger = logging.getLogger(__name__)
+
+# action name (as used in URLs and callback data) -> resulting lead state
+ACTIONS = {
+    "sent": "SENT",
+    "replied": "REPLIED",
+    "closed": "CLOSED",
+}
+
+# Bulk entries never move a lead back down this order, so retried or
+# late-arriving entries are no-ops (a "sent" replayed after "replied").
+# The states maintain_lead_states moves a sent lead through rank as SENT.
+ACTION_RANK = {"SENT": 1, "WAITING": 1, "NO_REPLY": 1, "FOLLOW_UP_ELIGIBLE": 1, "REPLIED": 2, "CLOSED": 3}
+
+def _action_values(action: str, at: datetime) -> Dict:
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown lead action: {action}")
+    values = {"state": ACTIONS[action], "updated_at": at}
+    if action == "sent":
+        values["sent_at"] = at
+        values["last_interaction_at"] = at
+    elif action == "replied":
+        values["last_interaction_at"] = at
+    return values
+
+def _lock_for_write(db):
+    """
+    SQLite has no row locks, so take its write lock up front (BEGIN
+    IMMEDIATE, as quota_ledger does); Postgres locks the rows read
+    with FOR UPDATE instead.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        raw = db.connection().connection.driver_connection
+        if not raw.in_transaction:
+            db.execute(text("BEGIN IMMEDIATE"))
+
+def apply_action(db, lead_id: str, action: str, at: Optional[datetime] = None) -> Optional[str]:
+    """
+    Applies a user action to one lead and records the transition in the
+    funnel aggregates. The lead is read and updated in one transaction
+    holding its row lock, so two actions on the same lead can't both
+    count it leaving the old state. Returns the business name, or None
+    if the lead doesn't exist. Commits.
+    """
+    at = at or datetime.utcnow()
+    values = _action_values(action, at)
+    try:
+        _lock_for_write(db)
+        before = db.execute(
+            select(Lead.state, Lead.niche, Lead.city, Lead.sent_at, Lead.business_name)
+            .where(Lead.id == lead_id).with_for_update()
+        ).first()
+        if before is None:
+            db.rollback()
+            return None
+        old_state, niche, city, sent_at, business_name = before
+        db.execute(update(Lead).where(Lead.id == lead_id).values(**values))
+        record_transitions(db, [(old_state, values["state"], niche, city, at, values.get("sent_at", sent_at))])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    logger.info(f"Lead {business_name} marked as {ACTIONS[action]}")
+    return business_name
+
+def apply_actions(db, items: List[Dict]) -> List[Dict]:
+    """
+    Applies many {"lead_id", "action", "at"} entries in one transaction.
+
+    Entries are replayed per lead in timestamp order, then written with one
+    bulk UPDATE per action type. Idempotent: an entry whose state the lead
+    already has (or has moved past) is reported as "unchanged" and leaves
+    its timestamps alone. Returns one result per entry, in input order.
+    """
+    results: List[Optional[Dict]] = [None] * len(items)
+    valid = []
+    for i, item in enumerate(items):
+        if item.get("action") not in ACTIONS:
+            results[i] = {"lead_id": item.get("lead_id"), "action": item.get("action"), "status": "invalid"}
+        else:
+            valid.append(i)
+
+    lead_ids = {items[i]["lead_id"] for i in valid}
+    if lead_ids:
+        # Locked until the commit below, so a concurrent action can't move these leads in between
+        _lock_for_write(db)
+        rows = db.execute(
+            select(Lead.id, Lead.state, Lead.niche, Lead.city, Lead.sent_at).where(Lead.id.in_(lead_ids))
+            .with_for_update()
+        ).all()
+    else:
+        rows = []
+    current = {row.id: row.state for row in rows}
+    leads = {row.id: row for row in rows}
+
+    now = datetime.utcnow()
+    pending: Dict[str, Dict] = {}  # lead_id -> merged column values
+    transitions = []  # for the funnel aggregates
+    for i in sorted(valid, key=lambda i: items[i].get("at") or now):
+        lead_id, action = items[i]["lead_id"], items[i]["action"]
+        result = {"lead_id": lead_id, "action": action}
+        results[i] = result
+        if lead_id not in current:
+            result["status"] = "not_found"
+            continue
+        state = ACTIONS[action]
+        at = items[i].get("at") or now
+        sent_at = pending.get(lead_id, {}).get("sent_at", leads[lead_id].sent_at)
+        # A "sent" no newer than the recorded send is a replay, even once a follow-up was re-queued
+        if ACTION_RANK.get(current[lead_id], 0) >= ACTION_RANK[state] or \
+                (action == "sent" and sent_at is not None and at <= sent_at):
+            result["status"] = "unchanged"
+            continue
+        values = _action_values(action, at)
+        pending.setdefault(lead_id, {"id": lead_id}).update(values)
+        lead = leads[lead_id]
+        transitions.append((current[lead_id], state, lead.niche, lead.city, at,
+                            pending[lead_id].get("sent_at", lead.sent_at)))
+        current[lead_id] = state
+        result["status"] = "updated"
+
+    # One executemany UPDATE per action type (leads that merged several
+    # entries, e.g. sent+replied, carry extra columns and form their own group)
+    groups: Dict[tuple, List[Dict]] = {}
+    for lead_id, values in pending.items():
+        groups.setdefault(tuple(sorted(values)), []).append(values)
+    try:
+        for rows in groups.values():
+            db.execute(update(Lead), rows)
+        record_transitions(db, transitions)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for result in results:
+        if result["status"] in ("updated", "unchanged"):
+            result["state"] = current[result["lead_id"]]  # the lead's state after the batch
+    logger.info(f"Bulk actions: {len(pending)} leads updated from {len(items)} entries")
+    return results
+
+def _apply_in_session(lead_id: str, action: str, at: Optional[datetime]) -> Optional[str]:
+    db = SessionLocal()
+    try:
+        return apply_action(db, lead_id, action, at)
+    finally:
+        db.close()
+
+async def perform_action(lead_id: str, action: str, at: Optional[datetime] = None) -> Optional[str]:
+    """
+    Async entry point for the FastAPI routes and the bot handlers.
+    The blocking DB round trip runs in a worker thread so the event loop stays free.
+    """
+    return await asyncio.to_thread(_apply_in_session, lead_id, action, at)
+
+def _apply_many_in_session(items: List[Dict]) -> List[Dict]:
+    db = SessionLocal()
+    try:
+        return apply_actions(db, items)
+    finally:
+        db.close()
+
+async def perform_actions(items: List[Dict]) -> List[Dict]:
+    """Async wrapper around apply_actions() for the bulk endpoint."""
+    return await asyncio.to_thread(_apply_many_in_session, items)
@@ -0,0 +1,299 @@
+import os
+import re
+import time
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+from models import Lead
+from funnel import record_transitions
+from entities import index_leads
+from channel_decision import AD_LINK_TERMS
+from utils import HIGH_VALUE_KEYWORDS
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 5000
+PHONE_SCAN_BATCH = 50_000  # existing phone numbers read per round trip when building the index
+
+# Lead field -> header spellings seen in old campaign sheets and directory exports
+COLUMN_ALIASES = {
+    "name": ("name", "business_name", "business", "company", "company_name", "title"),
+    "category": ("category", "business_type", "type", "industry"),
+    "phone": ("phone", "phone_number", "telephone", "tel", "mobile", "whatsapp"),
+    "email": ("email", "email_address", "e_mail"),
+    "website": ("website", "website_url", "url", "site", "web"),
+    "maps_url": ("maps_url", "google_maps_url", "maps_link", "place_url"),
+    "city": ("city", "town", "location", "area"),
+    "rating": ("rating", "stars"),
+    "reviews": ("reviews", "review_count", "reviews_count"),
+}
+# Import field -> Lead column
+LEAD_COLUMNS = {"name": "business_name", "phone": "phone_number", "website": "website_url"}
+# Filled in from the file on re-import; state and drafts are never overwritten
+UPSERT_COLUMNS = ("business_name", "category", "phone_number", "normalized_phone", "email", "website_url",
+                  "rating", "reviews", "rating_value", "review_count")
+# Set on insert only: the funnel aggregates count existing leads under their city and niche
+INSERT_COLUMNS = ("city", "niche", "priority")
+
+AD_LINK_PATTERN = "|".join(re.escape(term) for term in AD_LINK_TERMS)
+HIGH_VALUE_PATTERN = "|".join(re.escape(kw) for kw in HIGH_VALUE_KEYWORDS)
+
+class ImportStats:
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.parked = 0
+        self.started = time.monotonic()
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    def as_dict(self) -> Dict:
+        seconds = self.seconds
+        return {"rows": self.rows, "inserted": self.inserted, "updated": self.updated,
+                "duplicates": self.duplicates, "invalid": self.invalid, "parked": self.parked,
+                "seconds": round(seconds, 3), "rows_per_sec": round(self.rows / seconds, 1) if seconds else 0.0}
+
+# --- Reading ---
+
+def iter_chunks(path: str, chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """DataFrames of at most `chunk_size` rows, all values as strings; never the whole file at once."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        yield from _iter_xlsx(path, chunk_size)
+    elif ext in (".csv", ".txt", ".tsv"):
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False,
+                               sep="\t" if ext == ".tsv" else ",", encoding_errors="replace")
+    else:
+        raise ValueError(f"Unsupported file type: {ext} (use CSV or XLSX)")
+
+def _cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))  # phone numbers stored as numbers
+    return str(value)
+
+def _iter_xlsx(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError as e:
+        raise RuntimeError("XLSX import needs openpyxl: pip install openpyxl") from e
+    workbook = load_workbook(path, read_only=True, data_only=True)  # streams rows
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_cell(h) for h in next(rows, ())]
+        batch: List[List[str]] = []
+        for row in rows:
+            batch.append([_cell(v) for v in row])
+            if len(batch) >= chunk_size:
+                yield pd.DataFrame(batch, columns=header)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=header)
+    finally:
+        workbook.close()
+
+def standardize(frame: pd.DataFrame) -> pd.DataFrame:
+    """Maps known header spellings onto lead fields; every field present, stripped, "" when missing."""
+    lookup = {alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases}
+    renamed = {}
+    for column in frame.columns:
+        key = re.sub(r"[\s\-]+", "_", str(column).strip().lower())
+        if key in lookup and lookup[key] not in renamed.values():
+            renamed[column] = lookup[key]
+    frame = frame[list(renamed)].rename(columns=renamed)
+    for field in COLUMN_ALIASES:
+        if field not in frame.columns:
+            frame[field] = ""
+    return frame[list(COLUMN_ALIASES)].fillna("").astype(str).apply(lambda col: col.str.strip())
+
+# --- Vectorized rules ---
+
+def normalize_phones(phones: pd.Series) -> pd.Series:
+    """utils.normalize_phone over a whole column."""
+    digits = phones.fillna("").astype(str).str.replace(r"\D", "", regex=True)
+    length = digits.str.len()
+    normalized = np.select(
+        [digits.str.startswith("0") & (length == 11), digits.str.startswith("234"), length == 10],
+        ["234" + digits.str[1:], digits, "234" + digits],
+        default=digits,
+    )
+    return pd.Series(normalized, index=phones.index).where(phones.fillna("").astype(str) != "N/A", "")
+
+def channel_columns(frame: pd.DataFrame) -> pd.Series:
+    """
+    channel_decision.decide_channels over a whole frame: "EMAIL+WHATSAPP"
+    with a real website, "WHATSAPP" with only a phone, "" otherwise.
+    """
+    website = frame["website"].str.strip()
+    has_website = (website != "") & ~website.str.contains(AD_LINK_PATTERN, regex=True)
+    phone = frame["normalized_phone"].where(frame["normalized_phone"] != "", frame["phone"]).str.strip()
+    has_phone = (phone != "") & (phone != "N/A")
+    return pd.Series(np.select([has_website, has_phone], ["EMAIL+WHATSAPP", "WHATSAPP"], default=""),
+                     index=frame.index)
+
+def synthetic_maps_urls(frame: pd.DataFrame) -> pd.Series:
+    """Stable placeholder key for rows without a Maps link, so re-importing the file upserts instead of duplicating."""
+    digest = pd.util.hash_pandas_object(frame[["name", "normalized_phone", "website"]], index=False)
+    return "import:" + digest.map("{:016x}".format)
+
+def parse_ratings(ratings: pd.Series) -> pd.Series:
+    """utils.parse_rating over a whole column."""
+    number = ratings.str.extract(r"(\d+(?:[.,]\d+)?)", expand=False).str.replace(",", ".")
+    return pd.to_numeric(number, errors="coerce").fillna(0.0).astype(float)
+
+def parse_review_counts(reviews: pd.Series) -> pd.Series:
+    """utils.parse_review_count over a whole column."""
+    digits = reviews.str.replace(r"\D", "", regex=True)
+    return pd.to_numeric(digits.where(digits != ""), errors="coerce").fillna(0).astype("int64")
+
+def priority_scores(frame: pd.DataFrame) -> pd.Series:
+    """utils.score_lead over a whole frame with rating_value/review_count already parsed."""
+    score = (frame["rating_value"].clip(upper=5.0) / 5.0 * 30
+             + np.minimum(np.log10(1 + frame["review_count"]) * 10, 30)
+             + (frame["website"] != "") * 10
+             + (frame["email"] != "") * 15
+             + frame["category"].str.lower().str.contains(HIGH_VALUE_PATTERN, regex=True) * 15)
+    return score.round(2)
+
+def classify_niches(categories: pd.Series) -> pd.Series:
+    """Classified once per distinct category; directories repeat a handful of them."""
+    from ai_agent import niche_classifier
+    mapping = {category: niche_classifier.classify(category) for category in categories.unique() if category}
+    return categories.map(mapping)
+
+# --- Writing ---
+
+def load_phone_index(db) -> Set[str]:
+    """Normalized phones of every existing lead, read in batches and normalized a column at a time."""
+    phones: Set[str] = set()
+    result = db.execute(select(Lead.phone_number).where(Lead.phone_number != None)
+                        .execution_options(yield_per=PHONE_SCAN_BATCH))
+    for batch in result.scalars().partitions():
+        phones.update(normalize_phones(pd.Series(batch, dtype=object)))
+    phones.discard("")
+    return phones
+
+def _upsert_statement(db):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f"Bulk import needs SQLite or Postgres, not {dialect}")
+    stmt = insert(Lead)
+    table = Lead.__table__
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.maps_url],
+        set_={**{col: func.coalesce(stmt.excluded[col], table.c[col]) for col in UPSERT_COLUMNS},
+              "updated_at": stmt.excluded.updated_at},
+    )
+
+def import_frame(db, frame: pd.DataFrame, phone_index: Set[str], stats: ImportStats):
+    """Normalizes, deduplicates and upserts one chunk in a single transaction."""
+    stats.rows += len(frame)
+    frame = standardize(frame)
+    valid = frame["name"] != ""
+    stats.invalid += int((~valid).sum())
+    frame = frame[valid].copy()
+    if frame.empty:
+        return
+
+    frame["normalized_phone"] = normalize_phones(frame["phone"])
+    frame["channels"] = channel_columns(frame)
+    frame["maps_url"] = frame["maps_url"].where(frame["maps_url"] != "", synthetic_maps_urls(frame))
+
+    # Within the chunk: one row per maps_url, then per phone
+    before = len(frame)
+    frame = frame.drop_duplicates("maps_url")
+    has_phone = frame["normalized_phone"] != ""
+    frame = frame[~has_phone | ~frame["normalized_phone"].duplicated()]
+    stats.duplicates += before - len(frame)
+
+    existing = set(db.execute(select(Lead.maps_url).where(Lead.maps_url.in_(frame["maps_url"].tolist())))
+                   .scalars())
+    is_existing = frame["maps_url"].isin(existing)
+    # A new maps_url with a phone we already have is the same business listed again
+    # (set lookups per row: isin() would copy the whole index on every chunk)
+    phone_taken = ~is_existing & frame["normalized_phone"].map(phone_index.__contains__).astype(bool)
+    stats.duplicates += int(phone_taken.sum())
+    frame = frame[~phone_taken]
+    is_existing = is_existing[~phone_taken]
+    if frame.empty:
+        return
+
+    now = datetime.utcnow()
+    frame["niche"] = classify_niches(frame["category"])
+    frame["rating_value"] = parse_ratings(frame["rating"])
+    frame["review_count"] = parse_review_counts(frame["reviews"])
+    # Set on insert only: an existing lead's score also counts what enrichment found since
+    frame["priority"] = priority_scores(frame)
+    viable = frame["channels"] != ""
+    rows = frame.rename(columns=LEAD_COLUMNS)[["maps_url", *UPSERT_COLUMNS, *INSERT_COLUMNS]]
+    rows = rows.replace("", None)
+    rows = rows.astype(object).where(rows.notna(), None)  # NaN -> None, not a float in a text column
+    records = rows.to_dict("records")
+    for record, park in zip(records, viable.tolist()):
+        # New viable leads wait for admission like surplus scraped ones; existing ones keep their state
+        record.update(state="DISCOVERED", parked_at=now if park else None, follow_up_count=0,
+                      created_at=now, updated_at=now)
+    db.execute(_upsert_statement(db), records)
+    # So scraped listings of these businesses are merged into them later
+    index_leads(db, [record for record, known in zip(records, is_existing.tolist()) if not known])
+
+    new = frame[~is_existing]
+    record_transitions(db, [(None, "DISCOVERED", niche if isinstance(niche, str) else None, city or None, now, None)
+                            for niche, city in zip(new["niche"], new["city"])])
+    db.commit()
+
+    phone_index.update(p for p in frame["normalized_phone"] if p)
+    stats.inserted += len(new)
+    stats.updated += int(is_existing.sum())
+    stats.parked += int((viable & ~is_existing).sum())
+
+def import_leads(db, path: str, chunk_size: int = IMPORT_CHUNK_SIZE,
+                 phone_index: Optional[Set[str]] = None) -> ImportStats:
+    """
+    Streams a CSV/XLSX lead list into the database. Viable new leads are
+    parked, so admission feeds them to enrichment and drafting at the
+    pace quota and Telegram budget allow.
+    """
+    stats = ImportStats()
+    if phone_index is None:
+        phone_index = load_phone_index(db)
+    for chunk in iter_chunks(path, chunk_size):
+        import_frame(db, chunk, phone_index, stats)
+        logger.info(f"Imported {stats.rows} rows from {os.path.basename(path)} "
+                    f"({stats.as_dict()['rows_per_sec']} rows/s)")
+    return stats
+
+if __name__ == "__main__":
+    from database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Bulk-import leads from CSV or XLSX lists.")
+    parser.add_argument("files", nargs="+", help="CSV or XLSX files with a header row")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    init_db()
+    db = SessionLocal()
+    try:
+        phone_index = load_phone_index(db)
+        for path in args.files:
+            s = import_leads(db, path, args.chunk_size, phone_index).as_dict()
+            print(f"{path}: {s['rows']} rows in {s['seconds']}s ({s['rows_per_sec']} rows/s) -- "
+                  f"{s['inserted']} new ({s['parked']} queued for outreach), {s['updated']} updated, "
+                  f"{s['duplicates']} duplicates, {s['invalid']} without a name")
+    finally:
+        db.close()
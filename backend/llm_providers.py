@@ -0,0 +1,182 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+from ratelimit import limits, sleep_and_retry
+
+logger = logging.getLogger(__name__)
+
+GEMINI_CALLS_PER_MINUTE = 5
+ONE_MINUTE = 60
+
+# Routing health configuration
+LATENCY_WINDOW = 50        # calls kept per provider for p50/p95/error rate
+MIN_SAMPLES = 4            # below this a provider is always considered healthy
+MAX_ERROR_RATE = 0.5
+UNHEALTHY_COOLDOWN = 5 * 60  # seconds an unhealthy provider sits out
+
+class LLMProvider:
+    """
+    One model endpoint the drafting code can send a prompt to.
+
+    `quota_key` names the provider's row in the quota ledger and
+    `daily_limit` caps it; a limit of None means the provider is unmetered
+    (local server, stub).
+    """
+    def __init__(self, name: str, model: str, quota_key: Optional[str] = None,
+                 daily_limit: Optional[int] = None):
+        self.name = name
+        self.model = model
+        self.quota_key = quota_key or name
+        self.daily_limit = daily_limit
+
+    def complete(self, prompt: str) -> Tuple[str, int]:
+        """Returns (response text, total tokens). Raises on any API error."""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"<{type(self).__name__}(name='{self.name}', model='{self.model}')>"
+
+@sleep_and_retry
+@limits(calls=GEMINI_CALLS_PER_MINUTE, period=ONE_MINUTE)
+def _gemini_generate(client, model: str, prompt: str):
+    # Shared across keys: the free tier limit is per project, not per key
+    return client.models.generate_content(model=model, contents=prompt)
+
+class GeminiProvider(LLMProvider):
+    def __init__(self, api_key: str, model: str, quota_key: str, daily_limit: Optional[int]):
+        super().__init__(f"gemini-{quota_key}", model, quota_key, daily_limit)
+        self.api_key = api_key
+        self._client = None
+
+    def complete(self, prompt: str) -> Tuple[str, int]:
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=self.api_key)
+        response = _gemini_generate(self._client, self.model, prompt)
+        usage = getattr(response, "usage_metadata", None)
+        return response.text, (getattr(usage, "total_token_count", 0) or 0) if usage else 0
+
+class OpenAICompatibleProvider(LLMProvider):
+    """OpenAI, or any server speaking its chat completions API (vLLM, Ollama, llama.cpp)."""
+
+    def __init__(self, name: str, model: str, api_key: str, base_url: Optional[str] = None,
+                 daily_limit: Optional[int] = None, timeout: float = 60):
+        super().__init__(name, model, f"openai:{name}", daily_limit)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+
+    def complete(self, prompt: str) -> Tuple[str, int]:
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=self.api_key, base_url=self.base_url, timeout=self.timeout)
+        response = self._client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        usage = getattr(response, "usage", None)
+        return response.choices[0].message.content or "", (getattr(usage, "total_tokens", 0) or 0) if usage else 0
+
+class StubProvider(LLMProvider):
+    """
+    Deterministic offline provider for load tests and local runs.
+    The same prompt always yields the same draft; `latency` simulates a slow model.
+    """
+
+    def __init__(self, name: str = "stub", latency: float = 0.0):
+        super().__init__(name, "stub", f"stub:{name}", None)
+        self.latency = latency
+
+    def complete(self, prompt: str) -> Tuple[str, int]:
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        payload = {
+            "subject": f"Quick question ({digest})",
+            "message": f"Hi! This is a stub draft {digest} for offline testing.",
+        }
+        return json.dumps(payload), len(prompt) // 4
+
+class ProviderStats:
+    """Rolling latency and error window for one provider."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)  # (latency_seconds, ok)
+        self.last_failure_at = 0.0
+
+    def record(self, latency: float, ok: bool):
+        self.samples.append((latency, ok))
+        if not ok:
+            self.last_failure_at = time.monotonic()
+
+    def _percentile(self, pct: float) -> Optional[float]:
+        latencies = sorted(lat for lat, ok in self.samples if ok)
+        if not latencies:
+            return None
+        idx = min(len(latencies) - 1, int(round(pct / 100 * (len(latencies) - 1))))
+        return latencies[idx]
+
+    @property
+    def p50(self) -> Optional[float]:
+        return self._percentile(50)
+
+    @property
+    def p95(self) -> Optional[float]:
+        return self._percentile(95)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+    def is_healthy(self) -> bool:
+        if len(self.samples) < MIN_SAMPLES or self.error_rate < MAX_ERROR_RATE:
+            return True
+        # Let it back in after a cooldown so it can prove itself again
+        return time.monotonic() - self.last_failure_at > UNHEALTHY_COOLDOWN
+
+class ProviderRouter:
+    """
+    Orders providers for each generation: healthy ones with quota first,
+    fastest p50 first. Providers without samples yet sort first so they
+    get measured. Unhealthy providers are tried last rather than never.
+    """
+
+    def __init__(self, providers: List[LLMProvider], has_quota: Callable[[LLMProvider], bool]):
+        self.providers = list(providers)
+        self.has_quota = has_quota
+        self._stats: Dict[str, ProviderStats] = {p.name: ProviderStats() for p in self.providers}
+        self._lock = threading.Lock()
+
+    def candidates(self) -> List[LLMProvider]:
+        with self._lock:
+            available = [p for p in self.providers if self.has_quota(p)]
+            healthy = [p for p in available if self._stats[p.name].is_healthy()]
+            unhealthy = [p for p in available if p not in healthy]
+            by_latency = lambda p: self._stats[p.name].p50 or 0.0
+            return sorted(healthy, key=by_latency) + sorted(unhealthy, key=by_latency)
+
+    def record(self, provider: LLMProvider, latency: float, ok: bool):
+        with self._lock:
+            self._stats.setdefault(provider.name, ProviderStats()).record(latency, ok)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per-provider p50/p95 latency (seconds), error rate and health."""
+        with self._lock:
+            return {
+                p.name: {
+                    "model": p.model,
+                    "samples": len(self._stats[p.name].samples),
+                    "p50": self._stats[p.name].p50,
+                    "p95": self._stats[p.name].p95,
+                    "error_rate": self._stats[p.name].error_rate,
+                    "healthy": self._stats[p.name].is_healthy(),
+                }
+                for p in self.providers
+            }
@@ -3,14 +3,25 @@ import os
 import logging
 import time
 from datetime import datetime, timedelta
+from typing import Dict, List
 from sqlalchemy import and_, or_
 from database import init_db, SessionLocal, save_lead
 from models import Lead
 from scraper import scrape_google_maps
 from enrichment import enrich_lead_with_email
 from channel_decision import decide_channels
-from ai_agent import generate_message
-from telegram_queue import process_telegram_queue
+from ai_agent import generate_message, niche_classifier
+from telegram_queue import process_telegram_queue, run_outbox_worker
+from http_client import close_session
+from metrics import run_snapshot_writer
+import tracing
+from telegram_render import render_lead
+from generation_queue import process_generation_queue, PENDING_STATE
+from pipeline import Pipeline, Stage
+from admission import AdmissionController, parked_leads
+from query_leases import WORKER_ID, HEARTBEAT_INTERVAL, sync_queries, claim_query, renew_leases, release_query
+from entities import EntityResolver
+from checkpoints import start_run, checkpoint_lead, clear_lead, is_checkpointed, mark_query_done, finish_run, SCRAPED, ENRICHED
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -21,124 +32,269 @@ POLLING_INTERVAL = 10 * 60  # 10 minutes between search cycles
 SCRAPER_DELAY = 2  # seconds between scraper calls
 ENRICHMENT_DELAY = 3  # seconds between enrichment calls
 
-async def run_pipeline_cycle(db, processed_leads_cache):
-    """Runs a single cycle of scraping, enrichment, and drafting."""
-    # 1. Stop early if queue is already full/large to prevent spam
-    queue_count = db.query(Lead).filter(Lead.state == 'QUEUED').count()
-    draft_count = db.query(Lead).filter(Lead.state == 'DRAFTED').count()
-    if (queue_count + draft_count) >= 30: # 2 days worth of budget
-        logger.info(f"Queue is currently at {queue_count+draft_count} leads. Skipping discovery cycle to prevent backlog.")
-        return 0, 0
+# Pipeline stage configuration
+DISCOVER_CONCURRENCY = 1  # one Maps browser at a time
+ENRICH_CONCURRENCY = 2    # website crawls run alongside the next scrape
+STAGE_QUEUE_SIZE = 20     # leads buffered between stages before upstream waits
+# Several discovery workers (processes or hosts) can share search.txt via query leases
+DISCOVERY_SHARDING = os.getenv("DISCOVERY_SHARDING", "0") == "1"
 
-    # 2. Read queries from search.txt
-    search_file = os.path.join(os.path.dirname(__file__), "search.txt")
-    if not os.path.exists(search_file):
-        logger.error(f"search.txt not found at {search_file}")
-        return 0, 0
+def split_query(query: str):
+    """"dentist in Wuse" -> ("dentist", "Wuse"); no location defaults to Abuja."""
+    if " in " in query:
+        business_type, location = query.split(" in ", 1)
+        return business_type, location
+    return query, "Abuja"
 
-    with open(search_file, "r") as f:
-        queries = [line.strip() for line in f if line.strip()]
+class DiscoveryCycle:
+    """
+    One discovery cycle as a staged pipeline:
+    discover -> enrich -> decide -> persist -> draft -> deliver.
+
+    Each stage has its own concurrency and a bounded inbox, so e.g. two
+    enrichment browsers run while the next query is scraped, and a slow
+    drafting stage holds scraping back instead of piling up leads.
+    Drafting comes after persist: leads are saved PENDING_DRAFT and the
+    value-ranked generation queue decides which ones get LLM quota.
 
-    total_leads_processed = 0
-    total_messages_generated = 0
+    Progress is checkpointed in the DB (finished queries, and each unsaved
+    lead with its enrichment results) so a restart resumes the cycle.
+    """
+
+    def __init__(self, processed_leads_cache: set, admission: AdmissionController,
+                 sharded: bool = DISCOVERY_SHARDING, owner: str = WORKER_ID):
+        self.seen = processed_leads_cache
+        self.admission = admission
+        # Sharded: queries are leased from search_queries so several workers can share search.txt
+        self.sharded = sharded
+        self.owner = owner
+        self.run_record = None  # DiscoveryRun holding this cycle's checkpoints
+        self.db = SessionLocal()  # discover + persist; drafting/delivery open their own
+        self.resolver = EntityResolver(self.db)
+        self.leads_processed = 0
+        self.messages_generated = 0
+        self.pipeline = Pipeline([
+            # Sharded workers claim a query only when they can start on it, not 20 ahead
+            Stage("discover", self.discover, concurrency=DISCOVER_CONCURRENCY,
+                  queue_size=1 if sharded else STAGE_QUEUE_SIZE),
+            Stage("enrich", self.enrich, concurrency=ENRICH_CONCURRENCY, queue_size=STAGE_QUEUE_SIZE),
+            Stage("decide", self.decide, queue_size=STAGE_QUEUE_SIZE),
+            Stage("persist", self.persist, queue_size=STAGE_QUEUE_SIZE),
+            Stage("draft", self.draft, queue_size=STAGE_QUEUE_SIZE, batch_size=STAGE_QUEUE_SIZE),
+            Stage("deliver", self.deliver, queue_size=STAGE_QUEUE_SIZE, batch_size=STAGE_QUEUE_SIZE),
+        ])
+
+    async def run(self, queries: List[str]):
+        """
+        Resumes the last run if it was interrupted (skipping finished queries
+        and picking leads up at their checkpointed stage), else starts a new one.
+        """
+        try:
+            all_queries = queries
+            self.run_record, queries, resumed = start_run(self.db, queries, owner=self.owner)
+            self.seen.update(lead_data['maps_url'] for lead_data in resumed)
+            leads = []
+            for lead_data in resumed:
+                # Already scraped, so no browser cost left to save -- but drafting still needs a slot
+                if self.admission.admit():
+                    leads.append(lead_data)
+                else:
+                    clear_lead(self.db, self.run_record.id, lead_data['maps_url'])
+                    self.park(lead_data)
+            # Parked leads were found before anything scraped now, so they go first
+            leads += parked_leads(self.db, self.admission.capacity - self.admission.admitted)
+            for _ in leads[len(resumed):]:
+                self.admission.admit()
+            if self.sharded:
+                sync_queries(self.db, all_queries)
+                await self.run_sharded(leads)
+            else:
+                await self.pipeline.run(leads + queries)
+            finish_run(self.db, self.run_record)
+        finally:
+            self.db.close()
+        return self.leads_processed, self.messages_generated
+
+    async def run_sharded(self, leads: List[Dict]):
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            await self.pipeline.run(self.claimed_items(leads))
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def claimed_items(self, leads: List[Dict]):
+        for lead_data in leads:
+            yield lead_data
+        while not self.admission.exhausted:
+            query = claim_query(self.db, owner=self.owner)
+            if query is None:
+                logger.info("No more due queries to claim this cycle")
+                return
+            yield query
 
-    for query in queries:
+    async def heartbeat(self):
+        """Keeps this worker's leases alive while it scrapes."""
+        db = SessionLocal()
+        try:
+            while True:
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+                renew_leases(db, owner=self.owner)
+        finally:
+            db.close()
+
+    def park(self, lead_data: Dict):
+        """Saves a lead without enrichment or drafting, for a later window."""
+        lead_data.pop('checkpoint_stage', None)
+        lead_data['state'] = 'DISCOVERED'
+        lead_data['parked_at'] = datetime.utcnow()
+        save_lead(self.db, lead_data)
+        self.leads_processed += 1
+
+    async def discover(self, item, emit):
+        if isinstance(item, dict):
+            # Resumed from a checkpoint or parked in an earlier window; its slot was claimed up front
+            if 'checkpoint_stage' not in item:
+                item['parked_at'] = None
+                logger.info(f"Readmitting parked lead: {item['name']}")
+                checkpoint_lead(self.db, self.run_record.id, item, SCRAPED)
+            await emit(item)
+            return
+        if not self.sharded:
+            await self.scrape_query(item, emit)
+            return
+        done = False
+        try:
+            done = await self.scrape_query(item, emit)
+        finally:
+            # Not done (skipped, failed or cancelled): free the lease for any worker
+            release_query(self.db, item, owner=self.owner, done=done)
+
+    async def scrape_query(self, query: str, emit) -> bool:
+        """Scrapes one search query and admits or parks what it finds. False if skipped."""
+        if self.admission.exhausted:
+            logger.info(f"Admission capacity used up; skipping query '{query}' this cycle")
+            return False
         logger.info(f"--- Processing Query: {query} ---")
-        
-        # Determine location from query (heuristic)
-        if " in " in query:
-            parts = query.split(" in ")
-            business_type = parts[0]
-            location = parts[1]
-        else:
-            business_type = query
-            location = "Abuja"
-
-        # 3. Scrape with rate limiting
+        business_type, location = split_query(query)
         logger.info(f"Scraping: {business_type} in {location}")
         try:
             # Only ask for a few leads per query to keep diversity high
             leads = await scrape_google_maps(business_type, location, max_results=10)
         except Exception as e:
             logger.error(f"Scraper error: {e}")
-            continue
-        
+            leads = []
         logger.info(f"Found {len(leads)} leads for '{query}'")
-        
+
+        parked = 0
         for lead_data in leads:
-            # Check unique URL in DB
             maps_url = lead_data.get('maps_url')
-            db_lead = db.query(Lead).filter(Lead.maps_url == maps_url).first()
-            if db_lead:
-                # Already exists, skip
+            # Also skip leads another query found earlier this cycle but hasn't saved yet
+            if maps_url in self.seen or self.db.query(Lead.id).filter(Lead.maps_url == maps_url).first():
                 continue
-
-            logger.info(f"New business discovered: {lead_data['name']}")
+            # A worker that died mid-query resumes its checkpointed leads itself
+            if is_checkpointed(self.db, maps_url):
+                continue
+            self.seen.add(maps_url)
             lead_data['city'] = location
-            
-            # 4. Enrich if website exists
-            if lead_data.get('website'):
-                logger.info(f"Enriching {lead_data['name']} via {lead_data['website']}...")
+            # The same business listed under another query: merge it before any browser or LLM work
+            if self.resolver.resolve(lead_data):
+                continue
+            logger.info(f"New business discovered: {lead_data['name']}")
+            lead_data['query'] = query
+            lead_data['niche'] = niche_classifier.classify(lead_data.get('category'), query)
+            if self.admission.admit():
+                checkpoint_lead(self.db, self.run_record.id, lead_data, SCRAPED)
+                await emit(lead_data)
+            else:
+                # Downstream can't take it yet
+                self.park(lead_data)
+                parked += 1
+        if parked:
+            logger.info(f"Parked {parked} leads from '{query}' for a later window")
+        mark_query_done(self.db, self.run_record, query)
+        await asyncio.sleep(SCRAPER_DELAY)
+        return True
+
+    async def enrich(self, lead_data: Dict, emit):
+        if lead_data.pop('checkpoint_stage', None) == ENRICHED:
+            await emit(lead_data)  # enriched before a restart; don't crawl the site again
+            return
+        lead_data['state'] = 'DISCOVERED'
+        if lead_data.get('website'):
+            logger.info(f"Enriching {lead_data['name']} via {lead_data['website']}...")
+            with tracing.span("enrich.pacing", key=lead_data['maps_url']):
                 await asyncio.sleep(ENRICHMENT_DELAY)
-                try:
+            try:
+                # The crawler only sees the website; its page spans attach to this lead via context
+                with tracing.span("enrich", key=lead_data['maps_url'], website=lead_data['website']):
                     emails = await enrich_lead_with_email(lead_data['website'])
-                    if emails:
-                        lead_data['email'] = ", ".join(emails)
-                        lead_data['state'] = 'ENRICHED'
-                    else:
-                        lead_data['state'] = 'DISCOVERED'
-                except Exception:
-                    lead_data['state'] = 'DISCOVERED'
-            else:
-                lead_data['state'] = 'DISCOVERED'
+                if emails:
+                    lead_data['email'] = ", ".join(emails)
+                    lead_data['state'] = 'ENRICHED'
+            except Exception as e:
+                logger.warning(f"Enrichment failed for {lead_data['name']}: {e}")
+        checkpoint_lead(self.db, self.run_record.id, lead_data, ENRICHED)
+        await emit(lead_data)
 
-            # 5. Channel Decision
-            channels = decide_channels(lead_data)
-            if not channels:
-                save_lead(db, lead_data)
-                total_leads_processed += 1
-                continue
-            
-            # 6. AI Message Generation
-            all_generated = True
-            for channel in channels:
-                logger.info(f"Generating {channel} message for {lead_data['name']}...")
-                message_result = generate_message(lead_data, channel=channel)
-                
-                if message_result:
-                    if channel == "EMAIL":
-                        lead_data['email_subject'] = message_result.get('subject')
-                        lead_data['email_draft'] = message_result.get('message')
-                    elif channel == "WHATSAPP":
-                        lead_data['whatsapp_draft'] = message_result.get('message')
-                    total_messages_generated += 1
-                else:
-                    logger.warning(f"AI Failed for {lead_data['name']} on {channel}")
-                    all_generated = False
-                    break # Stop if one channel fails
-            
-            # Update lead data state
-            if all_generated:
-                lead_data['primary_channel'] = channels[0]
-                lead_data['state'] = 'DRAFTED'
-            else:
-                # If AI fails, mark for human review instead of generic template
-                lead_data['state'] = 'NEEDS_REVIEW'
-
-            # 7. Store in DB
-            save_lead(db, lead_data)
-            total_leads_processed += 1
-            logger.info(f"Processed and saved: {lead_data['name']} (State: {lead_data['state']})")
-        
-        # 8. Check Telegram queue after EACH query for real-time delivery
-        logger.info(f"Checking Telegram queue after query: {query}")
-        queued = await process_telegram_queue(db)
+    async def decide(self, lead_data: Dict, emit):
+        if decide_channels(lead_data):
+            # Drafting is done by the value-ranked generation queue
+            lead_data['state'] = PENDING_STATE
+        await emit(lead_data)
+
+    async def persist(self, lead_data: Dict, emit):
+        clear_lead(self.db, self.run_record.id, lead_data['maps_url'])
+        save_lead(self.db, lead_data)  # commits the checkpoint removal with the lead
+        self.leads_processed += 1
+        logger.info(f"Processed and saved: {lead_data['name']} (State: {lead_data['state']})")
+        if lead_data['state'] == PENDING_STATE:
+            await emit(lead_data['maps_url'])
+
+    async def draft(self, maps_urls: List[str], emit):
+        # One ranked pass covers every lead saved since the last one. LLM
+        # calls block, so the pass runs in a thread with its own session.
+        drafted, messages = await asyncio.to_thread(_run_generation_queue)
+        self.messages_generated += messages
+        if drafted > 0:
+            logger.info(f"Drafted {drafted} leads from the generation queue.")
+            await emit(drafted)
+
+    async def deliver(self, drafted: List[int], emit):
+        # Enqueue drafts as soon as they exist; the outbox worker delivers them
+        db = SessionLocal()
+        try:
+            queued = await process_telegram_queue(db)
+        finally:
+            db.close()
         if queued > 0:
             logger.info(f"Real-time delivery: Queued {queued} leads to Telegram.")
-        
-        await asyncio.sleep(SCRAPER_DELAY)
 
-    return total_leads_processed, total_messages_generated
+def _run_generation_queue():
+    db = SessionLocal()
+    try:
+        return process_generation_queue(db)
+    finally:
+        db.close()
+
+async def run_pipeline_cycle(db, processed_leads_cache):
+    """Runs a single cycle of scraping, enrichment, and drafting."""
+    # 1. Only discover as many leads as drafting and delivery can absorb
+    admission = AdmissionController.from_db(db)
+    if admission.capacity <= 0:
+        logger.info("No downstream capacity (LLM quota, Telegram budget or backlog). Skipping discovery cycle.")
+        return 0, 0
+
+    # 2. Read queries from search.txt
+    search_file = os.path.join(os.path.dirname(__file__), "search.txt")
+    if not os.path.exists(search_file):
+        logger.error(f"search.txt not found at {search_file}")
+        return 0, 0
+
+    with open(search_file, "r") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    return await DiscoveryCycle(processed_leads_cache, admission).run(queries)
 
 async def maintain_lead_states(db):
     """Maintains lead states and transitions them based on time."""
@@ -176,8 +332,10 @@ async def maintain_lead_states(db):
         lead_data = {
             "name": lead.business_name,
             "category": lead.category,
-            "city": "Abuja",
-            "follow_up_channel": lead.primary_channel or "WHATSAPP"
+            "niche": lead.niche,
+            "city": lead.city or "Abuja",
+            "follow_up_channel": lead.primary_channel or "WHATSAPP",
+            "follow_up_number": int(lead.follow_up_count or 0) + 1,
         }
         draft = generate_message(lead_data, channel="FOLLOW_UP")
         if draft:
@@ -190,6 +348,7 @@ async def maintain_lead_states(db):
             lead.state = 'DRAFTED' # Move back to drafted so it hits the Telegram queue
             lead.is_queued = False # Allow re-queueing
             lead.follow_up_count += 1
+            render_lead(lead)
             logger.info(f"Follow-up draft created for {lead.business_name}")
 
     db.commit()
@@ -207,37 +366,47 @@ async def main():
     logger.info(f"Loaded {len(processed_leads_cache)} leads from cache.")
     logger.info(f"Bot starting... Polling every {POLLING_INTERVAL/60} minutes.")
 
-    while True:
-        cycle_start = time.time()
-        logger.info("\n=== Starting Discovery Cycle ===")
-        
-        db = SessionLocal()
-        try:
-            # Maintain states first
-            await maintain_lead_states(db)
+    # Delivery runs on its own so it never waits for a slow scrape
+    outbox_worker = asyncio.create_task(run_outbox_worker())
+    # This process has no HTTP server; the Action API serves its metrics from snapshots
+    metrics_writer = asyncio.create_task(run_snapshot_writer(f"discovery-{WORKER_ID}"))
 
-            # Discovery Phase
-            processed, messages = await run_pipeline_cycle(db, processed_leads_cache)
-            logger.info(f"Cycle finished. Processed {processed} leads, generated {messages} messages.")
-            
-            # Queue Phase (Send to Telegram within budget)
-            logger.info("Checking Telegram queue...")
-            queued = await process_telegram_queue(db)
-            if queued > 0:
-                logger.info(f"Queued {queued} leads to Telegram.")
+    try:
+        while True:
+            cycle_start = time.time()
+            logger.info("\n=== Starting Discovery Cycle ===")
             
-        except Exception as e:
-            logger.error(f"Error in main loop: {e}")
-        finally:
-            db.close()
+            db = SessionLocal()
+            try:
+                # Maintain states first
+                await maintain_lead_states(db)
 
-        # Calculate sleep time
-        elapsed = time.time() - cycle_start
-        sleep_time = max(0, POLLING_INTERVAL - elapsed)
-        
-        if sleep_time > 0:
-            logger.info(f"Sleeping for {sleep_time/60:.1f} minutes until next cycle...")
-            await asyncio.sleep(sleep_time)
+                # Discovery Phase
+                processed, messages = await run_pipeline_cycle(db, processed_leads_cache)
+                logger.info(f"Cycle finished. Processed {processed} leads, generated {messages} messages.")
+                
+                # Queue Phase (move drafts into the Telegram outbox within budget)
+                logger.info("Checking Telegram queue...")
+                queued = await process_telegram_queue(db)
+                if queued > 0:
+                    logger.info(f"Queued {queued} leads to Telegram.")
+                
+            except Exception as e:
+                logger.error(f"Error in main loop: {e}")
+            finally:
+                db.close()
+
+            # Calculate sleep time
+            elapsed = time.time() - cycle_start
+            sleep_time = max(0, POLLING_INTERVAL - elapsed)
+            
+            if sleep_time > 0:
+                logger.info(f"Sleeping for {sleep_time/60:.1f} minutes until next cycle...")
+                await asyncio.sleep(sleep_time)
+    finally:
+        outbox_worker.cancel()
+        metrics_writer.cancel()
+        await close_session()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "metrics")
+SNAPSHOT_INTERVAL = 15      # seconds between snapshot writes from background processes
+SNAPSHOT_MAX_AGE = 5 * 60   # snapshots older than this belong to a stopped process
+
+# Seconds; wide enough for both a DB commit and a full Maps scrape
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Dict, float]]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Monotonic count, e.g. Telegram 429s."""
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + "_total", dict(zip(self.labelnames, k)), v) for k, v in self._values.items()]
+
+class Gauge(_Metric):
+    """Current value; either set() by the code or read from a callback at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+        self._callback: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, callback: Callable[[], float]):
+        """Evaluated only when metrics are collected, so it costs nothing on hot paths."""
+        self._callback = callback
+
+    def value(self, **labels) -> Optional[float]:
+        return self._values.get(self._key(labels))
+
+    def samples(self):
+        if self._callback is not None:
+            try:
+                return [(self.name, {}, float(self._callback()))]
+            except Exception as e:
+                logger.debug(f"Gauge {self.name} callback failed: {e}")
+                return []
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, k)), v) for k, v in self._values.items()]
+
+class Histogram(_Metric):
+    """Latency distribution in cumulative buckets, Prometheus style."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Tuple, List[int]] = {}  # per-bucket (non-cumulative), last slot is +Inf
+        self._sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, func):
+        """Decorator for coroutine functions; records each call's duration."""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with self.time():
+                return await func(*args, **kwargs)
+        return wrapper
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), []))
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    out.append((self.name + "_bucket", {**labels, "le": le}, cumulative))
+                out.append((self.name + "_sum", labels, self._sums[key]))
+                out.append((self.name + "_count", labels, cumulative))
+        return out
+
+class Registry:
+    """Named metrics for one process; get-or-create so modules can declare the same metric."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def collect(self) -> List[Dict]:
+        """Plain-data view of every metric, as written to snapshots."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [{"name": m.name, "kind": m.kind, "help": m.help, "samples": m.samples()} for m in metrics]
+
+REGISTRY = Registry()
+
+def _format_labels(labels: Dict) -> str:
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def render(families: List[Tuple[Dict, Dict]]) -> str:
+    """
+    Prometheus text format (0.0.4). `families` is a list of (collected
+    metric, extra labels); metrics sharing a name are grouped under one
+    HELP/TYPE header, e.g. the same counter from several processes.
+    """
+    grouped: Dict[str, List[Tuple[Dict, Dict]]] = {}
+    for metric, extra in families:
+        grouped.setdefault(metric["name"], []).append((metric, extra))
+    lines = []
+    for name, entries in grouped.items():
+        lines.append(f"# HELP {name} {entries[0][0]['help']}")
+        lines.append(f"# TYPE {name} {entries[0][0]['kind']}")
+        for metric, extra in entries:
+            for sample_name, labels, value in metric["samples"]:
+                lines.append(f"{sample_name}{_format_labels({**extra, **labels})} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+def write_snapshot(process: str, registry: Registry = REGISTRY, directory: Optional[str] = None):
+    """Publishes this process's metrics for the API process to serve (atomic replace)."""
+    directory = directory or SNAPSHOT_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{process}.json")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"process": process, "written_at": time.time(), "metrics": registry.collect()}, f)
+    os.replace(tmp, path)
+
+def render_all(process: str, registry: Registry = REGISTRY, directory: Optional[str] = None) -> str:
+    """This process's live metrics plus fresh snapshots from the others, each tagged with `process`."""
+    directory = directory or SNAPSHOT_DIR
+    families = [(metric, {"process": process}) for metric in registry.collect()]
+    if os.path.isdir(directory):
+        now = time.time()
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".json") or filename == f"{process}.json":
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if now - snapshot.get("written_at", 0) > SNAPSHOT_MAX_AGE:
+                continue
+            families += [(metric, {"process": snapshot["process"]}) for metric in snapshot["metrics"]]
+    return render(families)
+
+async def run_snapshot_writer(process: str, interval: float = SNAPSHOT_INTERVAL):
+    """Background task for processes without an HTTP server (the discovery loop)."""
+    while True:
+        try:
+            write_snapshot(process)
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot: {e}")
+        await asyncio.sleep(interval)
@@ -1,6 +1,6 @@
 from datetime import datetime
 import uuid
-from sqlalchemy import Column, String, DateTime, Text, Float, Boolean
+from sqlalchemy import Column, String, DateTime, Text, Float, Boolean, Integer, ForeignKey, Index, UniqueConstraint, desc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import UUID
 
@@ -15,28 +15,161 @@ class Lead(Base):
     business_name = Column(String(255), nullable=False)
     category = Column(String(255))
     phone_number = Column(String(50))
+    normalized_phone = Column(String(20), index=True)  # 234XXXXXXXXXX, see utils.normalize_phone
     email = Column(String(255))
     website_url = Column(Text)
-    rating = Column(String(10))
-    reviews = Column(String(10))
+    rating = Column(String(10))   # as shown on Maps, e.g. "4,7"
+    reviews = Column(String(10))  # e.g. "(1,203)"
+    rating_value = Column(Float)     # parsed from rating/reviews on every write (see database.py)
+    review_count = Column(Integer)
+    priority = Column(Float, default=0)  # utils.score_lead; drafting and delivery go highest first
+    niche = Column(String(50))  # key in config/niches.json, None if unmatched
+    city = Column(String(100))
     
     # Channel and messaging
     primary_channel = Column(String(20))
     email_draft = Column(Text)
     email_subject = Column(String(255))
     whatsapp_draft = Column(Text)
+    telegram_payload = Column(Text)  # JSON list of pre-rendered {"kind", "text", "reply_markup"}
     
     # State tracking
-    state = Column(String(50), default='DISCOVERED')  # DISCOVERED, ENRICHED, DRAFTED, QUEUED, SENT, WAITING, NO_REPLY, FOLLOW_UP_ELIGIBLE, REPLIED, CLOSED, NEEDS_REVIEW
+    state = Column(String(50), default='DISCOVERED')  # DISCOVERED, ENRICHED, PENDING_DRAFT, DRAFTED, QUEUED, SENT, WAITING, NO_REPLY, FOLLOW_UP_ELIGIBLE, REPLIED, CLOSED, NEEDS_REVIEW
     is_queued = Column(Boolean, default=False)
     queued_at = Column(DateTime)
     sent_at = Column(DateTime)
     last_interaction_at = Column(DateTime)
-    follow_up_count = Column(Float, default=0) # Using float just in case but int is fine
+    parked_at = Column(DateTime)  # scraped while downstream was full; enrich/draft in a later window
+    follow_up_count = Column(Integer, default=0)
     
     # Metadata
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        Index('ix_leads_created_id', 'created_at', 'id'),  # keyset pagination for exports
+        # Best drafts/pending/parked leads first without sorting the table; created_at breaks ties
+        Index('ix_leads_state_priority', 'state', desc('priority'), 'created_at'),
+    )
+
     def __repr__(self):
         return f"<Lead(name='{self.business_name}', state='{self.state}', channel='{self.primary_channel}')>"
+
+class OutboxMessage(Base):
+    """One Telegram message waiting to be (or already) delivered for a lead."""
+    __tablename__ = 'telegram_outbox'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    lead_id = Column(String(36), ForeignKey('leads.id'), nullable=False, index=True)
+    kind = Column(String(20), nullable=False)  # EMAIL, WHATSAPP, DIGEST
+    # lead_id:kind:follow_up_count -- the same draft is never enqueued twice
+    idempotency_key = Column(String(100), unique=True, nullable=False)
+    payload = Column(Text, nullable=False)  # JSON: {"text": ..., "reply_markup": ...}
+
+    status = Column(String(20), default='PENDING', index=True)  # PENDING, SENT, FAILED
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"<OutboxMessage(lead='{self.lead_id}', kind='{self.kind}', status='{self.status}')>"
+
+class TelegramDigest(Base):
+    """Several leads packed into one paginated Telegram message."""
+    __tablename__ = 'telegram_digests'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    lead_ids = Column(Text, nullable=False)  # JSON list
+    pages = Column(Text, nullable=False)  # JSON list of {"text": ..., "reply_markup": ...}
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class FunnelCount(Base):
+    """Leads entering each state per day, maintained on every transition (see funnel.py)."""
+    __tablename__ = 'funnel_counts'
+
+    day = Column(String(10), primary_key=True)  # YYYY-MM-DD (UTC)
+    state = Column(String(50), primary_key=True)
+    niche = Column(String(50), primary_key=True)
+    city = Column(String(100), primary_key=True)
+    entered = Column(Integer, nullable=False, default=0)
+
+class FunnelCurrent(Base):
+    """Leads currently in each state: incremented on entry, decremented on exit."""
+    __tablename__ = 'funnel_current'
+
+    state = Column(String(50), primary_key=True)
+    niche = Column(String(50), primary_key=True)
+    city = Column(String(100), primary_key=True)
+    leads = Column(Integer, nullable=False, default=0)
+
+class ReplyLatency(Base):
+    """Histogram of send-to-reply time, bucketed by upper bound in hours."""
+    __tablename__ = 'funnel_reply_latency'
+
+    day = Column(String(10), primary_key=True)  # day of the reply
+    niche = Column(String(50), primary_key=True)
+    city = Column(String(100), primary_key=True)
+    bucket = Column(String(10), primary_key=True)  # "1h", "4h", ..., "168h", "inf"
+    replies = Column(Integer, nullable=False, default=0)
+
+class DiscoveryRun(Base):
+    """One discovery cycle; RUNNING after a crash means the next start resumes it."""
+    __tablename__ = 'discovery_runs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    owner = Column(String(100), index=True)  # worker id; each worker resumes only its own runs
+    status = Column(String(20), default='RUNNING', index=True)  # RUNNING, DONE
+    done_queries = Column(Text, default='[]')  # JSON list of search.txt lines fully scraped
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+class LeadCheckpoint(Base):
+    """A scraped lead that hasn't been saved yet, with whatever enrichment found so far."""
+    __tablename__ = 'lead_checkpoints'
+    __table_args__ = (UniqueConstraint('run_id', 'maps_url'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(Integer, ForeignKey('discovery_runs.id'), nullable=False, index=True)
+    maps_url = Column(Text, nullable=False, index=True)
+    stage = Column(String(20), nullable=False)  # SCRAPED, ENRICHED
+    data = Column(Text, nullable=False)  # JSON lead_data
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SearchQuery(Base):
+    """A search.txt line as a leasable unit of discovery work, shared by all workers."""
+    __tablename__ = 'search_queries'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    query = Column(Text, unique=True, nullable=False)
+    active = Column(Boolean, default=True)  # False once removed from search.txt
+    owner = Column(String(100))  # worker holding the lease, None when free
+    lease_expires_at = Column(DateTime, index=True)
+    heartbeat_at = Column(DateTime)
+    last_done_at = Column(DateTime)
+    runs = Column(Integer, default=0)
+
+class Entity(Base):
+    """One real business, under the maps_url of the first listing found for it (see entities.py)."""
+    __tablename__ = 'entities'
+
+    maps_url = Column(Text, primary_key=True)
+    name = Column(String(255), nullable=False)  # normalized, for the similarity check
+    city = Column(String(100))
+    phone = Column(String(20))
+    domain = Column(String(255))
+    merged = Column(Integer, default=0)  # other listings folded into this one
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class EntityKey(Base):
+    """Blocking key pointing at an entity: phone, domain, "city|trigram", or alias (a merged maps_url)."""
+    __tablename__ = 'entity_keys'
+    __table_args__ = (
+        UniqueConstraint('kind', 'key', 'maps_url'),
+        Index('ix_entity_keys_kind_key', 'kind', 'key'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(10), nullable=False)  # phone, domain, trigram, alias
+    key = Column(Text, nullable=False)
+    maps_url = Column(Text, nullable=False)
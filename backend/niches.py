@@ -0,0 +1,189 @@
+import os
+import json
+import zlib
+import logging
+from collections import deque
+from string import Template
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+NICHES_FILE = os.path.join(os.path.dirname(__file__), "config", "niches.json")
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over niche keywords.
+
+    One pass over the text finds every keyword, however many niches and
+    keywords there are. A match must start on a word boundary, so "hair"
+    matches "hairdresser" but not "chair".
+    """
+
+    def __init__(self, keywords: Dict[str, List[str]]):
+        # keywords: {keyword: [niche, ...]}
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[Tuple[str, List[str]]]] = [[]]
+        for keyword, niches in keywords.items():
+            self._add(keyword.lower(), niches)
+        self._build()
+
+    def _add(self, keyword: str, niches: List[str]):
+        state = 0
+        for ch in keyword:
+            if ch not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][ch] = len(self.goto) - 1
+            state = self.goto[state][ch]
+        self.output[state].append((keyword, niches))
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                candidate = self.goto[f].get(ch, 0)
+                self.fail[nxt] = candidate if candidate != nxt else 0
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def find(self, text: str) -> List[Tuple[str, List[str]]]:
+        """Returns (keyword, niches) for every word-initial keyword in text."""
+        text = text.lower()
+        found = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for keyword, niches in self.output[state]:
+                start = i - len(keyword) + 1
+                if start == 0 or not text[start - 1].isalnum():
+                    found.append((keyword, niches))
+        return found
+
+class NicheClassifier:
+    """Maps a Maps category (and optionally the search query) to a niche in niches.json."""
+
+    CATEGORY_WEIGHT = 2  # the listing's own category beats the query we searched with
+
+    def __init__(self, niches: Dict[str, Dict], sender: str, company: str):
+        self.niches = niches
+        keywords: Dict[str, List[str]] = {}
+        for niche, config in niches.items():
+            for kw in config.get("keywords", []):
+                keywords.setdefault(kw.lower(), []).append(niche)
+        self.automaton = KeywordAutomaton(keywords)
+        self.templates = compile_templates(niches, sender, company)
+
+    @classmethod
+    def from_file(cls, sender: str, company: str, path: str = NICHES_FILE) -> "NicheClassifier":
+        try:
+            with open(path, "r") as f:
+                niches = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load niches from {path}: {e}")
+            niches = {}
+        return cls(niches, sender, company)
+
+    def classify(self, category: Optional[str], query: Optional[str] = None) -> Optional[str]:
+        """Best matching niche, or None if nothing matches."""
+        scores: Dict[str, float] = {}
+        for text, weight in ((category, self.CATEGORY_WEIGHT), (query, 1)):
+            if not text:
+                continue
+            for keyword, niches in self.automaton.find(text):
+                for niche in niches:
+                    # Longer keywords are more specific ("fast food" over "food")
+                    scores[niche] = scores.get(niche, 0) + weight + len(keyword) / 100
+        if not scores:
+            return None
+        return max(scores, key=scores.get)
+
+    def build_prompt(self, niche: str, channel: str, lead_data: Dict) -> Optional[str]:
+        """Fills the precompiled template for (niche, channel); None if there isn't one."""
+        template = self.templates.get((niche, channel))
+        if template is None:
+            return None
+        config = self.niches[niche]
+        business_name = lead_data.get("name") or "your business"
+        pain_points = config.get("pain_points") or ["manual client follow-up"]
+        # Stable per business, so redrafts hit the generation cache
+        pain_point = pain_points[zlib.crc32(business_name.encode("utf-8")) % len(pain_points)]
+        return template.substitute(
+            business_name=business_name,
+            category=lead_data.get("category") or "business",
+            city=lead_data.get("city") or "Abuja",
+            rating=lead_data.get("rating") or "N/A",
+            reviews=lead_data.get("reviews") or "0",
+            website_line="has a website" if lead_data.get("website") else "no website",
+            pain_point=pain_point,
+            follow_up=lead_data.get("follow_up_number") or 1,
+        )
+
+EMAIL_TEMPLATE = """You are $sender of $company. Email $$business_name, a $$category in $$city.
+Angle: $$pain_point. We offer $service_focus to $key_benefit.
+Facts: rating $$rating/5 ($$reviews reviews), $$website_line.
+Rules: $tone tone, no pidgin, no "I saw you on Maps", ask for a 15-min call, max 120 words.
+Return JSON only: {"subject": "...", "message": "..."}"""
+
+WHATSAPP_TEMPLATE = """You are $sender of $company, Abuja. WhatsApp $$business_name, a $$category in $$city.
+Open with "Hi! $sender here from $company in $$city." Mention $$pain_point; we do $service_focus.
+Never call the business by its rating. End with "Can we chat for 2 mins?" Under 180 chars, $tone, human.
+Return JSON only: {"message": "..."}"""
+
+FOLLOW_UP_TEMPLATE = """You are $sender. Follow up with $$business_name ($$category, $$city) about helping them $key_benefit.
+$tone, low pressure, no "just checking in". Max 140 chars for WhatsApp, 80 words for email.
+This is follow-up #$$follow_up: take a different angle from any earlier one.
+Return JSON only: {"message": "...", "subject": "Follow up for $$business_name"}"""
+
+def compile_templates(niches: Dict[str, Dict], sender: str, company: str) -> Dict[Tuple[str, str], Template]:
+    """
+    Bakes each niche's constants into per-channel templates once at startup.
+    Only the per-lead fields ($business_name, $city, ...) are left to fill.
+    """
+    compiled = {}
+    for niche, config in niches.items():
+        constants = {
+            "sender": sender,
+            "company": company,
+            "service_focus": config.get("service_focus", "automation"),
+            "key_benefit": config.get("key_benefit", "win more customers"),
+            "tone": config.get("tone", "neutral"),
+        }
+        # Literal "$" in the config must survive the second (per-lead) substitution
+        constants = {k: v.replace("$", "$$") for k, v in constants.items()}
+        for channel, source in (("EMAIL", EMAIL_TEMPLATE), ("WHATSAPP", WHATSAPP_TEMPLATE),
+                                ("FOLLOW_UP", FOLLOW_UP_TEMPLATE)):
+            compiled[(niche, channel)] = Template(Template(source).substitute(constants))
+    return compiled
+
+if __name__ == "__main__":
+    import random
+    import time
+    from ai_agent import niche_classifier as classifier, build_email_prompt, build_whatsapp_prompt
+
+    # Benchmark: classify a large batch of realistic Maps categories
+    words = [kw for cfg in classifier.niches.values() for kw in cfg["keywords"]]
+    fillers = ["shop", "centre", "services", "store", "agency", "ltd", "nigeria", "abuja", "chair", "hub"]
+    rng = random.Random(42)
+    batch = [
+        " ".join(rng.sample(fillers, 2) + ([rng.choice(words)] if rng.random() < 0.8 else []))
+        for _ in range(200_000)
+    ]
+
+    started = time.perf_counter()
+    matched = sum(1 for category in batch if classifier.classify(category))
+    elapsed = time.perf_counter() - started
+    print(f"Classified {len(batch)} categories in {elapsed:.2f}s "
+          f"({len(batch) / elapsed:,.0f}/s, {matched} matched)")
+
+    sample = {"name": "Sunrise Dental Clinic", "category": "Dental clinic", "city": "Abuja", "rating": "4.5"}
+    for channel, legacy in (("EMAIL", build_email_prompt), ("WHATSAPP", build_whatsapp_prompt)):
+        compact = classifier.build_prompt("healthcare", channel, sample)
+        print(f"{channel}: compact prompt {len(compact)} chars vs generic {len(legacy(sample))} chars")
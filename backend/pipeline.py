@@ -0,0 +1,164 @@
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 20
+STATS_LOG_INTERVAL = 60  # seconds between progress lines while a run is going
+
+# handler(item, emit) -- or handler([items], emit) for batch stages.
+# `emit` hands a result to the next stage and waits while that stage's queue is full.
+QUEUE_DEPTH = REGISTRY.gauge("pipeline_queue_depth", "Items waiting in a stage's queue", ["stage"])
+ITEMS_PROCESSED = REGISTRY.counter("pipeline_items", "Items finished by a stage", ["stage", "outcome"])
+
+Handler = Callable[[Any, Callable[[Any], Awaitable[None]]], Awaitable[None]]
+
+class Stage:
+    """
+    One step of a Pipeline: `concurrency` workers pulling from a bounded queue.
+
+    A full queue makes the previous stage wait in `emit`, so a slow stage
+    holds back everything upstream instead of piling up work in memory.
+    Batch stages take everything waiting in their queue (up to `batch_size`)
+    in one call -- used where a single pass serves many items, e.g. the
+    value-ranked generation queue.
+    """
+
+    def __init__(self, name: str, handler: Handler, concurrency: int = 1,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, batch_size: Optional[int] = None):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.emitted = 0
+        self.in_flight = 0
+        self.busy_time = 0.0
+        self.started_at: Optional[float] = None
+
+    async def put(self, item):
+        await self.queue.put(item)
+        self.received += 1
+        QUEUE_DEPTH.set(self.queue.qsize(), stage=self.name)
+
+    async def _take(self) -> List[Any]:
+        items = [await self.queue.get()]
+        while self.batch_size and len(items) < self.batch_size and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    async def _worker(self, emit: Callable[[Any], Awaitable[None]]):
+        while True:
+            items = await self._take()
+            self.in_flight += len(items)
+            started = time.monotonic()
+            try:
+                if self.batch_size:
+                    await self.handler(items, emit)
+                else:
+                    await self.handler(items[0], emit)
+                self.processed += len(items)
+                ITEMS_PROCESSED.inc(len(items), stage=self.name, outcome="ok")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += len(items)
+                ITEMS_PROCESSED.inc(len(items), stage=self.name, outcome="failed")
+                logger.error(f"Pipeline stage '{self.name}' failed: {e}")
+            finally:
+                self.busy_time += time.monotonic() - started
+                self.in_flight -= len(items)
+                QUEUE_DEPTH.set(self.queue.qsize(), stage=self.name)
+                for _ in items:
+                    self.queue.task_done()
+
+    def stats(self) -> Dict:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "emitted": self.emitted,
+            "throughput": round(self.processed / elapsed, 3) if elapsed else 0.0,  # items/s
+            # Share of worker time spent busy; the stage nearest 1.0 limits the run
+            "utilization": round(min(1.0, self.busy_time / (elapsed * self.concurrency)), 3) if elapsed else 0.0,
+        }
+
+class Pipeline:
+    """Stages joined by bounded asyncio queues; each stage's results feed the next."""
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+
+    def _emitter(self, index: int) -> Callable[[Any], Awaitable[None]]:
+        stage = self.stages[index]
+        nxt = self.stages[index + 1] if index + 1 < len(self.stages) else None
+
+        async def emit(item):
+            stage.emitted += 1
+            if nxt is not None:
+                await nxt.put(item)
+        return emit
+
+    async def run(self, items: Union[Iterable[Any], AsyncIterable[Any]]):
+        """
+        Feeds `items` into the first stage and returns once every stage has
+        drained. Cancelling the caller cancels all workers.
+        """
+        now = time.monotonic()
+        workers = []
+        for i, stage in enumerate(self.stages):
+            stage.started_at = now
+            emit = self._emitter(i)
+            workers += [asyncio.create_task(stage._worker(emit), name=f"{stage.name}-{n}")
+                        for n in range(stage.concurrency)]
+        reporter = asyncio.create_task(self._report())
+        try:
+            first = self.stages[0]
+            if hasattr(items, "__aiter__"):
+                # Pulled only as the first stage has room, e.g. work claimed from a shared queue
+                async for item in items:
+                    await first.put(item)
+            else:
+                for item in items:
+                    await first.put(item)
+            # A stage only emits while handling an item, so once it has
+            # drained everything it will ever send is already downstream.
+            for stage in self.stages:
+                await stage.queue.join()
+        finally:
+            reporter.cancel()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(reporter, *workers, return_exceptions=True)
+        self.log_stats()
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL)
+            self.log_stats()
+
+    def stats(self) -> Dict[str, Dict]:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def bottleneck(self) -> Optional[str]:
+        """The busiest stage relative to its concurrency."""
+        stats = self.stats()
+        return max(stats, key=lambda name: stats[name]["utilization"]) if stats else None
+
+    def log_stats(self):
+        for name, s in self.stats().items():
+            logger.info(f"[pipeline] {name:<8} queue {s['queue_depth']}/{s['queue_size']} "
+                        f"in-flight {s['in_flight']}/{s['concurrency']} done {s['processed']} "
+                        f"failed {s['failed']} {s['throughput']}/s util {s['utilization']:.0%}")
+        logger.info(f"[pipeline] bottleneck: {self.bottleneck()}")
@@ -0,0 +1,89 @@
+import os
+import socket
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import and_, or_, select, update
+from models import SearchQuery
+
+logger = logging.getLogger(__name__)
+
+# Stable across restarts so a worker resumes its own checkpoints; set it
+# explicitly when running several workers on one host.
+WORKER_ID = os.getenv("DISCOVERY_WORKER_ID") or socket.gethostname()
+LEASE_SECONDS = 5 * 60        # a dead worker's query is reclaimed after this
+HEARTBEAT_INTERVAL = 60       # seconds between lease renewals
+QUERY_MIN_INTERVAL = 5 * 60   # a finished query isn't scraped again sooner than this
+
+def sync_queries(db, queries: List[str]):
+    """Mirrors search.txt into search_queries (new lines added, removed ones deactivated). Commits."""
+    existing = {row.query: row for row in db.query(SearchQuery)}
+    for query in queries:
+        if query not in existing:
+            db.add(SearchQuery(query=query, active=True))
+        elif not existing[query].active:
+            existing[query].active = True
+    wanted = set(queries)
+    for query, row in existing.items():
+        if row.active and query not in wanted:
+            row.active = False
+    db.commit()
+
+def claim_query(db, owner: str = WORKER_ID, lease_seconds: float = LEASE_SECONDS,
+                min_interval: float = QUERY_MIN_INTERVAL) -> Optional[str]:
+    """
+    Leases the next due query to `owner`, or returns None if none is free.
+
+    A query is claimable when it has no owner or its lease has expired
+    (its worker died or stalled), and it wasn't finished in the last
+    `min_interval` seconds. The claim is a compare-and-set UPDATE, so two
+    workers racing for the same row can't both win. Commits.
+    """
+    now = datetime.utcnow()
+    free = or_(SearchQuery.owner == None, SearchQuery.lease_expires_at < now)
+    due = or_(SearchQuery.last_done_at == None, SearchQuery.last_done_at < now - timedelta(seconds=min_interval))
+    candidates = db.execute(
+        select(SearchQuery.id, SearchQuery.query, SearchQuery.owner)
+        .where(SearchQuery.active == True, free, due)
+        .order_by(SearchQuery.last_done_at.is_not(None), SearchQuery.last_done_at, SearchQuery.id)
+        .limit(10)
+    ).all()
+    for query_id, query, previous_owner in candidates:
+        result = db.execute(
+            update(SearchQuery)
+            .where(SearchQuery.id == query_id, free, due)
+            .values(owner=owner, lease_expires_at=now + timedelta(seconds=lease_seconds), heartbeat_at=now)
+        )
+        db.commit()
+        if result.rowcount == 1:
+            if previous_owner and previous_owner != owner:
+                logger.warning(f"Reclaimed stale lease on '{query}' from {previous_owner}")
+            return query
+    return None
+
+def renew_leases(db, owner: str = WORKER_ID, lease_seconds: float = LEASE_SECONDS) -> int:
+    """Heartbeat: extends every live lease `owner` holds. Returns how many. Commits."""
+    now = datetime.utcnow()
+    result = db.execute(
+        update(SearchQuery)
+        .where(SearchQuery.owner == owner, SearchQuery.lease_expires_at >= now)
+        .values(lease_expires_at=now + timedelta(seconds=lease_seconds), heartbeat_at=now)
+    )
+    db.commit()
+    return result.rowcount
+
+def release_query(db, query: str, owner: str = WORKER_ID, done: bool = True) -> bool:
+    """
+    Gives the lease back; `done` records the query as finished for this round.
+    Returns False if the lease had expired and another worker took it. Commits.
+    """
+    values = {"owner": None, "lease_expires_at": None}
+    if done:
+        values.update(last_done_at=datetime.utcnow(), runs=SearchQuery.runs + 1)
+    result = db.execute(
+        update(SearchQuery).where(and_(SearchQuery.query == query, SearchQuery.owner == owner)).values(**values)
+    )
+    db.commit()
+    if result.rowcount == 0:
+        logger.warning(f"Lease on '{query}' was lost before release")
+    return result.rowcount == 1
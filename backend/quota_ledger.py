@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+QUOTA_DB_FILE = os.getenv("QUOTA_DB_FILE", os.path.join(DATA_DIR, "quota.db"))
+CACHE_TTL = 5  # seconds before the in-process cache is reconciled with disk
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    key TEXT NOT NULL,
+    channel TEXT NOT NULL DEFAULT '',
+    calls INTEGER NOT NULL DEFAULT 0,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, key, channel)
+)
+"""
+
+def today() -> str:
+    return time.strftime("%Y-%m-%d")
+
+class QuotaLedger:
+    """
+    Daily LLM quota ledger shared by every process on the host.
+
+    Counts live in a small SQLite file. Reservations run inside
+    BEGIN IMMEDIATE so two processes can never both take the last call
+    of a key. Reads go through a short-lived in-process cache that is
+    dropped on date rollover.
+    """
+
+    def __init__(self, path: str = QUOTA_DB_FILE, cache_ttl: float = CACHE_TTL):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._cache: Dict[str, int] = {}
+        self._cache_day: Optional[str] = None
+        self._cache_at = 0.0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA)
+
+    def import_legacy_json(self, path: str):
+        """One-off import of today's counts from the old data/usage.json."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                usage = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable legacy usage file {path}: {e}")
+            return
+        if usage.get("date") == today():
+            with closing(self._connect()) as conn:
+                for key, calls in usage.get("keys", {}).items():
+                    conn.execute(
+                        "INSERT OR IGNORE INTO usage (day, key, channel, calls) VALUES (?, ?, '', ?)",
+                        (today(), str(key), int(calls))
+                    )
+        os.replace(path, path + ".migrated")
+        logger.info(f"Migrated legacy usage file {path} into quota ledger")
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None lets us issue BEGIN IMMEDIATE ourselves
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _invalidate(self):
+        self._cache_day = None
+
+    def key_counts(self, day: Optional[str] = None) -> Dict[str, int]:
+        """Calls per key for a day (today by default), served from cache."""
+        day = day or today()
+        with self._lock:
+            fresh = time.monotonic() - self._cache_at < self.cache_ttl
+            if self._cache_day == day and fresh:
+                return dict(self._cache)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT key, SUM(calls) FROM usage WHERE day = ? GROUP BY key", (day,)
+            ).fetchall()
+        counts = {k: int(c) for k, c in rows}
+        if day == today():
+            with self._lock:
+                self._cache = counts
+                self._cache_day = day
+                self._cache_at = time.monotonic()
+        return dict(counts)
+
+    def channel_counts(self, day: Optional[str] = None) -> Dict[str, int]:
+        """Calls per channel (EMAIL, WHATSAPP, FOLLOW_UP) for a day."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT channel, SUM(calls) FROM usage WHERE day = ? GROUP BY channel",
+                (day or today(),)
+            ).fetchall()
+        return {ch: int(c) for ch, c in rows if ch}
+
+    def token_usage(self, day: Optional[str] = None) -> Dict[str, int]:
+        """Tokens consumed per key for a day."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT key, SUM(tokens) FROM usage WHERE day = ? GROUP BY key",
+                (day or today(),)
+            ).fetchall()
+        return {k: int(t) for k, t in rows}
+
+    def snapshot(self) -> Dict:
+        """Reporting view: {"date", "keys", "channels", "tokens"}."""
+        day = today()
+        return {
+            "date": day,
+            "keys": self.key_counts(day),
+            "channels": self.channel_counts(day),
+            "tokens": self.token_usage(day),
+        }
+
+    def reserve(self, key: str, limit: int, channel: str = "") -> bool:
+        """
+        Atomically takes one call from `key` if it is still under `limit`.
+        Returns False when the key is exhausted (or the ledger is unreadable,
+        so we never overspend on a broken file).
+        """
+        day = today()
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                (used,) = conn.execute(
+                    "SELECT COALESCE(SUM(calls), 0) FROM usage WHERE day = ? AND key = ?",
+                    (day, key)
+                ).fetchone()
+                if used >= limit:
+                    conn.execute("COMMIT")
+                    return False
+                conn.execute(
+                    "INSERT INTO usage (day, key, channel, calls) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT(day, key, channel) DO UPDATE SET calls = calls + 1",
+                    (day, key, channel)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.error(f"Quota ledger unavailable, refusing reservation: {e}")
+            return False
+        self._invalidate()
+        return True
+
+    def release(self, key: str, channel: str = ""):
+        """Gives back a reservation whose call did not produce a usable result."""
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE usage SET calls = MAX(calls - 1, 0) WHERE day = ? AND key = ? AND channel = ?",
+                (today(), key, channel)
+            )
+        self._invalidate()
+
+    def record_tokens(self, key: str, tokens: int, channel: str = ""):
+        """Adds token usage to the row of an existing reservation."""
+        if not tokens:
+            return
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO usage (day, key, channel, tokens) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(day, key, channel) DO UPDATE SET tokens = tokens + excluded.tokens",
+                (today(), key, channel, int(tokens))
+            )
@@ -1,16 +1,129 @@
 import asyncio
 import random
 import re
+import time
 import logging
 import urllib.parse
+from typing import Dict, List, Optional
 from playwright.async_api import async_playwright
 from playwright_stealth import Stealth
 from utils import normalize_phone
+from metrics import REGISTRY
+import tracing
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+SCRAPE_SECONDS = REGISTRY.histogram("scrape_query_seconds", "Time to scrape one Maps search query")
+LEADS_SCRAPED = REGISTRY.counter("leads_scraped", "Listings extracted from Maps")
+
+FEED_SELECTOR = 'div[role="feed"]'
+ARTICLE_SELECTOR = 'div[role="article"]'
+SCROLL_PAUSE_MS = 2000  # lets Maps load the next page of results after each scroll
+
+async def extract_listings(page, max_results: int = 50, search_query: str = "",
+                           started: Optional[float] = None) -> List[Dict]:
+    """
+    Scrolls a loaded Maps results feed and reads each listing. Split from
+    scrape_google_maps so saved feed HTML can be replayed through it offline.
+    """
+    trace_key = f"query:{search_query}"
+    query_started = started or time.time()
+    leads = []
+    processed_ids = set()
+
+    while len(leads) < max_results:
+        # Scroll to load more
+        with tracing.span("maps.scroll", key=trace_key):
+            await page.evaluate(f"document.querySelector('{FEED_SELECTOR}').scrollBy(0, 3000)")
+            await page.wait_for_timeout(SCROLL_PAUSE_MS)
+
+        results = await page.query_selector_all(ARTICLE_SELECTOR)
+        if not results:
+            break
+
+        new_results_found = False
+        for result in results:
+            if len(leads) >= max_results:
+                break
+
+            name_el = await result.query_selector('.qBF1Pd')
+            if not name_el:
+                continue
+
+            name = await name_el.inner_text()
+            if name in processed_ids:
+                continue
+
+            new_results_found = True
+            processed_ids.add(name)
+
+            try:
+                # Extract high-level data from list view
+                rating_el = await result.query_selector('span.MW4etd')
+                rating = await rating_el.inner_text() if rating_el else "0"
+
+                review_el = await result.query_selector('span.UY7F9')
+                reviews = await review_el.inner_text() if review_el else "0"
+
+                category_el = await result.query_selector('.W4Efsd span:nth-child(1) span')
+                category = ""
+                if category_el:
+                    category_text = await category_el.inner_text()
+                    # Reject if it's just a number (rating)
+                    if not re.match(r'^\d+\.?\d*$', category_text.strip()):
+                        category = category_text
+
+                phone_el = await result.query_selector('span.UsdlK')
+                phone = await phone_el.inner_text() if phone_el else "N/A"
+
+                website = ""
+                website_el = await result.query_selector('a.lcr4fd')
+                if website_el:
+                    href = await website_el.get_attribute('href')
+                    # Reject ad links and internal google links
+                    if href and not any(term in href for term in ["/aclk", "googleadservices", "google.com/maps"]):
+                        website = href
+
+                # Extract unique link for this business
+                listing_url = ""
+                link_el = await result.query_selector('a.hfpxzc')
+                if link_el:
+                    listing_url = await link_el.get_attribute('href')
+
+                if not listing_url:
+                    # Fallback if the standard selector fails
+                    listing_url = f"https://www.google.com/maps/search/{urllib.parse.quote(name)}"
+
+                lead = {
+                    "name": name,
+                    "category": category,
+                    "phone": phone,
+                    "normalized_phone": normalize_phone(phone),
+                    "website": website,
+                    "rating": rating,
+                    "reviews": reviews,
+                    "maps_url": listing_url
+                }
+
+                leads.append(lead)
+                # Time from the search starting until this listing was read
+                tracing.record("maps.scrape", query_started, time.time() - query_started,
+                               key=listing_url, query=search_query)
+                logger.info(f"Scraped {len(leads)}: {name}")
+
+            except Exception as e:
+                logger.error(f"Error extracting listing: {e}")
+
+        # Check for end of list
+        end_of_list = await page.query_selector('span:has-text("You\'ve reached the end of the list.")')
+        if end_of_list or not new_results_found:
+            break
+
+    return leads
+
+@SCRAPE_SECONDS.timed
 async def scrape_google_maps(business_type: str, location: str, max_results: int = 50):
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=True)
@@ -24,11 +137,16 @@ async def scrape_google_maps(business_type: str, location: str, max_results: int
         
         search_query = f"{business_type} in {location}"
         url = f"https://www.google.com/maps/search/{search_query.replace(' ', '+')}"
+        # Query phases are traced under the query; each listing gets a span of its own lead
+        trace_key = f"query:{search_query}"
+        query_started = time.time()
         
         logger.info(f"Searching for: {search_query}")
         try:
-            await page.goto(url, timeout=90000)
-            await page.wait_for_load_state("networkidle", timeout=60000)
+            with tracing.span("maps.goto", key=trace_key):
+                await page.goto(url, timeout=90000)
+            with tracing.span("maps.networkidle", key=trace_key):
+                await page.wait_for_load_state("networkidle", timeout=60000)
         except Exception as e:
             logger.warning(f"Initial navigation timeout: {e}. Attempting to proceed.")
             
@@ -46,105 +164,18 @@ async def scrape_google_maps(business_type: str, location: str, max_results: int
             except Exception:
                 pass
 
-        leads = []
-        scrollable_div_selector = 'div[role="feed"]'
-        article_selector = 'div[role="article"]'
-        
         # Wait for the feed to load
         try:
-            await page.wait_for_selector(article_selector, timeout=15000)
+            await page.wait_for_selector(ARTICLE_SELECTOR, timeout=15000)
         except Exception:
             logger.error("No results found or page blocked.")
             await browser.close()
             return []
 
-        processed_ids = set()
-        
-        while len(leads) < max_results:
-            # Scroll to load more
-            await page.evaluate(f"document.querySelector('{scrollable_div_selector}').scrollBy(0, 3000)")
-            await page.wait_for_timeout(2000)
-            
-            results = await page.query_selector_all(article_selector)
-            if not results:
-                break
-                
-            new_results_found = False
-            for result in results:
-                if len(leads) >= max_results:
-                    break
-                
-                name_el = await result.query_selector('.qBF1Pd')
-                if not name_el:
-                    continue
-                
-                name = await name_el.inner_text()
-                if name in processed_ids:
-                    continue
-                
-                new_results_found = True
-                processed_ids.add(name)
-                
-                try:
-                    # Extract high-level data from list view
-                    rating_el = await result.query_selector('span.MW4etd')
-                    rating = await rating_el.inner_text() if rating_el else "0"
-                    
-                    review_el = await result.query_selector('span.UY7F9')
-                    reviews = await review_el.inner_text() if review_el else "0"
-                    
-                    category_el = await result.query_selector('.W4Efsd span:nth-child(1) span')
-                    category = ""
-                    if category_el:
-                        category_text = await category_el.inner_text()
-                        # Reject if it's just a number (rating)
-                        if not re.match(r'^\d+\.?\d*$', category_text.strip()):
-                            category = category_text
-                    
-                    phone_el = await result.query_selector('span.UsdlK')
-                    phone = await phone_el.inner_text() if phone_el else "N/A"
-                    
-                    website = ""
-                    website_el = await result.query_selector('a.lcr4fd')
-                    if website_el:
-                        href = await website_el.get_attribute('href')
-                        # Reject ad links and internal google links
-                        if href and not any(term in href for term in ["/aclk", "googleadservices", "google.com/maps"]):
-                            website = href
-
-                    # Extract unique link for this business
-                    listing_url = ""
-                    link_el = await result.query_selector('a.hfpxzc')
-                    if link_el:
-                        listing_url = await link_el.get_attribute('href')
-                    
-                    if not listing_url:
-                        # Fallback if the standard selector fails
-                        listing_url = f"https://www.google.com/maps/search/{urllib.parse.quote(name)}"
-
-                    lead = {
-                        "name": name,
-                        "category": category,
-                        "phone": phone,
-                        "normalized_phone": normalize_phone(phone),
-                        "website": website,
-                        "rating": rating,
-                        "reviews": reviews,
-                        "maps_url": listing_url
-                    }
-                    
-                    leads.append(lead)
-                    logger.info(f"Scraped {len(leads)}: {name}")
-                    
-                except Exception as e:
-                    logger.error(f"Error extracting listing: {e}")
-
-            # Check for end of list
-            end_of_list = await page.query_selector('span:has-text("You\'ve reached the end of the list.")')
-            if end_of_list or not new_results_found:
-                break
+        leads = await extract_listings(page, max_results, search_query, query_started)
 
         await browser.close()
+        LEADS_SCRAPED.inc(len(leads))
         return leads
 
 
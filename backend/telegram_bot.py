@@ -1,11 +1,20 @@
 import os
+import sys
+import hmac
 import asyncio
 import logging
-import aiohttp
+from typing import Optional
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 # from database import get_daily_status # This was causing issues if not defined, let's keep it if it exists or mock
+from database import SessionLocal
+from telegram_queue import get_digest_page
+from lead_actions import ACTIONS, perform_action
+from telegram_sender import TELEGRAM_API_BASE
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,66 +25,123 @@ logger = logging.getLogger(__name__)
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
-ACTION_API_URL = "http://localhost:3063/action"
 
-bot = Bot(token=TELEGRAM_TOKEN)
+# Webhook mode: updates arrive on the Action API's FastAPI app instead of long polling
+WEBHOOK_MODE = os.getenv("TELEGRAM_WEBHOOK_MODE", "0") == "1"
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_BASE_URL = os.getenv("TELEGRAM_WEBHOOK_URL", os.getenv("ACTION_API_PUBLIC_URL", ""))
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+WEBHOOK_MODE_EXIT = 78  # EX_CONFIG; the listener unit has RestartPreventExitStatus=78
+
+def create_bot(token: str, api_base: str = TELEGRAM_API_BASE) -> Bot:
+    """Bot pointed at the real Bot API, or at a local stand-in server for tests."""
+    if api_base.rstrip("/") == "https://api.telegram.org":
+        return Bot(token=token)
+    return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_base)))
+
+bot = create_bot(TELEGRAM_TOKEN) if TELEGRAM_TOKEN else None
 dp = Dispatcher()
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     await message.answer("🚀 *Outreach Control Bot Active*\n\nMonitoring leads and handling state transitions.", parse_mode="Markdown")
 
+def _is_digest(callback: types.CallbackQuery) -> bool:
+    """Digest messages hold many leads, so one tap must not wipe the whole keyboard."""
+    markup = callback.message.reply_markup if callback.message else None
+    if not markup:
+        return False
+    return any(
+        (button.callback_data or "").startswith("digest:")
+        for row in markup.inline_keyboard for button in row
+    )
+
+@dp.callback_query(F.data.startswith("digest:"))
+async def handle_digest_page(callback: types.CallbackQuery):
+    """Next/prev navigation inside a digest: swaps the message to another stored page."""
+    _, digest_id, page_no = callback.data.split(":")
+    db = SessionLocal()
+    try:
+        page = get_digest_page(db, int(digest_id), int(page_no))
+    finally:
+        db.close()
+    if not page:
+        await callback.answer("Digest page not found", show_alert=True)
+        return
+    try:
+        await callback.message.edit_text(page["text"], parse_mode="MarkdownV2", reply_markup=types.InlineKeyboardMarkup.model_validate(page["reply_markup"]))
+    except TelegramBadRequest as e:
+        # "message is not modified" when tapping the current page indicator
+        logger.debug(f"Digest page unchanged: {e}")
+    await callback.answer()
+
+async def _handle_action(callback: types.CallbackQuery, action: str, status_line: str):
+    """Applies a lead action in-process and updates the draft message."""
+    lead_id = callback.data.split(":")[1]
+    logger.info(f"Callback received: {action}:{lead_id}")
+    try:
+        business_name = await perform_action(lead_id, action)
+    except Exception as e:
+        logger.error(f"Failed to update lead {lead_id}: {e}")
+        await callback.answer("Error updating state", show_alert=True)
+        return
+
+    if business_name is None:
+        logger.error(f"Lead not found for callback {action}:{lead_id}")
+        await callback.answer("Lead not found", show_alert=True)
+        return
+
+    await callback.answer(f"{business_name} marked as {ACTIONS[action]}")
+    # Edit message to remove buttons and show status
+    if callback.message.text and not _is_digest(callback):
+        # Escape special chars for MarkdownV2 if necessary, but simple append here
+        new_text = callback.message.text + f"\n\n{status_line}"
+        await callback.message.edit_text(new_text, parse_mode="Markdown", reply_markup=None)
+
 @dp.callback_query(F.data.startswith("sent:"))
 async def handle_sent_callback(callback: types.CallbackQuery):
-    lead_id = callback.data.split(":")[1]
-    logger.info(f"Callback received: sent:{lead_id}")
-    async with aiohttp.ClientSession() as session:
-        url = f"{ACTION_API_URL}/sent/{lead_id}"
-        try:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    await callback.answer(data.get("message", "Marked as SENT"))
-                    
-                    # Edit message to remove buttons and show status
-                    if callback.message.text:
-                        # Escape special chars for MarkdownV2 if necessary, but simple append here
-                        new_text = callback.message.text + "\n\n✅ *Status: SENT*"
-                        await callback.message.edit_text(new_text, parse_mode="Markdown", reply_markup=None)
-                else:
-                    logger.error(f"API Error: {resp.status} for {url}")
-                    await callback.answer("Error updating state", show_alert=True)
-        except Exception as e:
-            logger.error(f"Failed to connect to Action API: {e}")
-            await callback.answer("API Connection Failed", show_alert=True)
+    await _handle_action(callback, "sent", "✅ *Status: SENT*")
 
 @dp.callback_query(F.data.startswith("replied:"))
 async def handle_replied_callback(callback: types.CallbackQuery):
-    lead_id = callback.data.split(":")[1]
-    logger.info(f"Callback received: replied:{lead_id}")
-    async with aiohttp.ClientSession() as session:
-        url = f"{ACTION_API_URL}/replied/{lead_id}"
-        try:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    await callback.answer(data.get("message", "Marked as REPLIED"))
-                    
-                    if callback.message.text:
-                        new_text = callback.message.text + "\n\n💬 *Status: REPLIED*"
-                        await callback.message.edit_text(new_text, parse_mode="Markdown", reply_markup=None)
-                else:
-                    logger.error(f"API Error: {resp.status} for {url}")
-                    await callback.answer("Error updating state", show_alert=True)
-        except Exception as e:
-            logger.error(f"Failed to connect to Action API: {e}")
-            await callback.answer("API Connection Failed", show_alert=True)
+    await _handle_action(callback, "replied", "💬 *Status: REPLIED*")
+
+def verify_webhook_secret(received: Optional[str]) -> bool:
+    """Constant-time check of the X-Telegram-Bot-Api-Secret-Token header."""
+    if not WEBHOOK_SECRET:
+        return False  # refuse webhook traffic until a secret is configured
+    return hmac.compare_digest(received or "", WEBHOOK_SECRET)
+
+async def feed_webhook_update(payload: dict):
+    """Handles one webhook update in the caller's event loop."""
+    update = types.Update.model_validate(payload, context={"bot": bot})
+    await dp.feed_update(bot, update)
+
+async def start_webhook():
+    """Registers the webhook with Telegram; called from the FastAPI lifespan."""
+    missing = [name for name, value in (("TELEGRAM_BOT_TOKEN", bot), ("TELEGRAM_WEBHOOK_URL", WEBHOOK_BASE_URL),
+                                        ("TELEGRAM_WEBHOOK_SECRET", WEBHOOK_SECRET)) if not value]
+    if missing:
+        # Without a secret every update would be refused with a 403 and nobody would notice
+        raise RuntimeError(f"TELEGRAM_WEBHOOK_MODE=1 needs {', '.join(missing)} set")
+    url = f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}"
+    await bot.set_webhook(url, secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"Telegram webhook set to {url}")
+
+async def stop_webhook():
+    await bot.session.close()
 
 async def main():
     logger.info("Starting Telegram Bot listener...")
+    # Polling and webhooks are mutually exclusive on Telegram's side
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
+    if WEBHOOK_MODE:
+        # Not an error: exit with a status systemd won't restart on
+        logger.info("TELEGRAM_WEBHOOK_MODE=1: updates are served by action_api.py; the polling listener isn't needed.")
+        sys.exit(WEBHOOK_MODE_EXIT)
     if TELEGRAM_TOKEN:
         asyncio.run(main())
     else:
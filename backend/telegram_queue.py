@@ -1,13 +1,17 @@
 import os
 import logging
 import asyncio
+import json
 from datetime import datetime
 from sqlalchemy import and_
-from models import Lead
+from typing import Dict, List, Optional
+from models import Lead, OutboxMessage, TelegramDigest
+from database import SessionLocal
 from dotenv import load_dotenv
-import aiohttp
-import urllib.parse
-import re
+from telegram_sender import get_sender
+from telegram_render import build_digest_pages, lead_messages
+from metrics import REGISTRY
+import tracing
 
 load_dotenv()
 
@@ -19,125 +23,199 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 DAILY_SENT_LIMIT = 15
 # Use PUBLIC_URL for Telegram buttons (e.g. EC2 IP), fallback to localhost
 ACTION_API_BASE_URL = os.getenv("ACTION_API_PUBLIC_URL", "http://localhost:3063")
+OUTBOX_POLL_INTERVAL = 5  # seconds between outbox drains
+OUTBOX_MAX_ATTEMPTS = 5
+# Digest mode packs several leads into one paginated message
+DIGEST_MODE = os.getenv("TELEGRAM_DIGEST_MODE", "0") == "1"
 
-def escape_markdown_v2(text: str, is_code: bool = False) -> str:
-    """Escapes characters for Telegram MarkdownV2."""
-    if not text:
-        return ""
-    if is_code:
-        return text.replace("\\", "\\\\").replace("`", "\\`")
-    
-    escape_chars = r"_*[]()~`>#+-=|{}.!"
-    return "".join(f"\\{c}" if c in escape_chars else c for c in text)
-
-async def send_to_telegram(lead: Lead):
-    """Sends separate messages for Email and WhatsApp drafts to Telegram."""
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-        logger.error("Telegram credentials missing in .env")
-        return False
-
-    success = True
-    
-    # Common Buttons for State Transitions (using callback_data instead of URL)
-    # format: action:lead_id
-    action_buttons = [
-        {"text": "✅ Mark Sent", "callback_data": f"sent:{lead.id}"},
-        {"text": "💬 Replied", "callback_data": f"replied:{lead.id}"}
-    ]
-
-    # 1. Send Email Draft if present
-    if lead.email_draft:
-        email_msg = f"📧 *EMAIL DRAFT for* {escape_markdown_v2(lead.business_name)}\n"
-        email_msg += f"📍 *Category:* {escape_markdown_v2(lead.category or 'Business')}\n"
-        email_msg += f"📧 *To:* `{escape_markdown_v2(lead.email or 'N/A')}`\n\n"
-        email_msg += f"📋 *Subject:* `{escape_markdown_v2(lead.email_subject or 'Outreach')}`\n\n"
-        email_msg += f"📝 *Copy Message \\(Tap to copy\\):*\n`{escape_markdown_v2(lead.email_draft, is_code=True)}`"
-        
-        keyboard = {"inline_keyboard": []}
-        if lead.email:
-            subject_enc = urllib.parse.quote(lead.email_subject or "Outreach")
-            body_enc = urllib.parse.quote(lead.email_draft or "")
-            mailto_link = f"mailto:{lead.email}?subject={subject_enc}&body={body_enc}"
-            keyboard["inline_keyboard"].append([{"text": "📧 Open Mail App", "url": mailto_link}])
-        
-        keyboard["inline_keyboard"].append(action_buttons)
-        
-        res = await _call_telegram_api(email_msg, keyboard)
-        if not res: success = False
-        await asyncio.sleep(1)
-
-    # 2. Send WhatsApp Draft if present
-    if lead.whatsapp_draft:
-        wa_msg = f"🟢 *WHATSAPP DRAFT for* {escape_markdown_v2(lead.business_name)}\n"
-        wa_msg += f"📱 *To:* `{escape_markdown_v2(lead.phone_number or 'N/A')}`\n\n"
-        wa_msg += f"📝 *Copy Message \\(Tap to copy\\):*\n`{escape_markdown_v2(lead.whatsapp_draft, is_code=True)}`"
-        
-        keyboard = {"inline_keyboard": []}
-        if lead.phone_number and lead.phone_number != "N/A":
-            hp = re.sub(r'\D', '', lead.phone_number)
-            if len(hp) >= 10:
-                if not hp.startswith('234'): hp = '234' + hp.lstrip('0')
-                msg_enc = urllib.parse.quote(lead.whatsapp_draft or "")
-                wa_link = f"https://wa.me/{hp}?text={msg_enc}"
-                keyboard["inline_keyboard"].append([{"text": "💬 Open WhatsApp", "url": wa_link}])
-            
-        keyboard["inline_keyboard"].append(action_buttons)
-            
-        res = await _call_telegram_api(wa_msg, keyboard)
-        if not res: success = False
-
-    return success
-
-async def _call_telegram_api(text: str, reply_markup: dict = None):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": text,
-        "parse_mode": "MarkdownV2",
-        "reply_markup": reply_markup
-    }
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                if response.status == 200:
-                    return True
-                else:
-                    err_text = await response.text()
-                    logger.error(f"Telegram API Error: {err_text}")
-                    return False
-    except Exception as e:
-        logger.error(f"Telegram request failed: {e}")
-        return False
+OUTBOX_PENDING = REGISTRY.gauge("telegram_outbox_pending", "Outbox messages waiting for delivery")
+
+def enqueue_lead(db, lead: Lead) -> int:
+    """
+    Writes the lead's messages to the outbox and marks it QUEUED in the same
+    transaction (the caller commits). Returns the number of new outbox rows.
+    """
+    added = 0
+    for message in lead_messages(lead):
+        key = f"{lead.id}:{message['kind']}:{int(lead.follow_up_count or 0)}"
+        existing = db.query(OutboxMessage).filter(OutboxMessage.idempotency_key == key).first()
+        if existing is not None:
+            if existing.status == 'FAILED':
+                # Re-queued after review: send the current draft this time
+                existing.payload = json.dumps({"text": message["text"], "reply_markup": message["reply_markup"]})
+                existing.status = 'PENDING'
+                existing.attempts = 0
+                existing.last_error = None
+            continue
+        db.add(OutboxMessage(
+            lead_id=lead.id,
+            kind=message["kind"],
+            idempotency_key=key,
+            payload=json.dumps({"text": message["text"], "reply_markup": message["reply_markup"]}),
+        ))
+        added += 1
+    lead.is_queued = True
+    lead.queued_at = datetime.utcnow()
+    lead.state = 'QUEUED'
+    return added
+
+def enqueue_digest(db, leads: List[Lead]) -> TelegramDigest:
+    """
+    Queues one digest message for all `leads`; later pages are served by
+    the bot's next/prev callbacks. The caller commits.
+    """
+    digest = TelegramDigest(lead_ids=json.dumps([lead.id for lead in leads]), pages="[]")
+    db.add(digest)
+    db.flush()  # need the id for the callback data
+    pages = build_digest_pages(digest.id, leads)
+    digest.pages = json.dumps(pages)
+    db.add(OutboxMessage(
+        lead_id=leads[0].id,
+        kind="DIGEST",
+        idempotency_key=f"digest:{digest.id}",
+        payload=json.dumps(pages[0]),
+    ))
+    now = datetime.utcnow()
+    for lead in leads:
+        lead.is_queued = True
+        lead.queued_at = now
+        lead.state = 'QUEUED'
+    return digest
+
+def get_digest_page(db, digest_id: int, page_no: int) -> Optional[Dict]:
+    """Stored page of a digest, or None if it doesn't exist."""
+    digest = db.query(TelegramDigest).filter(TelegramDigest.id == digest_id).first()
+    if not digest:
+        return None
+    pages = json.loads(digest.pages)
+    return pages[page_no] if 0 <= page_no < len(pages) else None
+
+def remaining_daily_budget(db) -> int:
+    """Leads that can still be queued to Telegram today."""
+    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    sent_today = db.query(Lead).filter(
+        and_(Lead.is_queued == True, Lead.queued_at >= today_start)
+    ).count()
+    return max(0, DAILY_SENT_LIMIT - sent_today)
 
 async def process_telegram_queue(db):
-    """Checks the budget and sends drafted leads to Telegram."""
+    """Checks the budget and moves drafted leads into the Telegram outbox."""
     try:
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        sent_today = db.query(Lead).filter(
-            and_(Lead.is_queued == True, Lead.queued_at >= today_start)
-        ).count()
-        
-        remaining = DAILY_SENT_LIMIT - sent_today
+        remaining = remaining_daily_budget(db)
         if remaining <= 0:
             logger.info("Daily budget reached.")
             return 0
 
+        # Best drafts first when the budget can't take them all; walks ix_leads_state_priority
         drafts = db.query(Lead).filter(
             and_(Lead.state == 'DRAFTED', Lead.is_queued == False)
-        ).order_by(Lead.created_at.asc()).limit(remaining).all()
-
-        sent_count = 0
-        for lead in drafts:
-            if await send_to_telegram(lead):
-                lead.is_queued = True
-                lead.queued_at = datetime.utcnow()
-                lead.state = 'QUEUED'
-                sent_count += 1
-                await asyncio.sleep(1)
+        ).order_by(Lead.priority.desc(), Lead.created_at.asc()).limit(remaining).all()
+
+        if DIGEST_MODE and drafts:
+            enqueue_digest(db, drafts)
+        else:
+            for lead in drafts:
+                with tracing.span("telegram.enqueue", key=lead.maps_url, lead_id=lead.id):
+                    enqueue_lead(db, lead)
         
         db.commit()
-        return sent_count
+        return len(drafts)
     except Exception as e:
         logger.error(f"Queue processing error: {e}")
         db.rollback()
         return 0
+
+def _give_up_on_leads(db, row: OutboxMessage):
+    """
+    A message that will never go out: its leads leave QUEUED for NEEDS_REVIEW
+    so they don't sit queued forever and stop counting against the daily budget.
+    """
+    lead_ids = [row.lead_id]
+    if row.kind == "DIGEST":
+        digest = db.query(TelegramDigest).filter(
+            TelegramDigest.id == int(row.idempotency_key.split(":")[1])).first()
+        if digest:
+            lead_ids = json.loads(digest.lead_ids)
+    for lead in db.query(Lead).filter(Lead.id.in_(lead_ids), Lead.state == 'QUEUED'):
+        lead.is_queued = False
+        lead.state = 'NEEDS_REVIEW'
+
+async def _deliver_lead_messages(db, rows: List[OutboxMessage], sender) -> int:
+    """
+    Delivers one lead's messages in order, committing after each delivery.
+    Leads run concurrently on one session, so each row is only changed
+    after its send returns, with no await before the commit: every commit
+    then carries exactly one row's outcome, never another lead's.
+    """
+    delivered = 0
+    for row in rows:
+        payload = json.loads(row.payload)
+        attempt = (row.attempts or 0) + 1
+        with tracing.span("telegram.send", key=f"lead:{row.lead_id}", attempt=attempt) as attrs:
+            sent = await sender.send_message(TELEGRAM_CHAT_ID, payload["text"], payload.get("reply_markup"))
+            attrs["ok"] = sent
+        row.attempts = attempt
+        if sent:
+            row.status = 'SENT'
+            row.sent_at = datetime.utcnow()
+            row.last_error = None
+            delivered += 1
+        else:
+            row.last_error = "send failed"
+            if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                row.status = 'FAILED'
+                logger.error(f"Giving up on outbox message {row.idempotency_key} after {row.attempts} attempts")
+                _give_up_on_leads(db, row)
+        try:
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        if row.status != 'SENT':
+            break  # keep per-lead order; retry the rest on the next pass
+    return delivered
+
+async def drain_outbox(db, limit: int = 50) -> int:
+    """Delivers pending outbox messages. Returns how many were delivered."""
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        logger.error("Telegram credentials missing in .env")
+        return 0
+
+    pending = db.query(OutboxMessage).filter(OutboxMessage.status == 'PENDING') \
+        .order_by(OutboxMessage.id.asc()).limit(limit).all()
+    OUTBOX_PENDING.set(len(pending) if len(pending) < limit else
+                       db.query(OutboxMessage).filter(OutboxMessage.status == 'PENDING').count())
+    if not pending:
+        return 0
+
+    by_lead: Dict[str, List[OutboxMessage]] = {}
+    for row in pending:
+        by_lead.setdefault(row.lead_id, []).append(row)
+
+    # Leads go out concurrently; the sender's token buckets do the pacing
+    sender = get_sender(TELEGRAM_BOT_TOKEN)
+    sender.reset_stats()
+    results = await asyncio.gather(*(_deliver_lead_messages(db, rows, sender) for rows in by_lead.values()))
+    delivered = sum(results)
+
+    stats = sender.stats()
+    logger.info(f"Telegram sender: {stats['sent']} sent, {stats['failed']} failed, "
+                f"{stats['throttled']} throttled (429), waited {stats['wait_time']}s, "
+                f"p50 {stats['p50']}s, p95 {stats['p95']}s")
+    return delivered
+
+async def run_outbox_worker(poll_interval: float = OUTBOX_POLL_INTERVAL):
+    """Drains the outbox forever, independently of the discovery loop."""
+    logger.info("Telegram outbox worker started.")
+    while True:
+        db = SessionLocal()
+        try:
+            delivered = await drain_outbox(db)
+            if delivered:
+                logger.info(f"Outbox worker delivered {delivered} messages.")
+        except Exception as e:
+            logger.error(f"Outbox worker error: {e}")
+            db.rollback()
+        finally:
+            db.close()
+        await asyncio.sleep(poll_interval)
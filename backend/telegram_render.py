@@ -0,0 +1,151 @@
+import json
+import urllib.parse
+from typing import Dict, List, Optional
+from models import Lead
+from utils import normalize_phone
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram limit for message text
+DIGEST_PAGE_BUDGET = MAX_MESSAGE_LENGTH - 200  # room for the page header
+DIGEST_MAX_DRAFT_CHARS = 1200  # per draft body, so one lead can't blow a page
+
+# str.translate tables: one C-level pass instead of a per-character generator
+_MARKDOWN_V2_TABLE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+_CODE_TABLE = str.maketrans({"\\": "\\\\", "`": "\\`"})
+
+def escape_markdown_v2(text: str, is_code: bool = False) -> str:
+    """Escapes characters for Telegram MarkdownV2."""
+    if not text:
+        return ""
+    return text.translate(_CODE_TABLE if is_code else _MARKDOWN_V2_TABLE)
+
+def _mailto_link(lead: Lead) -> Optional[str]:
+    if not lead.email:
+        return None
+    subject_enc = urllib.parse.quote(lead.email_subject or "Outreach")
+    body_enc = urllib.parse.quote(lead.email_draft or "")
+    return f"mailto:{lead.email}?subject={subject_enc}&body={body_enc}"
+
+def _whatsapp_link(lead: Lead) -> Optional[str]:
+    if not lead.phone_number or lead.phone_number == "N/A":
+        return None
+    hp = normalize_phone(lead.phone_number)
+    if len(hp) < 10:
+        return None
+    msg_enc = urllib.parse.quote(lead.whatsapp_draft or "")
+    return f"https://wa.me/{hp}?text={msg_enc}"
+
+def build_telegram_messages(lead: Lead) -> List[Dict]:
+    """Renders the Email and WhatsApp draft messages (text + keyboard) for a lead."""
+    messages = []
+    
+    # Common Buttons for State Transitions (using callback_data instead of URL)
+    # format: action:lead_id
+    action_buttons = [
+        {"text": "✅ Mark Sent", "callback_data": f"sent:{lead.id}"},
+        {"text": "💬 Replied", "callback_data": f"replied:{lead.id}"}
+    ]
+
+    # 1. Email Draft if present
+    if lead.email_draft:
+        email_msg = f"📧 *EMAIL DRAFT for* {escape_markdown_v2(lead.business_name)}\n"
+        email_msg += f"📍 *Category:* {escape_markdown_v2(lead.category or 'Business')}\n"
+        email_msg += f"📧 *To:* `{escape_markdown_v2(lead.email or 'N/A')}`\n\n"
+        email_msg += f"📋 *Subject:* `{escape_markdown_v2(lead.email_subject or 'Outreach')}`\n\n"
+        email_msg += f"📝 *Copy Message \\(Tap to copy\\):*\n`{escape_markdown_v2(lead.email_draft, is_code=True)}`"
+        
+        keyboard = {"inline_keyboard": []}
+        mailto_link = _mailto_link(lead)
+        if mailto_link:
+            keyboard["inline_keyboard"].append([{"text": "📧 Open Mail App", "url": mailto_link}])
+        
+        keyboard["inline_keyboard"].append(action_buttons)
+        messages.append({"kind": "EMAIL", "text": email_msg, "reply_markup": keyboard})
+
+    # 2. WhatsApp Draft if present
+    if lead.whatsapp_draft:
+        wa_msg = f"🟢 *WHATSAPP DRAFT for* {escape_markdown_v2(lead.business_name)}\n"
+        wa_msg += f"📱 *To:* `{escape_markdown_v2(lead.phone_number or 'N/A')}`\n\n"
+        wa_msg += f"📝 *Copy Message \\(Tap to copy\\):*\n`{escape_markdown_v2(lead.whatsapp_draft, is_code=True)}`"
+        
+        keyboard = {"inline_keyboard": []}
+        wa_link = _whatsapp_link(lead)
+        if wa_link:
+            keyboard["inline_keyboard"].append([{"text": "💬 Open WhatsApp", "url": wa_link}])
+            
+        keyboard["inline_keyboard"].append(action_buttons)
+        messages.append({"kind": "WHATSAPP", "text": wa_msg, "reply_markup": keyboard})
+
+    return messages
+
+def render_lead(lead: Lead) -> str:
+    """
+    Renders the lead's Telegram messages once, when it reaches DRAFTED, and
+    stores them on the lead so queueing and delivery only do I/O.
+    """
+    lead.telegram_payload = json.dumps(build_telegram_messages(lead))
+    return lead.telegram_payload
+
+def lead_messages(lead: Lead) -> List[Dict]:
+    """The lead's pre-rendered messages (rendered on the fly for older rows)."""
+    if lead.telegram_payload:
+        return json.loads(lead.telegram_payload)
+    return build_telegram_messages(lead)
+
+def _truncate(text: str, limit: int) -> str:
+    text = text or ""
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def build_digest_section(number: int, lead: Lead) -> str:
+    """One lead's block inside a digest page (already MarkdownV2-escaped)."""
+    section = f"*{number}\\. {escape_markdown_v2(lead.business_name)}* \\- {escape_markdown_v2(lead.category or 'Business')}\n"
+    if lead.email_draft:
+        section += f"📧 `{escape_markdown_v2(lead.email or 'N/A', is_code=True)}` \\| "
+        section += f"`{escape_markdown_v2(lead.email_subject or 'Outreach', is_code=True)}`\n"
+        section += f"`{escape_markdown_v2(_truncate(lead.email_draft, DIGEST_MAX_DRAFT_CHARS), is_code=True)}`\n"
+    if lead.whatsapp_draft:
+        section += f"🟢 `{escape_markdown_v2(lead.phone_number or 'N/A', is_code=True)}`\n"
+        section += f"`{escape_markdown_v2(_truncate(lead.whatsapp_draft, DIGEST_MAX_DRAFT_CHARS), is_code=True)}`\n"
+    return section
+
+def _digest_lead_row(number: int, lead: Lead) -> List[Dict]:
+    row = []
+    mailto_link = _mailto_link(lead) if lead.email_draft else None
+    wa_link = _whatsapp_link(lead) if lead.whatsapp_draft else None
+    if mailto_link:
+        row.append({"text": f"{number} 📧", "url": mailto_link})
+    if wa_link:
+        row.append({"text": f"{number} 💬", "url": wa_link})
+    row.append({"text": f"{number} ✅ Sent", "callback_data": f"sent:{lead.id}"})
+    row.append({"text": f"{number} Replied", "callback_data": f"replied:{lead.id}"})
+    return row
+
+def build_digest_pages(digest_id: int, leads: List[Lead]) -> List[Dict]:
+    """
+    Packs lead sections into pages under the Telegram length limit.
+    Pages only ever split between leads, never inside an escape or code span.
+    """
+    groups: List[List] = [[]]
+    used = 0
+    for number, lead in enumerate(leads, start=1):
+        section = build_digest_section(number, lead)
+        if groups[-1] and used + len(section) + 1 > DIGEST_PAGE_BUDGET:
+            groups.append([])
+            used = 0
+        groups[-1].append((number, lead, section))
+        used += len(section) + 1
+
+    pages = []
+    total = len(groups)
+    for page_no, group in enumerate(groups):
+        header = f"📬 *DRAFT DIGEST* \\- {len(leads)} leads, page {page_no + 1}/{total}\n\n"
+        text = header + "\n".join(section for _, _, section in group)
+        keyboard = [_digest_lead_row(number, lead) for number, lead, _ in group]
+        nav = []
+        if page_no > 0:
+            nav.append({"text": "◀ Prev", "callback_data": f"digest:{digest_id}:{page_no - 1}"})
+        nav.append({"text": f"{page_no + 1}/{total}", "callback_data": f"digest:{digest_id}:{page_no}"})
+        if page_no < total - 1:
+            nav.append({"text": "Next ▶", "callback_data": f"digest:{digest_id}:{page_no + 1}"})
+        keyboard.append(nav)
+        pages.append({"text": text, "reply_markup": {"inline_keyboard": keyboard}})
+    return pages
@@ -0,0 +1,158 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from http_client import get_session
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+
+# Telegram Bot API limits: ~30 msg/s overall, ~1 msg/s into a single chat
+# (short bursts tolerated), 20 msg/min into a group.
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+MAX_RETRIES = 5
+DEFAULT_RETRY_AFTER = 5  # seconds, when a 429 doesn't say
+
+TELEGRAM_REQUEST_SECONDS = REGISTRY.histogram("telegram_request_seconds", "Bot API request latency", ["method"])
+TELEGRAM_429 = REGISTRY.counter("telegram_429", "Bot API calls answered with 429 Too Many Requests", ["method"])
+
+class TokenBucket:
+    """Async token bucket. `pause()` empties it for a server-imposed cooldown."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Takes one token, sleeping as needed. Returns seconds waited."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+class TelegramSender:
+    """
+    Bot API client that stays inside Telegram's rate limits.
+
+    Sends may be issued concurrently; each waits on the global bucket and
+    its chat's bucket. A 429 pauses the chat for `parameters.retry_after`
+    and the send is retried instead of dropped.
+    """
+
+    def __init__(self, token: str, api_base: str = TELEGRAM_API_BASE, global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST, max_retries: int = MAX_RETRIES):
+        self.token = token
+        self.api_base = api_base.rstrip("/")
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict[str, TokenBucket] = {}
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        if key not in self.chat_buckets:
+            self.chat_buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[key]
+
+    async def call(self, method: str, payload: Dict) -> Optional[Dict]:
+        """Calls a Bot API method within limits. Returns the `result` or None on failure."""
+        url = f"{self.api_base}/bot{self.token}/{method}"
+        chat_id = payload.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                self.wait_time += await self._chat_bucket(chat_id).acquire()
+            self.wait_time += await self.global_bucket.acquire()
+
+            started = time.monotonic()
+            try:
+                session = await get_session()
+                async with session.post(url, json=payload) as response:
+                    body = await response.json(content_type=None)
+                    elapsed = time.monotonic() - started
+                    self.latencies.append(elapsed)
+                    TELEGRAM_REQUEST_SECONDS.observe(elapsed, method=method)
+                    if response.status == 200 and body.get("ok"):
+                        self.sent += 1
+                        return body.get("result") or {}
+                    if response.status == 429:
+                        retry_after = (body.get("parameters") or {}).get("retry_after", DEFAULT_RETRY_AFTER)
+                        self.throttled += 1
+                        TELEGRAM_429.inc(method=method)
+                        logger.warning(f"Telegram 429 on {method}; retrying in {retry_after}s "
+                                       f"(attempt {attempt + 1}/{self.max_retries})")
+                        bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                        bucket.pause(retry_after)
+                        continue
+                    logger.error(f"Telegram API Error: {body}")
+                    break
+            except Exception as e:
+                logger.error(f"Telegram request failed: {e}")
+                break
+        self.failed += 1
+        return None
+
+    async def send_message(self, chat_id, text: str, reply_markup: dict = None,
+                           parse_mode: str = "MarkdownV2") -> bool:
+        payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "reply_markup": reply_markup}
+        return await self.call("sendMessage", payload) is not None
+
+    def stats(self) -> Dict:
+        """Send counts, 429s, time spent throttled and p50/p95 request latency (seconds)."""
+        latencies = sorted(self.latencies)
+        pct = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else None
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "wait_time": round(self.wait_time, 3),
+            "p50": pct(0.5),
+            "p95": pct(0.95),
+        }
+
+    def reset_stats(self):
+        self.latencies.clear()
+        self.sent = self.failed = self.throttled = 0
+        self.wait_time = 0.0
+
+_sender: Optional[TelegramSender] = None
+_sender_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_sender(token: str) -> TelegramSender:
+    """Process-wide sender so buckets persist between queue passes (one per event loop)."""
+    global _sender, _sender_loop
+    loop = asyncio.get_running_loop()
+    if _sender is None or _sender_loop is not loop or _sender.token != token:
+        _sender = TelegramSender(token)
+        _sender_loop = loop
+    return _sender
@@ -0,0 +1,61 @@
+"""
+Local stand-in for the Telegram Bot API, for tests and offline runs.
+
+Serves POST /bot<token>/<method>, records every call and answers with the
+minimal valid result for the methods this project uses.
+"""
+import itertools
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+class FakeTelegramServer:
+    def __init__(self, fail_first: int = 0, retry_after: float = 0.1):
+        self.calls = []  # (method, payload)
+        self.fail_first = fail_first  # answer the first N calls with a 429
+        self.retry_after = retry_after
+        self._message_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self._handle)
+        self.server = TestServer(self.app)
+
+    @property
+    def base_url(self) -> str:
+        return str(self.server.make_url("")).rstrip("/")
+
+    def methods(self):
+        return [method for method, _ in self.calls]
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+        self.calls.append((method, payload))
+
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                 "parameters": {"retry_after": self.retry_after}},
+                status=429,
+            )
+
+        if method == "sendMessage":
+            result = {
+                "message_id": next(self._message_ids),
+                "date": 0,
+                "chat": {"id": int(payload.get("chat_id", 0)), "type": "private"},
+                "text": payload.get("text", ""),
+            }
+        else:
+            # setWebhook, deleteWebhook, answerCallbackQuery, editMessageText ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
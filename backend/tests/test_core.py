@@ -1,11 +1,21 @@
+import os
+import tempfile
+
+# Before any backend import: ai_agent opens its quota ledger and generation cache on import
+_TEST_DATA_DIR = tempfile.mkdtemp(prefix="outreach-tests-")
+os.environ["QUOTA_DB_FILE"] = os.path.join(_TEST_DATA_DIR, "quota.db")
+os.environ["GENERATION_CACHE_FILE"] = os.path.join(_TEST_DATA_DIR, "generation_cache.db")
+
 import pytest
 from unittest.mock import MagicMock, patch
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from models import Base, Lead
 from database import save_lead
-import os
+from llm_providers import LLMProvider, ProviderRouter, StubProvider
 import json
+import time
+import asyncio
 
 # Setup in-memory SQLite for testing
 @pytest.fixture
@@ -17,6 +27,24 @@ def db_session():
     yield session
     session.close()
 
+@pytest.fixture(autouse=True)
+def ledger(tmp_path):
+    """Points ai_agent at a throwaway quota ledger."""
+    import ai_agent
+    from quota_ledger import QuotaLedger
+    test_ledger = QuotaLedger(str(tmp_path / "quota.db"))
+    with patch.object(ai_agent, "ledger", test_ledger):
+        yield test_ledger
+
+@pytest.fixture(autouse=True)
+def generation_cache(tmp_path):
+    """Points ai_agent at a throwaway generation cache."""
+    import ai_agent
+    from generation_cache import GenerationCache
+    test_cache = GenerationCache(str(tmp_path / "generation_cache.db"))
+    with patch.object(ai_agent, "generation_cache", test_cache):
+        yield test_cache
+
 # --- DATABASE TESTS ---
 
 def test_lead_uniqueness(db_session):
@@ -47,50 +75,1286 @@ def test_lead_upsert_updates_fields(db_session):
     assert lead.business_name == "New Name"
     assert lead.phone_number == "222"
 
+def test_apply_action_sets_state_timestamps_and_funnel(db_session):
+    """The shared lead-actions service used by the API and the bot."""
+    from funnel import funnel_summary
+    from lead_actions import apply_action
+    lead = save_lead(db_session, {"name": "Biz", "maps_url": "https://maps/act"})
+    
+    assert apply_action(db_session, lead.id, "sent") == "Biz"
+    db_session.refresh(lead)
+    assert lead.state == "SENT" and lead.sent_at == lead.last_interaction_at
+    
+    assert apply_action(db_session, lead.id, "replied") == "Biz"
+    db_session.refresh(lead)
+    assert lead.state == "REPLIED" and lead.last_interaction_at >= lead.sent_at
+    assert funnel_summary(db_session)["current"] == {"REPLIED": 1}
+    
+    assert apply_action(db_session, "missing-id", "closed") is None
+    with pytest.raises(ValueError):
+        apply_action(db_session, lead.id, "deleted")
+
+def test_bulk_actions_are_idempotent(db_session):
+    """One transaction, per-item results, and replays never move a lead backwards."""
+    from datetime import datetime, timedelta
+    from lead_actions import apply_actions
+    a = save_lead(db_session, {"name": "A", "maps_url": "https://maps/bulk-a", "state": "QUEUED"})
+    b = save_lead(db_session, {"name": "B", "maps_url": "https://maps/bulk-b", "state": "QUEUED"})
+    t0 = datetime(2026, 1, 5, 9, 0)
+    items = [
+        {"lead_id": b.id, "action": "replied", "at": t0 + timedelta(hours=2)},
+        {"lead_id": a.id, "action": "sent", "at": t0},
+        {"lead_id": b.id, "action": "sent", "at": t0 + timedelta(hours=1)},
+        {"lead_id": "missing", "action": "sent", "at": t0},
+        {"lead_id": a.id, "action": "archive", "at": t0},
+    ]
+    
+    results = apply_actions(db_session, items)
+    assert [r["status"] for r in results] == ["updated", "updated", "updated", "not_found", "invalid"]
+    db_session.refresh(a)
+    db_session.refresh(b)
+    assert (a.state, a.sent_at) == ("SENT", t0)
+    assert (b.state, b.sent_at, b.last_interaction_at) == ("REPLIED", t0 + timedelta(hours=1), t0 + timedelta(hours=2))
+    
+    # A client retrying the same batch changes nothing
+    results = apply_actions(db_session, items)
+    assert [r["status"] for r in results[:3]] == ["unchanged"] * 3
+    db_session.refresh(b)
+    assert b.state == "REPLIED"
+
+@pytest.mark.asyncio
+async def test_bulk_sent_replayed_after_maintenance_is_unchanged(db_session):
+    """The discovery loop moves SENT on to WAITING; a retried "sent" must not bring it back."""
+    from datetime import datetime, timedelta
+    from lead_actions import apply_actions
+    from main import maintain_lead_states
+    from models import FunnelCount
+    lead = save_lead(db_session, {"name": "A", "maps_url": "https://maps/replay", "state": "QUEUED"})
+    sent_at = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    items = [{"lead_id": lead.id, "action": "sent", "at": sent_at}]
+    assert apply_actions(db_session, items)[0]["status"] == "updated"
+    await maintain_lead_states(db_session)
+    db_session.refresh(lead)
+    assert lead.state == "WAITING"
+
+    assert apply_actions(db_session, items)[0]["status"] == "unchanged"
+    db_session.refresh(lead)
+    assert (lead.state, lead.sent_at) == ("WAITING", sent_at)
+    assert sum(c.entered for c in db_session.query(FunnelCount).filter(FunnelCount.state == "SENT")) == 1
+
+    # A follow-up re-queued the lead: only a newer "sent" counts
+    lead.state = "QUEUED"
+    db_session.commit()
+    assert apply_actions(db_session, items)[0]["status"] == "unchanged"
+
+# --- FUNNEL ANALYTICS TESTS ---
+
+def test_funnel_aggregates_follow_state_transitions(db_session):
+    """ORM changes and lead actions both keep the aggregates in step with the leads table."""
+    from datetime import datetime, timedelta
+    from funnel import funnel_summary, rebuild_funnel
+    from lead_actions import apply_action, apply_actions
+    a = save_lead(db_session, {"name": "A", "maps_url": "https://maps/f-a", "niche": "healthcare", "city": "Abuja"})
+    b = save_lead(db_session, {"name": "B", "maps_url": "https://maps/f-b", "niche": "beauty", "city": "Lagos"})
+    a.state = "DRAFTED"
+    db_session.commit()
+    
+    sent_at = datetime.utcnow() - timedelta(hours=3)
+    apply_action(db_session, a.id, "sent", at=sent_at)
+    apply_actions(db_session, [{"lead_id": a.id, "action": "replied", "at": sent_at + timedelta(hours=2)}])
+    
+    summary = funnel_summary(db_session)
+    assert summary["current"] == {"DISCOVERED": 1, "REPLIED": 1}
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    assert summary["daily"][today]["DISCOVERED"] == 2
+    assert summary["daily"][today]["DRAFTED"] == 1
+    assert summary["reply_latency_hours"]["4h"] == 1
+    assert funnel_summary(db_session, city="Lagos")["current"] == {"DISCOVERED": 1}
+    
+    # A full rebuild from the leads table agrees on the current snapshot
+    rebuild_funnel(db_session)
+    rebuilt = funnel_summary(db_session)
+    assert rebuilt["current"] == summary["current"]
+    assert rebuilt["reply_latency_hours"] == summary["reply_latency_hours"]
+
+def test_concurrent_actions_on_one_lead_move_it_once(shared_db):
+    """Actions racing on the same lead from several threads leave it counted in exactly one state."""
+    from concurrent.futures import ThreadPoolExecutor
+    from funnel import funnel_summary
+    from lead_actions import _apply_in_session
+    db = shared_db()
+    lead = save_lead(db, {"name": "Race", "maps_url": "https://maps/race", "niche": "beauty", "city": "Lagos"})
+    lead.state = "DRAFTED"
+    db.commit()
+    
+    actions = ["sent", "replied", "closed", "sent"] * 5
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(lambda action: _apply_in_session(lead.id, action, None), actions)) == {"Race"}
+    
+    db.expire_all()
+    state = db.query(Lead).one().state
+    assert funnel_summary(db)["current"] == {state: 1}
+    db.close()
+
+def test_concurrent_bulk_actions_on_one_lead_move_it_once(shared_db):
+    """Bulk batches racing each other and single actions on one lead keep the funnel in step."""
+    from concurrent.futures import ThreadPoolExecutor
+    from funnel import funnel_summary
+    from lead_actions import _apply_in_session, _apply_many_in_session
+    db = shared_db()
+    lead = save_lead(db, {"name": "Bulk Race", "maps_url": "https://maps/bulk-race", "niche": "beauty", "city": "Lagos"})
+    lead.state = "DRAFTED"
+    db.commit()
+    
+    def act(action):
+        if action == "sent":
+            return _apply_in_session(lead.id, action, None)
+        return _apply_many_in_session([{"lead_id": lead.id, "action": action}])[0]["status"]
+    
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(act, ["sent", "replied", "closed", "replied"] * 5))
+    
+    db.expire_all()
+    state = db.query(Lead).one().state
+    assert funnel_summary(db)["current"] == {state: 1}
+    db.close()
+
+# --- EXPORT TESTS ---
+
+def test_export_keyset_pages_cover_every_lead_once(db_session):
+    """Leads sharing a created_at are still paged exactly once, in every format."""
+    import io
+    import csv as _csv
+    from datetime import datetime
+    from export import iter_lead_batches, iter_ndjson, iter_csv
+    same_time = datetime(2026, 3, 1, 12, 0)
+    for i in range(7):
+        state = "SENT" if i % 2 else "DRAFTED"
+        db_session.add(Lead(business_name=f"Clinic {i}", category="Dental clinic", maps_url=f"https://maps/x{i}",
+                            state=state, created_at=same_time if i < 5 else datetime(2026, 3, 2)))
+    db_session.add(Lead(business_name="Bakery", category="Bakery", maps_url="https://maps/bakery"))
+    db_session.commit()
+    
+    batches = list(iter_lead_batches(db_session, category="dental", batch_size=2))
+    assert [len(b) for b in batches] == [2, 2, 2, 1]
+    ids = [row["id"] for batch in batches for row in batch]
+    assert len(set(ids)) == 7
+    
+    sent = list(iter_lead_batches(db_session, states=["SENT"], since=datetime(2026, 3, 1), batch_size=2))
+    assert sum(len(b) for b in sent) == 3
+    
+    lines = b"".join(iter_ndjson(iter_lead_batches(db_session, batch_size=3))).decode().splitlines()
+    assert len(lines) == 8 and json.loads(lines[0])["created_at"].startswith("2026-03-01")
+    rows = list(_csv.DictReader(io.StringIO(b"".join(iter_csv(iter_lead_batches(db_session, batch_size=3))).decode())))
+    assert len(rows) == 8 and rows[-1]["business_name"] == "Bakery"
+
+def test_export_parquet_writes_one_row_group_per_batch(db_session):
+    pq = pytest.importorskip("pyarrow.parquet")
+    import io
+    from export import iter_lead_batches, iter_parquet
+    for i in range(5):
+        save_lead(db_session, {"name": f"Biz {i}", "maps_url": f"https://maps/pq{i}"})
+    
+    data = b"".join(iter_parquet(iter_lead_batches(db_session, batch_size=2)))
+    parquet = pq.ParquetFile(io.BytesIO(data))
+    assert parquet.metadata.num_row_groups == 3
+    table = parquet.read()
+    assert table.num_rows == 5 and str(table.schema.field("created_at").type) == "timestamp[us]"
+
 # --- AI AGENT TESTS ---
 
-@patch("ai_agent.get_daily_usage")
-@patch("ai_agent.increment_usage")
-@patch("ai_agent.call_gemini_api")
-def test_gemini_key_rotation(mock_call, mock_increment, mock_usage):
+class ScriptedProvider(LLMProvider):
+    """Test provider that returns canned responses (or raises) in order."""
+    def __init__(self, name, responses, daily_limit=25):
+        super().__init__(name, "scripted", name, daily_limit)
+        self.responses = list(responses)
+        self.calls = 0
+
+    def complete(self, prompt):
+        self.calls += 1
+        response = self.responses[min(self.calls, len(self.responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return json.dumps(response), 40
+
+def use_providers(*providers):
+    """Routes ai_agent through the given providers only."""
+    import ai_agent
+    return patch.object(ai_agent, "router", ProviderRouter(list(providers), has_quota=ai_agent.has_quota))
+
+def test_gemini_key_rotation(ledger):
     """Tests that the agent tries the next key if the first one fails or is exhausted."""
     from ai_agent import generate_message
-    import ai_agent
-    
-    # Setup two mock keys
-    ai_agent.GEMINI_KEYS = ["KEY_A", "KEY_B"]
-    
-    # Mock usage: KEY_A is exhausted (25/25), KEY_B is fresh
-    mock_usage.return_value = {
-        "keys": {"0": 25, "1": 0},
-        "date": "2026-02-23"
-    }
     
-    # Mock behavior: If key is KEY_B, return success. key_index is not passed to call_gemini_api, 
-    # but the loop in generate_message will try key 1 because key 0 is exhausted.
-    mock_call.return_value = {"message": "Success from Key B"}
+    # KEY_A is exhausted (25/25), KEY_B is fresh
+    key_a = ScriptedProvider("0", [{"message": "Success from Key A"}])
+    key_b = ScriptedProvider("1", [{"message": "Success from Key B"}])
+    for _ in range(25):
+        ledger.reserve("0", 25)
     
     lead_data = {"name": "Test", "category": "Clinic", "city": "Abuja"}
-    result = generate_message(lead_data, channel="WHATSAPP")
+    with use_providers(key_a, key_b):
+        result = generate_message(lead_data, channel="WHATSAPP")
     
     assert result is not None
     assert result["message"] == "Success from Key B"
-    # Verify that increment_usage was called for the SECOND key (index 1)
-    mock_increment.assert_called_once_with(1)
+    # Verify that usage was charged to the SECOND key (index 1) only
+    assert key_a.calls == 0
+    assert ledger.key_counts() == {"0": 25, "1": 1}
+    assert ledger.channel_counts() == {"WHATSAPP": 1}
 
-@patch("ai_agent.GEMINI_KEYS", ["MOCK_KEY"])
-@patch("ai_agent.call_gemini_api")
-def test_needs_review_on_total_failure(mock_call):
+@patch("ai_agent.time.sleep")
+def test_needs_review_on_total_failure(mock_sleep, ledger):
     """Verifies that if all AI attempts fail, it returns None (to signal NEEDS_REVIEW)."""
     from ai_agent import generate_message
     
     # Mock all API calls as failing
-    mock_call.return_value = None
+    failing = ScriptedProvider("0", [RuntimeError("500 INTERNAL")])
     
     lead_data = {"name": "Test", "category": "Clinic", "city": "Abuja"}
-    result = generate_message(lead_data, channel="WHATSAPP")
+    with use_providers(failing):
+        result = generate_message(lead_data, channel="WHATSAPP")
     
     assert result is None
+    # The failed attempt must not burn quota
+    assert ledger.key_counts() == {"0": 0}
+
+def test_generation_cache_skips_quota_on_redraft(ledger, generation_cache):
+    """A redraft of the same lead is served from cache unless forced."""
+    from ai_agent import generate_message
+    
+    provider = ScriptedProvider("0", [{"message": "Hi there"}, {"message": "Fresh take"}])
+    lead_data = {"name": "Test", "category": "Clinic", "city": "Abuja"}
+    
+    with use_providers(provider):
+        first = generate_message(lead_data, channel="WHATSAPP")
+        second = generate_message(lead_data, channel="WHATSAPP")
+        assert first == second == {"message": "Hi there"}
+        assert provider.calls == 1
+        assert ledger.key_counts() == {"0": 1}
+        
+        stats = generation_cache.stats()
+        assert stats["hits"] == 1 and stats["tokens_saved"] == 40
+        
+        assert generate_message(lead_data, channel="WHATSAPP", force=True) == {"message": "Fresh take"}
+        assert provider.calls == 2
+
+def test_stub_drafts_are_never_cached(ledger, generation_cache):
+    """Offline stub text must not be served from cache to a later real provider."""
+    from ai_agent import generate_message
+    lead_data = {"name": "Test", "category": "Clinic", "city": "Abuja"}
+    with use_providers(StubProvider()):
+        assert "stub draft" in generate_message(lead_data, channel="WHATSAPP")["message"]
+    assert generation_cache.stats()["entries"] == 0
+    
+    provider = ScriptedProvider("0", [{"message": "Real draft"}])
+    with use_providers(provider):
+        assert generate_message(lead_data, channel="WHATSAPP") == {"message": "Real draft"}
+    assert provider.calls == 1
+
+@pytest.mark.asyncio
+async def test_second_follow_up_is_a_new_draft(db_session, ledger, generation_cache):
+    """Follow-up #2 falls inside the cache TTL of #1 but must not repeat it."""
+    from datetime import datetime, timedelta
+    import telegram_queue
+    from main import maintain_lead_states
+    from models import OutboxMessage
+    provider = ScriptedProvider("0", [{"message": "Nudge one"}, {"message": "Nudge two"}])
+    lead = save_lead(db_session, {"name": "Sunrise Dental", "maps_url": "https://maps/nudge", "category": "Dental clinic",
+                                  "city": "Abuja", "primary_channel": "WHATSAPP", "state": "NO_REPLY"})
+    drafts = []
+    with use_providers(provider), patch.object(telegram_queue, "TELEGRAM_BOT_TOKEN", "T"), \
+            patch.object(telegram_queue, "TELEGRAM_CHAT_ID", "1"):
+        for _ in range(2):
+            lead.state = "NO_REPLY"
+            lead.last_interaction_at = datetime.utcnow() - timedelta(days=6)
+            db_session.commit()
+            await maintain_lead_states(db_session)
+            drafts.append(lead.whatsapp_draft)
+            assert await telegram_queue.process_telegram_queue(db_session) == 1
+
+    assert drafts == ["Nudge one", "Nudge two"] and provider.calls == 2
+    payloads = [json.loads(row.payload)["text"] for row in db_session.query(OutboxMessage).order_by(OutboxMessage.id)]
+    assert any("Nudge one" in p for p in payloads) and any("Nudge two" in p for p in payloads)
+
+@patch("ai_agent.time.sleep")
+def test_router_prefers_fastest_healthy_provider(mock_sleep, ledger):
+    """Slow or failing providers drop down the order; the stub drafts offline."""
+    from ai_agent import generate_message
+    flaky = ScriptedProvider("flaky", [RuntimeError("timeout")])
+    stub = StubProvider()
+    
+    with use_providers(flaky, stub) as router:
+        router.record(stub, 0.2, ok=True)
+        for _ in range(4):
+            router.record(flaky, 0.1, ok=False)
+        assert router.candidates() == [stub, flaky]
+        
+        lead_data = {"name": "Test", "category": "Clinic", "city": "Abuja"}
+        result = generate_message(lead_data, channel="EMAIL")
+        assert result == generate_message(lead_data, channel="EMAIL", force=True)
+        assert "stub draft" in result["message"]
+        assert flaky.calls == 0
+        
+        stats = router.stats()
+        assert stats["flaky"]["error_rate"] == 1.0 and not stats["flaky"]["healthy"]
+        assert stats["stub"]["samples"] == 3 and stats["stub"]["p95"] is not None
+
+def test_generation_cache_ttl_and_lru(tmp_path):
+    """Expired entries miss; overflow evicts the least recently used entry."""
+    from generation_cache import GenerationCache
+    cache = GenerationCache(str(tmp_path / "c.db"), ttl=100, max_entries=2)
+    with patch("generation_cache.time.time", return_value=1000):
+        cache.put("a", "m", "EMAIL", {"message": "a"})
+        cache.put("b", "m", "EMAIL", {"message": "b"})
+    with patch("generation_cache.time.time", return_value=1010):
+        assert cache.get("a") == {"message": "a"}  # a is now most recent
+        cache.put("c", "m", "EMAIL", {"message": "c"})
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+    with patch("generation_cache.time.time", return_value=1200):
+        assert cache.get("c") is None
+
+# --- NICHE CLASSIFIER TESTS ---
+
+def test_niche_classifier_matches_keywords_on_word_boundaries():
+    from niches import NicheClassifier
+    classifier = NicheClassifier.from_file("Peter", "Anchor Digitals")
+    assert classifier.classify("Dental clinic") == "healthcare"
+    assert classifier.classify("Hairdresser") == "personal_care"
+    assert classifier.classify("Office chair supplier") is None
+    assert classifier.classify("Fast food restaurant") == "food_beverage"
+    # The listing's category outweighs the query it was found under
+    assert classifier.classify("Bakery", query="Clinics in Abuja") == "food_beverage"
+    assert classifier.classify("", query="Wedding photographers in Abuja") == "events"
+
+def test_compact_niche_prompt_is_used_and_shorter():
+    from ai_agent import build_prompt, build_email_prompt
+    lead_data = {"name": "Sunrise Dental", "category": "Dental clinic", "city": "Abuja", "rating": "4.5"}
+    prompt = build_prompt(lead_data, "EMAIL")
+    assert "Sunrise Dental" in prompt and "appointment reminders" in prompt
+    assert len(prompt) < len(build_email_prompt(lead_data))
+    assert build_prompt(lead_data, "EMAIL") == prompt  # deterministic for the cache
+    # Unknown niches fall back to the generic prompt
+    assert build_prompt({"name": "X", "category": "Law firm"}, "EMAIL") == build_email_prompt({"name": "X", "category": "Law firm"})
+
+# --- GENERATION QUEUE TESTS ---
+
+def test_score_lead_prefers_established_reachable_businesses():
+    from utils import score_lead
+    strong = {"rating": "4.8", "reviews": "(1,203)", "website": "https://a.ng", "email": "a@a.ng", "category": "Dental clinic"}
+    weak = {"rating": "3.1", "reviews": "(2)", "website": "", "category": "Car wash"}
+    assert score_lead(strong) > score_lead(weak)
+    assert score_lead({}) == 0
+
+def test_generation_queue_spends_quota_on_best_leads_first(db_session):
+    """With quota for one lead only, the best lead is drafted and the rest deferred."""
+    from generation_queue import process_generation_queue, PENDING_STATE
+    for i, (rating, reviews) in enumerate([("3.0", "(1)"), ("4.9", "(900)"), ("4.0", "(20)")]):
+        save_lead(db_session, {
+            "name": f"Biz {i}", "maps_url": f"https://maps/{i}", "phone": "08031234567",
+            "rating": rating, "reviews": reviews, "city": "Lagos", "state": PENDING_STATE
+        })
+    
+    budget = {"left": 1}
+    def fake_generate(lead_data, channel):
+        assert lead_data["city"] == "Lagos"  # deferred drafts keep the scraped city, not the "Abuja" default
+        budget["left"] -= 1
+        return {"message": f"Hi {lead_data['name']}"}
+    
+    with patch("generation_queue.generate_message", side_effect=fake_generate), \
+         patch("generation_queue.remaining_quota", side_effect=lambda: budget["left"]):
+        drafted, messages = process_generation_queue(db_session)
+    
+    assert (drafted, messages) == (1, 1)
+    states = {l.business_name: l.state for l in db_session.query(Lead).all()}
+    assert states == {"Biz 0": PENDING_STATE, "Biz 1": "DRAFTED", "Biz 2": PENDING_STATE}
+
+# --- QUOTA LEDGER TESTS ---
+
+def test_quota_ledger_never_overspends_across_instances(tmp_path):
+    """Two ledgers on the same file (two processes) share one daily limit."""
+    from quota_ledger import QuotaLedger
+    path = str(tmp_path / "quota.db")
+    a, b = QuotaLedger(path), QuotaLedger(path)
+    
+    granted = [l.reserve("0", 3, "EMAIL") for l in (a, b, a, b, a)]
+    assert granted == [True, True, True, False, False]
+    assert a.key_counts() == {"0": 3}
+    
+    b.release("0", "EMAIL")
+    assert a.reserve("0", 3, "WHATSAPP") is True
+    a.record_tokens("0", 120, "WHATSAPP")
+    
+    snap = b.snapshot()
+    assert snap["keys"] == {"0": 3}
+    assert snap["channels"] == {"EMAIL": 2, "WHATSAPP": 1}
+    assert snap["tokens"] == {"0": 120}
+
+def test_quota_ledger_rolls_over_by_date(tmp_path):
+    """Counts are per calendar day; the cache does not leak yesterday's numbers."""
+    import quota_ledger
+    ledger = quota_ledger.QuotaLedger(str(tmp_path / "quota.db"))
+    with patch("quota_ledger.today", return_value="2026-01-01"):
+        assert ledger.reserve("0", 1) is True
+        assert ledger.reserve("0", 1) is False
+        assert ledger.key_counts() == {"0": 1}
+    with patch("quota_ledger.today", return_value="2026-01-02"):
+        assert ledger.key_counts() == {}
+        assert ledger.reserve("0", 1) is True
+
+# --- HTTP CLIENT TESTS ---
+
+@pytest.mark.asyncio
+async def test_shared_http_session_is_reused_until_closed():
+    from http_client import get_session, close_session
+    first = await get_session()
+    assert await get_session() is first
+    assert first.connector.limit_per_host > 0
+    await close_session()
+    assert first.closed
+    second = await get_session()
+    assert second is not first
+    await close_session()
+
+# --- TELEGRAM SENDER TESTS ---
+
+@pytest.mark.asyncio
+async def test_telegram_sender_honours_retry_after():
+    """A 429 pauses the chat for retry_after and the message is resent, not dropped."""
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from telegram_sender import TelegramSender
+    from http_client import close_session
+    
+    received = []
+    async def send_message(request):
+        received.append(await request.json())
+        if len(received) == 1:
+            return web.json_response({"ok": False, "error_code": 429, "parameters": {"retry_after": 0.2}}, status=429)
+        return web.json_response({"ok": True, "result": {"message_id": len(received)}})
+    
+    app = web.Application()
+    app.router.add_post("/botTOKEN/sendMessage", send_message)
+    async with TestServer(app) as server:
+        sender = TelegramSender("TOKEN", api_base=str(server.make_url("")), chat_rate=50, chat_burst=50)
+        started = time.monotonic()
+        results = await asyncio.gather(*(sender.send_message("42", f"msg {i}") for i in range(3)))
+        elapsed = time.monotonic() - started
+    await close_session()
+    
+    assert results == [True, True, True]
+    assert len(received) == 4
+    assert elapsed >= 0.2
+    stats = sender.stats()
+    assert stats["sent"] == 3 and stats["throttled"] == 1 and stats["failed"] == 0
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_to_rate():
+    from telegram_sender import TokenBucket
+    bucket = TokenBucket(rate=20, capacity=1)
+    started = time.monotonic()
+    for _ in range(5):
+        await bucket.acquire()
+    # 1 immediate + 4 refills at 20/s
+    assert time.monotonic() - started >= 0.19
+
+# --- TELEGRAM OUTBOX TESTS ---
+
+class FakeSender:
+    """Stands in for TelegramSender; fails the sends listed in `fail_on`."""
+    def __init__(self, fail_on=()):
+        self.sent = []
+        self.fail_on = set(fail_on)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if len(self.sent) in self.fail_on:
+            self.fail_on.discard(len(self.sent))
+            return False
+        self.sent.append(text)
+        return True
+
+    def reset_stats(self):
+        pass
+
+    def stats(self):
+        return {"sent": len(self.sent), "failed": 0, "throttled": 0, "wait_time": 0, "p50": None, "p95": None}
+
+@pytest.mark.asyncio
+async def test_outbox_delivers_once_and_resumes_after_failure(db_session):
+    """Delivered messages are committed individually and never resent."""
+    import telegram_queue
+    from models import OutboxMessage
+    lead = save_lead(db_session, {
+        "name": "Biz", "maps_url": "https://maps/outbox", "phone": "08031234567", "website": "https://biz.ng",
+        "email": "hi@biz.ng", "email_draft": "Hello", "email_subject": "Hi", "whatsapp_draft": "Hey", "state": "DRAFTED"
+    })
+    
+    with patch.object(telegram_queue, "TELEGRAM_BOT_TOKEN", "T"), patch.object(telegram_queue, "TELEGRAM_CHAT_ID", "1"):
+        assert await telegram_queue.process_telegram_queue(db_session) == 1
+        assert lead.state == "QUEUED"
+        # Enqueueing again is a no-op thanks to the idempotency key
+        assert telegram_queue.enqueue_lead(db_session, lead) == 0
+        
+        # The WhatsApp send fails on the first pass
+        sender = FakeSender(fail_on={1})
+        with patch.object(telegram_queue, "get_sender", return_value=sender):
+            assert await telegram_queue.drain_outbox(db_session) == 1
+            statuses = [r.status for r in db_session.query(OutboxMessage).order_by(OutboxMessage.id)]
+            assert statuses == ["SENT", "PENDING"]
+            
+            assert await telegram_queue.drain_outbox(db_session) == 1
+            assert await telegram_queue.drain_outbox(db_session) == 0
+    
+    assert len(sender.sent) == 2
+    assert "EMAIL DRAFT" in sender.sent[0] and "WHATSAPP DRAFT" in sender.sent[1]
+
+@pytest.mark.asyncio
+async def test_outbox_gives_up_on_a_lead_without_holding_up_the_rest(db_session):
+    """A lead whose message fails for good leaves QUEUED; the other lead in the same pass still goes out."""
+    import telegram_queue
+    from models import OutboxMessage
+    for name in ("Good", "Broken"):
+        save_lead(db_session, {"name": name, "maps_url": f"https://maps/{name}", "phone": "08031234567",
+                               "whatsapp_draft": f"Hi {name}", "state": "DRAFTED"})
+    
+    class PickySender(FakeSender):
+        async def send_message(self, chat_id, text, reply_markup=None):
+            return "Broken" not in text and await super().send_message(chat_id, text, reply_markup)
+    
+    sender = PickySender()
+    with patch.object(telegram_queue, "TELEGRAM_BOT_TOKEN", "T"), patch.object(telegram_queue, "TELEGRAM_CHAT_ID", "1"), \
+            patch.object(telegram_queue, "get_sender", return_value=sender):
+        assert await telegram_queue.process_telegram_queue(db_session) == 2
+        assert telegram_queue.remaining_daily_budget(db_session) == telegram_queue.DAILY_SENT_LIMIT - 2
+        for _ in range(telegram_queue.OUTBOX_MAX_ATTEMPTS):
+            await telegram_queue.drain_outbox(db_session)
+    
+    assert len(sender.sent) == 1
+    broken = db_session.query(Lead).filter_by(business_name="Broken").one()
+    assert (broken.state, broken.is_queued) == ("NEEDS_REVIEW", False)
+    assert db_session.query(Lead).filter_by(business_name="Good").one().state == "QUEUED"
+    assert sorted(r.status for r in db_session.query(OutboxMessage)) == ["FAILED", "SENT"]
+    assert telegram_queue.remaining_daily_budget(db_session) == telegram_queue.DAILY_SENT_LIMIT - 1
+    
+    # Redrafted and sent back to the queue after review, the new text goes out
+    broken.whatsapp_draft = "Hello again"
+    broken.state = "DRAFTED"
+    db_session.commit()
+    assert await telegram_queue.process_telegram_queue(db_session) == 1
+    row = db_session.query(OutboxMessage).filter_by(lead_id=broken.id).one()
+    assert (row.status, row.attempts, row.last_error) == ("PENDING", 0, None)
+    assert "Hello again" in json.loads(row.payload)["text"]
+
+@pytest.mark.asyncio
+async def test_digest_mode_packs_leads_into_paginated_messages(db_session):
+    """Many leads become one outbox message; pages stay under the length limit."""
+    import telegram_queue
+    from models import OutboxMessage
+    from telegram_render import MAX_MESSAGE_LENGTH
+    for i in range(15):
+        save_lead(db_session, {
+            "name": f"Biz {i}.", "maps_url": f"https://maps/d{i}", "phone": "08031234567",
+            "whatsapp_draft": "Hi! " + "x" * 500, "state": "DRAFTED"
+        })
+    
+    with patch.object(telegram_queue, "DIGEST_MODE", True):
+        assert await telegram_queue.process_telegram_queue(db_session) == 15
+    
+    rows = db_session.query(OutboxMessage).all()
+    assert [r.kind for r in rows] == ["DIGEST"]
+    digest_id = int(rows[0].idempotency_key.split(":")[1])
+    
+    pages = []
+    page_no = 0
+    while (page := telegram_queue.get_digest_page(db_session, digest_id, page_no)) is not None:
+        pages.append(page)
+        page_no += 1
+    assert len(pages) > 1
+    assert all(len(p["text"]) <= MAX_MESSAGE_LENGTH for p in pages)
+    assert "Biz 0\\." in pages[0]["text"]  # escaped, and never split mid-lead
+    lead_rows = sum(len(p["reply_markup"]["inline_keyboard"]) - 1 for p in pages)
+    assert lead_rows == 15
+    assert pages[1]["reply_markup"]["inline_keyboard"][-1][0]["callback_data"] == f"digest:{digest_id}:0"
+
+# --- TELEGRAM WEBHOOK TESTS ---
+
+@pytest.fixture
+def shared_db(tmp_path):
+    """File-backed DB for code that opens its own sessions from worker threads."""
+    import lead_actions
+    engine = create_engine(f"sqlite:///{tmp_path / 'shared.db'}")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with patch.object(lead_actions, "SessionLocal", Session):
+        yield Session
+
+@pytest.mark.asyncio
+async def test_webhook_update_applies_action_and_checks_secret(shared_db):
+    """Callback updates posted to the FastAPI app run the bot handlers in-process."""
+    import httpx
+    import telegram_bot
+    from fastapi import FastAPI
+    from action_api import mount_telegram_webhook
+    from tests.fake_telegram import FakeTelegramServer
+    
+    db = shared_db()
+    lead = save_lead(db, {"name": "Biz", "maps_url": "https://maps/hook", "state": "DRAFTED"})
+    update = {
+        "update_id": 1,
+        "callback_query": {
+            "id": "cb1", "chat_instance": "ci", "data": f"sent:{lead.id}",
+            "from": {"id": 7, "is_bot": False, "first_name": "Op"},
+            "message": {"message_id": 5, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "EMAIL DRAFT"},
+        },
+    }
+    app = FastAPI()
+    mount_telegram_webhook(app)
+    
+    async with FakeTelegramServer() as server:
+        test_bot = telegram_bot.create_bot("123456:TEST", api_base=server.base_url)
+        with patch.object(telegram_bot, "bot", test_bot), patch.object(telegram_bot, "WEBHOOK_SECRET", "s3cret"):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+                response = await client.post(telegram_bot.WEBHOOK_PATH, json=update, headers=headers)
+                assert response.status_code == 403
+                assert server.calls == []
+                # Without a secret the webhook would 403 every update: refuse to register it at all
+                with patch.object(telegram_bot, "WEBHOOK_SECRET", ""), \
+                        pytest.raises(RuntimeError, match="TELEGRAM_WEBHOOK_SECRET"):
+                    await telegram_bot.start_webhook()
+                assert server.calls == []
+                
+                headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+                response = await client.post(telegram_bot.WEBHOOK_PATH, json=update, headers=headers)
+                assert response.status_code == 200
+        await test_bot.session.close()
+    
+    db.refresh(lead)
+    assert lead.state == "SENT"
+    assert server.methods() == ["answerCallbackQuery", "editMessageText"]
+    assert server.calls[0][1]["text"] == "Biz marked as SENT"
+    db.close()
+
+# --- PIPELINE TESTS ---
+
+@pytest.mark.asyncio
+async def test_pipeline_bounds_queues_and_concurrency():
+    """A slow stage backs up its bounded queue and holds back the stages above it."""
+    from pipeline import Pipeline, Stage
+    active = {"n": 0, "max": 0}
+    results = []
+    
+    async def fan_out(item, emit):
+        for i in range(5):
+            await emit((item, i))
+    
+    async def slow(item, emit):
+        active["n"] += 1
+        active["max"] = max(active["max"], active["n"])
+        await asyncio.sleep(0.01)
+        active["n"] -= 1
+        await emit(item)
+    
+    async def collect(items, emit):
+        results.extend(items)
+    
+    slow_stage = Stage("slow", slow, concurrency=2, queue_size=3)
+    pipeline = Pipeline([Stage("fan", fan_out, queue_size=2), slow_stage, Stage("sink", collect, batch_size=10)])
+    
+    depths = []
+    async def watch():
+        while True:
+            depths.append(slow_stage.queue.qsize())
+            await asyncio.sleep(0.002)
+    watcher = asyncio.create_task(watch())
+    await pipeline.run(range(4))
+    watcher.cancel()
+    
+    assert sorted(results) == [(a, b) for a in range(4) for b in range(5)]
+    assert active["max"] == 2 and max(depths) <= 3
+    stats = pipeline.stats()
+    assert stats["slow"]["processed"] == 20 and stats["fan"]["emitted"] == 20
+    assert pipeline.bottleneck() == "slow"
+
+@pytest.mark.asyncio
+async def test_pipeline_cancellation_stops_workers():
+    from pipeline import Pipeline, Stage
+    async def forever(item, emit):
+        await asyncio.sleep(3600)
+    pipeline = Pipeline([Stage("stuck", forever, concurrency=2)])
+    run = asyncio.create_task(pipeline.run(range(3)))
+    await asyncio.sleep(0.05)
+    run.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await run
+    assert not [t for t in asyncio.all_tasks() if t.get_name().startswith("stuck-")]
+
+@pytest.mark.asyncio
+async def test_discovery_cycle_runs_all_stages(shared_db, ledger):
+    """Scrape -> enrich -> decide -> persist -> draft -> deliver, with duplicates across queries skipped."""
+    import main
+    from models import OutboxMessage
+    from admission import AdmissionController
+    
+    async def fake_scrape(business_type, location, max_results=10):
+        return [
+            {"name": f"{business_type} {i}", "maps_url": f"https://maps/{i}", "phone": "08031234567",
+             "website": "", "category": "Dental clinic"}
+            for i in range(3)
+        ]
+    
+    with patch.object(main, "SessionLocal", shared_db), patch.object(main, "scrape_google_maps", fake_scrape), \
+            patch.object(main, "SCRAPER_DELAY", 0), use_providers(StubProvider()):
+        admission = AdmissionController(llm_calls_left=100, telegram_left=15, pending_drafts=0, unqueued_drafts=0)
+        processed, messages = await main.DiscoveryCycle(set(), admission).run(["dentist in Wuse", "dentist in Garki"])
+    
+    db = shared_db()
+    assert processed == 3 and messages == 3
+    leads = db.query(Lead).all()
+    assert {l.city for l in leads} == {"Wuse"} and {l.niche for l in leads} == {"healthcare"}
+    assert {l.state for l in leads} == {"QUEUED"}
+    assert db.query(OutboxMessage).count() == 3
+    db.close()
+
+def test_admission_capacity_is_the_tighter_of_quota_and_delivery():
+    from admission import AdmissionController
+    # 10 calls -> 5 leads, minus 2 already waiting for drafts
+    assert AdmissionController(10, 15, pending_drafts=2, unqueued_drafts=0).capacity == 3
+    # Quota to spare, but 25 drafts already cover the 2-day Telegram budget (15 left today + 15)
+    assert AdmissionController(float("inf"), 15, pending_drafts=0, unqueued_drafts=25).capacity == 5
+    controller = AdmissionController(0, 15, 0, 0)
+    assert controller.capacity == 0 and not controller.admit() and controller.parked == 1
+
+@pytest.mark.asyncio
+async def test_surplus_leads_are_parked_then_readmitted(shared_db, ledger):
+    """Leads past capacity skip enrichment and drafting, and go first next window."""
+    import main
+    from admission import AdmissionController
+    enriched = []
+    
+    async def fake_scrape(business_type, location, max_results=10):
+        return [{"name": f"Biz {i}", "maps_url": f"https://maps/p{i}", "phone": "08031234567",
+                 "website": f"https://biz{i}.ng", "category": "Salon", "reviews": str(i)} for i in range(4)]
+    
+    async def fake_enrich(url):
+        enriched.append(url)
+        return []
+    
+    with patch.object(main, "SessionLocal", shared_db), patch.object(main, "scrape_google_maps", fake_scrape), \
+            patch.object(main, "enrich_lead_with_email", fake_enrich), patch.object(main, "SCRAPER_DELAY", 0), \
+            patch.object(main, "ENRICHMENT_DELAY", 0), use_providers(StubProvider()):
+        await main.DiscoveryCycle(set(), AdmissionController(2, 15, 0, 0)).run(["salon in Wuse", "salon in Jabi"])
+        db = shared_db()
+        parked = db.query(Lead).filter(Lead.parked_at != None).all()
+        assert len(enriched) == 1 and len(parked) == 3
+        assert {l.state for l in parked} == {"DISCOVERED"}
+        
+        # Next window: the best parked leads are readmitted before any scraping
+        with patch("admission.remaining_quota", return_value=4):
+            processed, _ = await main.run_pipeline_cycle(db, set())
+        db.expire_all()
+        assert db.query(Lead).filter(Lead.parked_at != None).count() == 1
+        assert len(enriched) == 3 and enriched[1:] == ["https://biz3.ng", "https://biz2.ng"]
+        db.close()
+
+@pytest.mark.asyncio
+async def test_interrupted_cycle_resumes_from_checkpoints(shared_db, ledger):
+    """After a crash, finished queries aren't scraped again and unsaved leads pick up where they were."""
+    import main
+    from admission import AdmissionController
+    from models import DiscoveryRun, LeadCheckpoint
+    scraped, enriched = [], []
+    crashed = {"now": False}
+    
+    async def fake_scrape(business_type, location, max_results=10):
+        scraped.append(business_type)
+        if business_type == "gym" and not crashed["now"]:
+            await asyncio.sleep(3600)  # the process dies during this query
+        return [{"name": f"{business_type} {i}", "maps_url": f"https://maps/{business_type}{i}",
+                 "phone": "08031234567", "website": f"https://{business_type}{i}.ng", "category": "Spa"}
+                for i in range(2)]
+    
+    async def fake_enrich(url):
+        enriched.append(url)
+        if url == "https://spa1.ng" and not crashed["now"]:
+            await asyncio.sleep(3600)
+        return ["hi@" + url[8:]]
+    
+    def cycle():
+        return main.DiscoveryCycle(set(), AdmissionController(100, 15, 0, 0))
+    
+    with patch.object(main, "SessionLocal", shared_db), patch.object(main, "scrape_google_maps", fake_scrape), \
+            patch.object(main, "enrich_lead_with_email", fake_enrich), patch.object(main, "SCRAPER_DELAY", 0), \
+            patch.object(main, "ENRICHMENT_DELAY", 0), use_providers(StubProvider()):
+        task = asyncio.create_task(cycle().run(["spa in Wuse", "gym in Wuse"]))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        
+        db = shared_db()
+        assert db.query(Lead).count() == 1  # spa 0 made it, spa 1 is mid-enrichment
+        assert db.query(LeadCheckpoint).count() == 1
+        
+        crashed["now"] = True
+        await cycle().run(["spa in Wuse", "gym in Wuse"])
+    
+    assert scraped == ["spa", "gym", "gym"]
+    assert enriched.count("https://spa0.ng") == 1 and enriched.count("https://spa1.ng") == 2
+    db.expire_all()
+    assert db.query(Lead).count() == 4 and db.query(LeadCheckpoint).count() == 0
+    assert [r.status for r in db.query(DiscoveryRun).all()] == ["DONE"]
+    assert db.query(Lead).filter(Lead.maps_url == "https://maps/spa1").one().email == "hi@spa1.ng"
+    db.close()
+
+# --- QUERY LEASE TESTS ---
+
+def test_query_leases_claim_renew_release_and_reclaim(db_session):
+    from datetime import datetime, timedelta
+    from models import SearchQuery
+    from query_leases import sync_queries, claim_query, renew_leases, release_query
+    sync_queries(db_session, ["spa in Wuse", "gym in Wuse"])
+    
+    assert claim_query(db_session, owner="a") == "spa in Wuse"
+    assert claim_query(db_session, owner="b") == "gym in Wuse"
+    assert claim_query(db_session, owner="c") is None  # both leased
+    assert renew_leases(db_session, owner="a") == 1
+    
+    # b dies: once its lease expires, c takes the query over and b can't release it
+    db_session.query(SearchQuery).filter(SearchQuery.owner == "b") \
+        .update({"lease_expires_at": datetime.utcnow() - timedelta(seconds=1)})
+    db_session.commit()
+    assert claim_query(db_session, owner="c") == "gym in Wuse"
+    assert release_query(db_session, "gym in Wuse", owner="b") is False
+    
+    assert release_query(db_session, "spa in Wuse", owner="a", done=True)
+    assert release_query(db_session, "gym in Wuse", owner="c", done=False)
+    # Finished queries wait for the next round; unfinished ones are free again
+    assert claim_query(db_session, owner="a") == "gym in Wuse"
+    assert claim_query(db_session, owner="a") is None
+    
+    sync_queries(db_session, ["gym in Wuse"])
+    assert not db_session.query(SearchQuery).filter(SearchQuery.query == "spa in Wuse").one().active
+
+@pytest.mark.asyncio
+async def test_sharded_workers_never_scrape_the_same_query(shared_db, ledger):
+    import main
+    from admission import AdmissionController
+    scraped = []
+    queries = [f"shop{i} in Wuse" for i in range(6)]
+    
+    async def fake_scrape(business_type, location, max_results=10):
+        scraped.append(business_type)
+        await asyncio.sleep(0.01)
+        return [{"name": business_type, "maps_url": f"https://maps/{business_type}", "phone": "08031234567",
+                 "website": "", "category": "Shop"}]
+    
+    with patch.object(main, "SessionLocal", shared_db), patch.object(main, "scrape_google_maps", fake_scrape), \
+            patch.object(main, "SCRAPER_DELAY", 0), use_providers(StubProvider()):
+        workers = [
+            main.DiscoveryCycle(set(), AdmissionController(100, 15, 0, 0), sharded=True, owner=f"worker-{n}")
+            for n in range(2)
+        ]
+        await asyncio.gather(*(w.run(queries) for w in workers))
+    
+    assert sorted(scraped) == sorted(q.split(" in ")[0] for q in queries)
+    assert all(w.leads_processed > 0 for w in workers)
+    db = shared_db()
+    assert db.query(Lead).count() == 6
+    db.close()
+
+@pytest.mark.asyncio
+async def test_reclaimed_query_skips_leads_the_dead_worker_checkpointed(shared_db, ledger):
+    """The worker that checkpointed a lead finishes it; whoever takes over its query doesn't."""
+    import main
+    from datetime import datetime, timedelta
+    from admission import AdmissionController
+    from checkpoints import start_run, checkpoint_lead, SCRAPED
+    from entities import EntityResolver
+    from models import SearchQuery
+    from query_leases import sync_queries, claim_query
+    listings = [{"name": f"Shop {i}", "maps_url": f"https://maps/shop{i}", "phone": f"0803123456{i}",
+                 "website": "", "category": "Shop", "city": "Wuse"} for i in range(2)]
+    
+    # worker-a scraped the query, checkpointed Shop 0 and died before finishing it
+    db = shared_db()
+    sync_queries(db, ["shop in Wuse"])
+    assert claim_query(db, owner="worker-a") == "shop in Wuse"
+    run, _, _ = start_run(db, ["shop in Wuse"], owner="worker-a")
+    assert EntityResolver(db).resolve(dict(listings[0])) is None
+    checkpoint_lead(db, run.id, dict(listings[0], query="shop in Wuse", niche="general"), SCRAPED)
+    db.query(SearchQuery).update({"lease_expires_at": datetime.utcnow() - timedelta(seconds=1)})
+    db.commit()
+    
+    async def fake_scrape(business_type, location, max_results=10):
+        return [dict(lead) for lead in listings]
+    
+    def worker(owner):
+        return main.DiscoveryCycle(set(), AdmissionController(100, 15, 0, 0), sharded=True, owner=owner)
+    
+    with patch.object(main, "SessionLocal", shared_db), patch.object(main, "scrape_google_maps", fake_scrape), \
+            patch.object(main, "SCRAPER_DELAY", 0), use_providers(StubProvider()):
+        b = worker("worker-b")
+        await b.run(["shop in Wuse"])
+        a = worker("worker-a")
+        await a.run(["shop in Wuse"])
+    
+    assert b.leads_processed == 1 and a.leads_processed == 1
+    db.expire_all()
+    assert sorted(l.maps_url for l in db.query(Lead).all()) == ["https://maps/shop0", "https://maps/shop1"]
+    db.close()
+
+# --- METRICS TESTS ---
+
+def test_registry_renders_prometheus_text():
+    from metrics import Registry, render
+
+    registry = Registry()
+    sends = registry.counter("telegram_429", "429s", ["method"])
+    sends.inc(method="sendMessage")
+    sends.inc(2, method="sendMessage")
+    assert registry.counter("telegram_429", "429s", ["method"]) is sends  # get-or-create
+    latency = registry.histogram("llm_call_seconds", "LLM latency", ["provider"], buckets=(0.1, 1))
+    latency.observe(0.05, provider="gemini")
+    latency.observe(0.5, provider="gemini")
+    latency.observe(5, provider="gemini")
+    registry.gauge("llm_quota_remaining", "calls left").set_function(lambda: float("inf"))
+
+    text = render([(metric, {"process": "api"}) for metric in registry.collect()])
+    assert "# TYPE telegram_429 counter" in text
+    assert 'telegram_429_total{method="sendMessage",process="api"} 3' in text
+    assert 'llm_call_seconds_bucket{le="0.1",process="api",provider="gemini"} 1' in text
+    assert 'llm_call_seconds_bucket{le="1.0",process="api",provider="gemini"} 2' in text
+    assert 'llm_call_seconds_bucket{le="+Inf",process="api",provider="gemini"} 3' in text
+    assert 'llm_call_seconds_count{process="api",provider="gemini"} 3' in text
+    assert 'llm_call_seconds_sum{process="api",provider="gemini"} 5.55' in text
+    assert 'llm_quota_remaining{process="api"} +Inf' in text
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_merges_worker_snapshots(tmp_path):
+    import httpx
+    import metrics
+    from metrics import Registry, write_snapshot
+    from action_api import app
+
+    worker = Registry()
+    worker.counter("leads_scraped", "Listings extracted from Maps").inc(7)
+    write_snapshot("discovery-a", worker, directory=str(tmp_path))
+    stale = Registry()
+    stale.counter("leads_scraped", "Listings extracted from Maps").inc(99)
+    write_snapshot("discovery-old", stale, directory=str(tmp_path))
+    old = time.time() - metrics.SNAPSHOT_MAX_AGE - 1
+    with open(tmp_path / "discovery-old.json") as f:
+        snapshot = json.load(f)
+    snapshot["written_at"] = old
+    with open(tmp_path / "discovery-old.json", "w") as f:
+        json.dump(snapshot, f)
+
+    with patch.object(metrics, "SNAPSHOT_DIR", str(tmp_path)):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'leads_scraped_total{process="discovery-a"} 7' in response.text
+    assert "discovery-old" not in response.text
+    assert response.text.count("# TYPE leads_scraped counter") == 1
+
+# --- TRACING TESTS ---
+
+@pytest.fixture
+def span_file(tmp_path):
+    import tracing
+    path = str(tmp_path / "spans.jsonl")
+    with patch.object(tracing, "TRACING_ENABLED", True), patch.object(tracing, "TRACE_FILE", path):
+        yield path
+        tracing.stop_writer()
+
+@pytest.mark.asyncio
+async def test_spans_follow_the_lead_through_context_and_delivery(db_session, span_file):
+    import tracing
+    url = "https://maps.google.com/?cid=traced"
+
+    async def crawl():
+        with tracing.span("site.home"):  # knows nothing about the lead
+            await asyncio.sleep(0)
+        await asyncio.to_thread(tracing.record, "site.parse", time.time(), 0.01)
+
+    with tracing.span("enrich", key=url):
+        await crawl()
+    lead = save_lead(db_session, {"name": "Traced Ltd", "maps_url": url})
+    with tracing.span("telegram.send", key=f"lead:{lead.id}"):
+        pass
+    with tracing.span("untraced"):  # no lead in context: dropped
+        pass
+    tracing.stop_writer()
+
+    spans = list(tracing.read_spans(span_file))
+    by_name = {s["name"]: s for s in spans}
+    assert set(by_name) == {"enrich", "site.home", "site.parse", "db.save_lead", "telegram.send"}
+    assert by_name["site.home"]["parent"] == by_name["enrich"]["span"]
+    assert by_name["site.parse"]["parent"] == by_name["enrich"]["span"]
+    assert by_name["db.save_lead"]["parent"] is None
+    assert by_name["db.save_lead"]["attrs"]["lead_id"] == lead.id
+    assert list(tracing.group_by_lead(spans)) == [url]
+
+def test_trace_analyzer_reports_critical_path(span_file):
+    import tracing
+    def entry(key, name, start, duration, span, parent=None):
+        return {"key": key, "span": span, "parent": parent, "name": name, "start": start, "duration": duration}
+    rotated = [entry("a", "maps.scrape", 0, 30, "1"), entry("query:dentist in Wuse", "maps.scroll", 0, 2, "q1")]
+    current = [
+        entry("a", "enrich", 40, 20, "2"), entry("a", "site.home", 40, 15, "3", parent="2"),
+        entry("a", "llm.generate", 100, 5, "4"),
+        {**entry("a", "db.save_lead", 105, 1, "5"), "attrs": {"lead_id": "L1"}},
+        entry("lead:L1", "telegram.send", 200, 1, "6"),
+        entry("b", "maps.scrape", 0, 10, "7"),
+    ]
+    with open(span_file + ".1", "w") as f:
+        f.writelines(json.dumps(e) + "\n" for e in rotated)
+    with open(span_file, "w") as f:
+        f.writelines(json.dumps(e) + "\n" for e in current)
+        f.write('{"key": "trunc')  # half-written line from a crash
+
+    leads = tracing.group_by_lead(tracing.read_spans(span_file))
+    a = tracing.breakdown(leads["a"])
+    assert a["wall"] == 201
+    assert a["stages"] == {"maps.scrape": 30, "enrich": 20, "llm.generate": 5, "db.save_lead": 1, "telegram.send": 1}
+    assert a["detail"] == {"site.home": 15}
+    assert a["waiting"] == 201 - 57
+
+    report = tracing.summarize(tracing.read_spans(span_file), slowest=1)
+    assert "2 leads traced" in report
+    assert "slowest 1 leads" in report and "a\n" in report and "    b\n" not in report
+    assert "maps.scroll" in report
+
+# --- BENCHMARK TESTS ---
+
+@pytest.mark.asyncio
+async def test_offline_benchmarks_produce_comparable_results():
+    import benchmark
+    leads = benchmark.fixture_leads()
+    assert len(leads) == 60 and len({l["maps_url"] for l in leads}) == 60
+    assert not any("googleadservices" in l["website"] for l in leads)
+    
+    document = await benchmark.run_benchmarks(
+        ["normalize_phone", "decide_channels", "save_lead", "full_cycle"], rows=[200], micro_inputs=500, cycle_queries=1
+    )
+    results = document["results"]
+    assert set(results) == {"normalize_phone", "decide_channels", "save_lead[200]", "full_cycle", "outbox_delivery"}
+    assert results["full_cycle"]["ops"] == 60 and results["outbox_delivery"]["ops"] > 0
+    json.dumps(document)  # machine-readable as is
+    
+    faster_baseline = {"results": {name: {**r, "ops_per_sec": r["ops_per_sec"] * 2} for name, r in results.items()}}
+    comparison = benchmark.compare(document, faster_baseline)
+    assert len(comparison) == len(results) and all(row["regressed"] for row in comparison)
+    assert not any(row["regressed"] for row in benchmark.compare(document, document))
+
+# --- BULK IMPORT TESTS ---
+
+def test_vectorized_rules_match_the_per_lead_functions():
+    import pandas as pd
+    from utils import normalize_phone
+    from channel_decision import decide_channels
+    from lead_import import normalize_phones, channel_columns
+    
+    phones = ["0803 123 4567", "+234 806 555 0101", "8031234567", "N/A", "", "080312345678", "(0812) 770 010"]
+    assert normalize_phones(pd.Series(phones)).tolist() == [normalize_phone(p) for p in phones]
+    
+    frame = pd.DataFrame({
+        "website": ["https://biz.ng", "https://www.googleadservices.com/aclk?x", "", "", " "],
+        "phone": ["", "08031234567", "08031234567", "N/A", ""],
+    })
+    frame["normalized_phone"] = normalize_phones(frame["phone"])
+    expected = ["+".join(decide_channels(row)) for row in frame.to_dict("records")]
+    assert channel_columns(frame).tolist() == expected == ["EMAIL+WHATSAPP", "WHATSAPP", "WHATSAPP", "", ""]
+
+def test_bulk_import_dedupes_and_upserts_in_chunks(db_session, tmp_path):
+    from lead_import import import_leads
+    from funnel import funnel_summary
+    save_lead(db_session, {"name": "Existing Clinic", "maps_url": "https://maps/existing", "phone": "0803 000 0001"})
+    
+    csv_path = tmp_path / "campaign.csv"
+    csv_path.write_text(
+        "Business Name,Phone Number,Website,Category,City,Maps URL\n"
+        "Wuse Dental,0803 123 4567,https://wusedental.ng,Dental clinic,Wuse,\n"
+        "Wuse Dental Centre,+234 803 123 4567,,Dentist,Wuse,\n"           # same phone: duplicate
+        "Old Friend,+234 803 000 0001,,Dentist,Garki,\n"                  # phone of an existing lead
+        "Existing Clinic,,https://existing.ng,Dentist,Garki,https://maps/existing\n"  # same maps_url: update
+        ",08099999999,,,,\n"                                               # no name
+        "Quiet Shop,N/A,,Shop,Jabi,\n"                                     # no channel: not parked
+    )
+    stats = import_leads(db_session, str(csv_path), chunk_size=2).as_dict()
+    assert (stats["rows"], stats["inserted"], stats["updated"], stats["duplicates"], stats["invalid"]) == (6, 2, 1, 2, 1)
+    assert stats["parked"] == 1 and stats["rows_per_sec"] > 0
+    
+    db_session.expire_all()
+    dental = db_session.query(Lead).filter_by(business_name="Wuse Dental").one()
+    assert dental.maps_url.startswith("import:") and dental.parked_at is not None
+    assert dental.niche == "healthcare" and dental.city == "Wuse" and dental.state == "DISCOVERED"
+    existing = db_session.query(Lead).filter_by(maps_url="https://maps/existing").one()
+    assert existing.website_url == "https://existing.ng" and existing.phone_number == "0803 000 0001"
+    assert existing.city is None and existing.niche is None  # still counted in the funnel's "unknown" bucket
+    assert db_session.query(Lead).filter_by(business_name="Quiet Shop").one().parked_at is None
+    assert funnel_summary(db_session)["current"] == {"DISCOVERED": 3}
+    assert funnel_summary(db_session, city="Garki")["current"] == {}
+    
+    # Re-importing the same file changes nothing
+    again = import_leads(db_session, str(csv_path)).as_dict()
+    assert again["inserted"] == 0 and db_session.query(Lead).count() == 3
+
+def test_bulk_import_streams_xlsx(db_session, tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    from lead_import import import_leads
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["Company", "Mobile", "Email"])
+    for i in range(5):
+        workbook.active.append([f"Firm {i}", 8031230000 + i, f"info@firm{i}.ng"])  # phones stored as numbers
+    workbook.save(tmp_path / "directory.xlsx")
+    
+    stats = import_leads(db_session, str(tmp_path / "directory.xlsx"), chunk_size=2).as_dict()
+    assert stats["inserted"] == 5
+    phones = {l.phone_number for l in db_session.query(Lead)}
+    assert "8031230000" in phones
+
+# --- ENTITY RESOLUTION TESTS ---
+
+def test_entity_resolver_merges_listings_by_phone_domain_and_name(db_session):
+    from entities import EntityResolver, registered_domain
+    from models import Entity, EntityKey
+
+    assert registered_domain("https://www.smileclinic.com.ng/contact") == "smileclinic.com.ng"
+    assert registered_domain("https://web.facebook.com/smileclinic") is None
+    resolver = EntityResolver(db_session)
+    first = {"name": "Smile Dental Clinic", "maps_url": "https://maps/a", "phone": "0803 123 4567",
+             "website": "", "city": "Abuja"}
+    assert resolver.resolve(first) is None
+    save_lead(db_session, first)
+
+    # Same phone under another query, with the website the first listing lacked
+    assert resolver.resolve({"name": "Smile Dental Clinic Ltd", "maps_url": "https://maps/b", "phone": "+2348031234567",
+                             "website": "https://www.smileclinic.com.ng", "city": "Abuja"}) == "https://maps/a"
+    assert resolver.resolve({"name": "Smile Dental Clinic Ltd", "maps_url": "https://maps/b",
+                             "city": "Abuja"}) == "https://maps/a"  # alias, on a later run
+    # Same domain; then the name alone, with no contradicting phone
+    assert resolver.resolve({"name": "Smile Dental", "maps_url": "https://maps/c", "phone": "N/A",
+                             "website": "http://smileclinic.com.ng/about", "city": "Abuja"}) == "https://maps/a"
+    assert resolver.resolve({"name": "Smile Dental Clinic.", "maps_url": "https://maps/d", "phone": "N/A",
+                             "website": "", "city": "Abuja"}) == "https://maps/a"
+    # Another branch (different number), another plaza shop, another city: new businesses
+    assert resolver.resolve({"name": "Smile Dental Clinic", "maps_url": "https://maps/e", "phone": "08099999999",
+                             "website": "", "city": "Abuja"}) is None
+    for n in (12, 14):
+        assert resolver.resolve({"name": f"Wuse Plaza Shop {n}", "maps_url": f"https://maps/shop{n}",
+                                 "phone": "08055555555", "website": "", "city": "Abuja"}) is None
+    assert resolver.resolve({"name": "Smile Dental Clinic", "maps_url": "https://maps/g", "phone": "N/A",
+                             "website": "", "city": "Lagos"}) is None
+
+    lead = db_session.query(Lead).filter(Lead.maps_url == "https://maps/a").one()
+    assert lead.website_url == "https://www.smileclinic.com.ng" and lead.normalized_phone == "2348031234567"
+    assert db_session.get(Entity, "https://maps/a").merged == 3
+    assert db_session.query(EntityKey).filter(EntityKey.kind == "alias").count() == 3
+
+@pytest.mark.asyncio
+async def test_discovery_merges_cross_listings_before_enrichment(shared_db, ledger):
+    import main
+    from admission import AdmissionController
+    enriched = []
+
+    async def fake_scrape(business_type, location, max_results=10):
+        return [{"name": "Bright Smile Dental", "maps_url": f"https://maps/{business_type}", "phone": "08031234567",
+                 "website": "", "category": "Dental clinic"}]
+
+    async def fake_enrich(url):
+        enriched.append(url)
+        return []
+
+    with patch.object(main, "SessionLocal", shared_db), patch.object(main, "scrape_google_maps", fake_scrape), \
+            patch.object(main, "enrich_lead_with_email", fake_enrich), patch.object(main, "SCRAPER_DELAY", 0), \
+            use_providers(StubProvider()):
+        admission = AdmissionController(llm_calls_left=100, telegram_left=15, pending_drafts=0, unqueued_drafts=0)
+        processed, _ = await main.DiscoveryCycle(set(), admission).run(["clinics in Abuja", "dental offices in Abuja"])
+
+    db = shared_db()
+    assert processed == 1 and db.query(Lead).count() == 1 and admission.admitted == 1
+    db.close()
+
+# --- LEAD PRIORITY TESTS ---
+
+def test_typed_columns_are_backfilled_by_migration(tmp_path):
+    from sqlalchemy import text as sa_text
+    from database import migrate_columns, backfill_lead_columns
+    from utils import score_lead
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(sa_text("CREATE TABLE leads (id VARCHAR(36) PRIMARY KEY, maps_url TEXT, business_name VARCHAR(255), "
+                             "category VARCHAR(255), rating VARCHAR(10), reviews VARCHAR(10), website_url TEXT, "
+                             "email VARCHAR(255), state VARCHAR(50), created_at DATETIME)"))
+        conn.execute(sa_text("INSERT INTO leads (id, maps_url, business_name, category, rating, reviews, website_url) "
+                             "VALUES ('a', 'https://maps/a', 'A', 'Dental clinic', '4,7', '(1,203)', 'https://a.ng'), "
+                             "('b', 'https://maps/b', 'B', 'Car wash', NULL, NULL, NULL)"))
+    assert "leads.priority" in migrate_columns(engine)
+    with patch("database.BACKFILL_BATCH", 1):
+        backfill_lead_columns(engine)
+    with engine.connect() as conn:
+        rows = {r.id: r for r in conn.execute(sa_text("SELECT id, rating_value, review_count, priority FROM leads"))}
+    assert (rows["a"].rating_value, rows["a"].review_count) == (4.7, 1203) and rows["b"].review_count == 0
+    assert rows["a"].priority == score_lead({"rating": "4,7", "reviews": "(1,203)", "website": "https://a.ng",
+                                             "category": "Dental clinic"})
+    assert "leads.priority" not in migrate_columns(engine)
+
+@pytest.mark.asyncio
+async def test_telegram_queue_sends_best_drafts_first(db_session):
+    import telegram_queue
+    for name, rating, reviews in [("Weak", "3.0", "(2)"), ("Best", "4.9", "(900)"), ("Good", "4.2", "(40)")]:
+        save_lead(db_session, {"name": name, "maps_url": f"https://maps/{name}", "phone": "08031234567",
+                               "rating": rating, "reviews": reviews, "whatsapp_draft": "Hey", "state": "DRAFTED"})
+    best = db_session.query(Lead).filter(Lead.business_name == "Best").one()
+    assert (best.rating_value, best.review_count) == (4.9, 900) and best.priority > 0
+    best.email = "hi@best.ng"
+    db_session.commit()
+    assert best.priority > 60  # rescored on update
+
+    with patch.object(telegram_queue, "DAILY_SENT_LIMIT", 2):
+        assert await telegram_queue.process_telegram_queue(db_session) == 2
+    queued = {l.business_name for l in db_session.query(Lead).filter(Lead.state == "QUEUED")}
+    assert queued == {"Best", "Good"}
+
+# --- TELEGRAM RENDERING TESTS ---
+
+def test_escape_markdown_v2_translate_table():
+    from telegram_render import escape_markdown_v2
+    assert escape_markdown_v2("Dr. Ade's (Clinic) #1!") == "Dr\\. Ade's \\(Clinic\\) \\#1\\!"
+    assert escape_markdown_v2("a`b\\c", is_code=True) == "a\\`b\\\\c"
+    assert escape_markdown_v2(None) == ""
+
+def test_payload_is_rendered_when_lead_is_drafted(db_session):
+    """Drafting stores the final Telegram payload; queueing reuses it verbatim."""
+    import json as _json
+    from generation_queue import draft_lead, lead_to_data
+    from telegram_render import lead_messages
+    lead = save_lead(db_session, {"name": "Biz", "maps_url": "https://maps/r", "phone": "0803 123 4567"})
+    with patch("generation_queue.generate_message", return_value={"message": "Hello there"}):
+        draft_lead(lead, lead_to_data(lead), ["WHATSAPP"])
+    
+    assert lead.state == "DRAFTED"
+    messages = _json.loads(lead.telegram_payload)
+    assert [m["kind"] for m in messages] == ["WHATSAPP"]
+    # utils.normalize_phone is used for the wa.me link
+    assert messages[0]["reply_markup"]["inline_keyboard"][0][0]["url"].startswith("https://wa.me/2348031234567?text=Hello")
+    assert lead_messages(lead) == messages
+
+def test_migrate_columns_adds_new_model_columns(tmp_path):
+    from sqlalchemy import inspect as sa_inspect, text as sa_text
+    from database import migrate_columns
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(sa_text("CREATE TABLE leads (id VARCHAR(36) PRIMARY KEY, maps_url TEXT, business_name VARCHAR(255))"))
+    migrate_columns(engine)
+    columns = {c["name"] for c in sa_inspect(engine).get_columns("leads")}
+    assert {"telegram_payload", "state", "whatsapp_draft"} <= columns
 
 # --- SCRAPER UNIQUE IDENTIFIER TEST ---
 
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import argparse
+import statistics
+import contextvars
+import logging.handlers
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TRACE_FILE = os.getenv("LEAD_TRACE_FILE", os.path.join(DATA_DIR, "traces", "spans.jsonl"))
+TRACE_MAX_BYTES = 10 * 1024 * 1024  # rotate the span file at 10MB...
+TRACE_BACKUPS = 5                   # ...keeping this many old files
+TRACING_ENABLED = os.getenv("LEAD_TRACING", "0") == "1"
+
+# (trace key, current span id) for whatever code is running now; follows
+# awaits and asyncio.to_thread, so nested spans find their lead by themselves
+_context: contextvars.ContextVar = contextvars.ContextVar("lead_trace", default=(None, None))
+
+_span_logger = logging.getLogger("lead_spans")
+_span_logger.propagate = False
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def _start_writer():
+    """Spans go through an in-memory queue; a listener thread does the file I/O and rotation."""
+    global _listener
+    if _listener is not None:
+        return
+    os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES,
+                                                        backupCount=TRACE_BACKUPS)
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    span_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _span_logger.addHandler(logging.handlers.QueueHandler(span_queue))
+    _span_logger.setLevel(logging.INFO)
+    _listener = logging.handlers.QueueListener(span_queue, file_handler)
+    _listener.start()
+    atexit.register(stop_writer)
+
+def stop_writer():
+    """Flushes queued spans to disk."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in list(_span_logger.handlers):
+        _span_logger.removeHandler(handler)
+    _listener = None
+
+def _write(key: str, span_id: str, parent: Optional[str], name: str, start: float, duration: float,
+           attrs: Dict, error: Optional[str]):
+    entry = {"key": key, "span": span_id, "parent": parent, "name": name,
+             "start": round(start, 6), "duration": round(duration, 6)}
+    if attrs:
+        entry["attrs"] = attrs
+    if error:
+        entry["error"] = error
+    _start_writer()
+    _span_logger.info(json.dumps(entry, default=str))
+
+def record(name: str, start: float, duration: float, key: Optional[str] = None, **attrs):
+    """Writes a span measured by the caller (start in epoch seconds), e.g. one listing of a Maps scroll."""
+    if not TRACING_ENABLED:
+        return
+    context_key, parent = _context.get()
+    if key and key != context_key:
+        parent = None  # first span of another lead
+    key = key or context_key
+    if key is not None:
+        _write(key, uuid.uuid4().hex[:16], parent, name, start, duration, attrs, None)
+
+@contextmanager
+def span(name: str, key: Optional[str] = None, **attrs):
+    """
+    Times the block as a span of lead `key` (its maps_url; defaults to the
+    lead of the enclosing span). Spans opened inside become its children.
+    Yields the attrs dict so the block can add what it learns, e.g. an id.
+    """
+    if not TRACING_ENABLED:
+        yield {}
+        return
+    context_key, parent = _context.get()
+    if key and key != context_key:
+        parent = None
+    key = key or context_key
+    span_id = uuid.uuid4().hex[:16]
+    token = _context.set((key, span_id))
+    start, started = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _context.reset(token)
+        if key is not None:
+            _write(key, span_id, parent, name, start, time.perf_counter() - started, attrs, error)
+
+# --- Analysis ---
+
+def read_spans(path: str = TRACE_FILE) -> Iterator[Dict]:
+    """Spans from the current file and its rotated backups, oldest file first."""
+    paths = [f"{path}.{n}" for n in range(TRACE_BACKUPS, 0, -1)] + [path]
+    for candidate in paths:
+        if not os.path.exists(candidate):
+            continue
+        with open(candidate) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # partial line from a crash
+
+def group_by_lead(spans) -> Dict[str, List[Dict]]:
+    """
+    Spans per maps_url. Delivery only knows the lead id, so spans keyed
+    `lead:<id>` are folded into the maps_url that save_lead recorded for it.
+    """
+    by_key: Dict[str, List[Dict]] = {}
+    aliases: Dict[str, str] = {}
+    for entry in spans:
+        by_key.setdefault(entry["key"], []).append(entry)
+        lead_id = (entry.get("attrs") or {}).get("lead_id")
+        if lead_id and not entry["key"].startswith("lead:"):
+            aliases[f"lead:{lead_id}"] = entry["key"]
+    leads: Dict[str, List[Dict]] = {}
+    for key, entries in by_key.items():
+        leads.setdefault(aliases.get(key, key), []).extend(entries)
+    return leads
+
+def breakdown(entries: List[Dict]) -> Dict:
+    """
+    Critical path of one lead: wall time from its first span to the end of
+    its last, time inside top-level spans by name, and the rest as waiting
+    (queues between stages, pacing, the delivery budget).
+    """
+    ids = {e["span"] for e in entries}
+    top = sorted((e for e in entries if e.get("parent") not in ids), key=lambda e: e["start"])
+    top_ids = {e["span"] for e in top}
+    start = min(e["start"] for e in entries)
+    end = max(e["start"] + e["duration"] for e in entries)
+    by_name: Dict[str, float] = {}
+    busy, covered_to = 0.0, start
+    for e in top:
+        by_name[e["name"]] = by_name.get(e["name"], 0.0) + e["duration"]
+        e_end = e["start"] + e["duration"]
+        if e_end > covered_to:
+            busy += e_end - max(e["start"], covered_to)
+            covered_to = e_end
+    children: Dict[str, float] = {}
+    for e in entries:
+        if e["span"] not in top_ids:
+            children[e["name"]] = children.get(e["name"], 0.0) + e["duration"]
+    return {"wall": end - start, "stages": by_name, "detail": children, "waiting": max(0.0, (end - start) - busy),
+            "errors": sum(1 for e in entries if e.get("error"))}
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))] if values else 0.0
+
+def _table(per_name: Dict[str, List[float]], label: str) -> List[str]:
+    lines = [f"{label:<24}{'count':>7}{'mean':>9}{'p95':>9}{'total':>10}"]
+    for name, values in sorted(per_name.items(), key=lambda item: -sum(item[1])):
+        lines.append(f"{name:<24}{len(values):>7}{statistics.mean(values):>8.1f}s"
+                     f"{_percentile(values, 0.95):>8.1f}s{sum(values):>9.1f}s")
+    return lines
+
+def summarize(spans, slowest: int = 10) -> str:
+    """Text report: end-to-end percentiles, time per span name, the slowest leads, and Maps query phases."""
+    grouped = group_by_lead(spans)
+    leads = {key: breakdown(entries) for key, entries in grouped.items() if not key.startswith("query:")}
+    if not leads:
+        return "No lead spans found.\n"
+    lines = [f"{len(leads)} leads traced"]
+    walls = [b["wall"] for b in leads.values()]
+    lines.append(f"end-to-end: p50 {_percentile(walls, 0.5):.1f}s  p95 {_percentile(walls, 0.95):.1f}s  "
+                 f"max {max(walls):.1f}s")
+
+    per_name: Dict[str, List[float]] = {}
+    for b in leads.values():
+        for name, seconds in list(b["stages"].items()) + list(b["detail"].items()):
+            per_name.setdefault(name, []).append(seconds)
+        per_name.setdefault("(waiting)", []).append(b["waiting"])
+    lines.append("")
+    lines += _table(per_name, "span (per lead)")
+
+    lines.append("")
+    lines.append(f"slowest {min(slowest, len(leads))} leads:")
+    for key, b in sorted(leads.items(), key=lambda item: -item[1]["wall"])[:slowest]:
+        parts = sorted(list(b["stages"].items()) + [("waiting", b["waiting"])], key=lambda item: -item[1])
+        detail = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in parts if seconds >= 0.05)
+        errors = f"  [{b['errors']} errors]" if b["errors"] else ""
+        lines.append(f"  {b['wall']:>7.1f}s  {key}{errors}")
+        lines.append(f"            {detail}")
+
+    per_phase: Dict[str, List[float]] = {}
+    for key, entries in grouped.items():
+        if key.startswith("query:"):
+            for e in entries:
+                per_phase.setdefault(e["name"], []).append(e["duration"])
+    if per_phase:
+        lines.append("")
+        lines += _table(per_phase, "maps phase (per query)")
+    return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Where did each lead's time go?")
+    parser.add_argument("--file", default=TRACE_FILE, help="span file (rotated backups are read too)")
+    parser.add_argument("--slowest", type=int, default=10, help="how many of the slowest leads to list")
+    parser.add_argument("--lead", help="print every span of one maps_url in order")
+    args = parser.parse_args()
+
+    if args.lead:
+        entries = sorted(group_by_lead(read_spans(args.file)).get(args.lead, []), key=lambda e: e["start"])
+        if not entries:
+            sys.exit(f"No spans for {args.lead}")
+        origin = entries[0]["start"]
+        depth = {}
+        for e in entries:
+            depth[e["span"]] = depth.get(e.get("parent"), -1) + 1
+            error = f"  !{e['error']}" if e.get("error") else ""
+            print(f"+{e['start'] - origin:>8.2f}s {e['duration']:>7.2f}s  {'  ' * depth[e['span']]}{e['name']}"
+                  f" {e.get('attrs') or ''}{error}")
+    else:
+        sys.stdout.write(summarize(read_spans(args.file), args.slowest))
@@ -1,4 +1,6 @@
 import re
+import math
+from typing import Dict
 
 def normalize_phone(phone_str: str) -> str:
     """Cleans and normalizes Nigerian phone numbers to international format."""
@@ -17,3 +19,49 @@ def normalize_phone(phone_str: str) -> str:
         return '234' + digits
     
     return digits
+
+def parse_rating(rating_str) -> float:
+    """Parses a Maps rating like "4.7" or "4,7" into a float (0.0 if missing)."""
+    if rating_str is None:
+        return 0.0
+    if isinstance(rating_str, (int, float)):
+        return float(rating_str)
+    match = re.search(r'\d+(?:[.,]\d+)?', str(rating_str))
+    return float(match.group().replace(',', '.')) if match else 0.0
+
+def parse_review_count(reviews_str) -> int:
+    """Parses a Maps review count like "(1,203)" into an int (0 if missing)."""
+    if reviews_str is None:
+        return 0
+    if isinstance(reviews_str, (int, float)):
+        return int(reviews_str)
+    digits = re.sub(r'\D', '', str(reviews_str))
+    return int(digits) if digits else 0
+
+# Categories we close most often (appointment-driven businesses)
+HIGH_VALUE_KEYWORDS = ("clinic", "dental", "hospital", "salon", "spa", "barber", "physio", "optician", "laboratory")
+
+def score_lead(lead_data: Dict) -> float:
+    """
+    Ranks a lead by expected value using only data we already collect.
+    Higher is better; the scale is roughly 0-100.
+    """
+    score = 0.0
+    rating = parse_rating(lead_data.get("rating"))
+    reviews = parse_review_count(lead_data.get("reviews"))
+
+    score += min(rating, 5.0) / 5.0 * 30               # quality of the business
+    score += min(math.log10(1 + reviews) * 10, 30)     # footfall; 1000 reviews maxes out
+    if lead_data.get("website"):
+        score += 10
+    if lead_data.get("email"):
+        score += 15                                    # a second channel we can actually use
+    category = (lead_data.get("category") or "").lower()
+    if any(kw in category for kw in HIGH_VALUE_KEYWORDS):
+        score += 15
+    return round(score, 2)
+
+def lead_priority(lead) -> float:
+    """score_lead for a saved Lead row; stored as Lead.priority."""
+    return score_lead({"rating": lead.rating, "reviews": lead.reviews, "website": lead.website_url,
+                       "email": lead.email, "category": lead.category})